@@ -0,0 +1,115 @@
+"""
+ASGI入口 / ASGI entry point
+
+SSE推送和长轮询直接在事件循环中等待变更事件，挂起的连接不占用线程；
+其他接口通过a2wsgi在线程池中执行原有的Flask应用（导出任务仍在后台导出线程池中执行）。
+Push (SSE) and long-poll connections wait on the event loop instead of holding a
+thread; every other route runs the existing Flask app in a thread pool.
+
+用法 / Usage:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker --bind=0.0.0.0:$PORT
+"""
+import asyncio
+import json
+import os
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+from server import (app as flask_app, change_broadcaster, parse_event_seq, parse_poll_timeout,
+                    sse_message, SSE_HEARTBEAT_SECONDS)
+
+# 执行Flask接口的线程数（与railway.toml中gthread的线程数一致）
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '32'))
+
+wsgi_app = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+
+def response_headers(scope, content_type, extra=()):
+    headers = [(b'content-type', content_type)]
+    # 与flask_cors的默认配置一致：允许任意来源
+    if any(name == b'origin' for name, _ in scope['headers']):
+        headers.append((b'access-control-allow-origin', b'*'))
+    headers.extend(extra)
+    return headers
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def poll_events(scope, query, send):
+    """与 server.poll_events 相同的长轮询接口"""
+    seq = parse_event_seq(query.get('since'))
+    if seq is None:
+        payload = {'seq': change_broadcaster.seq, 'events': []}
+    else:
+        events = await change_broadcaster.wait_for_events_async(seq, parse_poll_timeout(query.get('timeout')))
+        payload = {'seq': events[-1]['seq'] if events else seq, 'events': events}
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': response_headers(scope, b'application/json')})
+    await send({'type': 'http.response.body', 'body': json.dumps(payload).encode()})
+
+
+async def stream_events(scope, query, receive, send):
+    """与 server.stream_events 相同的SSE推送通道"""
+    last_event_id = dict(scope['headers']).get(b'last-event-id')
+    seq = parse_event_seq(last_event_id.decode() if last_event_id else query.get('since'))
+    if seq is None:
+        seq = change_broadcaster.seq
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': response_headers(scope, b'text/event-stream', [
+                    (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')])})
+
+    async def send_text(text):
+        await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send_text(f'retry: 3000\nid: {seq}\n\n')
+        while True:
+            waiter = asyncio.ensure_future(change_broadcaster.wait_for_events_async(seq, SSE_HEARTBEAT_SECONDS))
+            await asyncio.wait({waiter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                return
+            events = waiter.result()
+            if not events:
+                # 心跳，防止代理断开空闲连接
+                await send_text(': keepalive\n\n')
+                continue
+            for event in events:
+                seq = event['seq']
+                await send_text(sse_message(event))
+    finally:
+        disconnected.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        query = {name: values[0] for name, values in parse_qs(scope['query_string'].decode()).items()}
+        if scope['path'] == '/api/events/poll':
+            return await poll_events(scope, query, send)
+        if scope['path'] == '/api/events':
+            return await stream_events(scope, query, receive, send)
+
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,438 @@
+"""
+性能测试脚本 / Performance benchmarks
+
+在临时SQLite数据库中生成模拟库存数据，对比新旧查询实现的耗时。
+Seeds a temporary SQLite database with synthetic inventory and times
+old vs. new query implementations.
+
+用法 / Usage:
+    python benchmark.py aggregation [--rows 200000]
+    python benchmark.py explain [--rows 20000]
+    python benchmark.py load [--rows 20000] [--clients 200] [--requests 50]
+    python benchmark.py concurrency [--rows 20000] [--writers 16] [--readers 16] [--duration 10]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# 原先基于 GROUP_CONCAT 字符串编码的BT查询（用于对比）
+LEGACY_BT_QUERY = '''
+    WITH bt_inventory AS (
+        SELECT i.item_code, b.bin_code, inv.customer_po, inv.BT, inv.pieces_per_box,
+               SUM(inv.box_count) as box_count, SUM(inv.total_pieces) as total_pieces
+        FROM inventory inv
+        JOIN items i ON inv.item_id = i.item_id
+        JOIN bins b ON inv.bin_id = b.bin_id
+        WHERE inv.BT = ?
+        GROUP BY i.item_code, b.bin_code, inv.customer_po, inv.BT, inv.pieces_per_box
+    ),
+    location_summary AS (
+        SELECT item_code, bin_code, customer_po, BT,
+               SUM(total_pieces) as po_bt_total_pieces,
+               GROUP_CONCAT(box_count || 'x' || pieces_per_box) as po_bt_box_details
+        FROM bt_inventory
+        GROUP BY item_code, bin_code, customer_po, BT
+    ),
+    item_location_summary AS (
+        SELECT item_code, bin_code, SUM(po_bt_total_pieces) as total_pieces,
+               GROUP_CONCAT(
+                   CASE
+                       WHEN customer_po IS NOT NULL AND BT IS NOT NULL THEN customer_po || '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
+                       WHEN customer_po IS NOT NULL THEN customer_po || '||' || po_bt_total_pieces || '|' || po_bt_box_details
+                       WHEN BT IS NOT NULL THEN '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
+                       ELSE '||' || po_bt_total_pieces || '|' || po_bt_box_details
+                   END
+               ) as po_bt_details
+        FROM location_summary
+        GROUP BY item_code, bin_code
+    )
+    SELECT item_code, SUM(total_pieces) as item_total_pieces,
+           GROUP_CONCAT(bin_code || '||' || total_pieces || '||' || po_bt_details, '|||') as location_details
+    FROM item_location_summary
+    GROUP BY item_code
+    ORDER BY item_code
+'''
+
+
+def legacy_bt_inventory(cursor, BT):
+    """原先的实现：SQL拼接字符串，Python再拆分解析"""
+    cursor.execute(LEGACY_BT_QUERY, (BT,))
+    items_list = []
+    for row in cursor.fetchall():
+        item_info = {'item_code': row['item_code'], 'total_pieces': row['item_total_pieces'],
+                     'total_boxes': 0, 'locations': []}
+        for location_group in (row['location_details'] or '').split('|||'):
+            parts = location_group.split('||')
+            if len(parts) < 3:
+                continue
+            location_info = {'bin_code': parts[0], 'total_pieces': int(parts[1]),
+                             'total_boxes': 0, 'po_bt_groups': []}
+            for detail in parts[2].split(','):
+                detail_parts = detail.split('|')
+                if len(detail_parts) < 4:
+                    continue
+                group_box_details = []
+                group_total_boxes = 0
+                for box_detail in detail_parts[3].split(','):
+                    if 'x' in box_detail:
+                        box_count, pieces_per_box = box_detail.split('x')
+                        group_box_details.append({'box_count': int(box_count),
+                                                  'pieces_per_box': int(pieces_per_box)})
+                        group_total_boxes += int(box_count)
+                location_info['po_bt_groups'].append({
+                    'customer_po': detail_parts[0] or None, 'BT': detail_parts[1] or None,
+                    'pieces': int(detail_parts[2]) if detail_parts[2] else 0,
+                    'total_boxes': group_total_boxes, 'box_details': group_box_details})
+                location_info['total_boxes'] += group_total_boxes
+            item_info['locations'].append(location_info)
+            item_info['total_boxes'] += location_info['total_boxes']
+        items_list.append(item_info)
+    return items_list
+
+
+def seed_database(db_path, rows, seed=42):
+    """生成模拟库存数据：rows 条库存记录，分布在若干BT/PO上"""
+    random.seed(seed)
+    db = sqlite3.connect(db_path)
+    cursor = db.cursor()
+    cursor.execute('SELECT bin_id FROM bins')
+    bin_ids = [row[0] for row in cursor.fetchall()]
+    item_count = max(100, rows // 50)
+    cursor.executemany('INSERT OR IGNORE INTO items (item_code) VALUES (?)',
+                       [(f'SKU{n:06d}',) for n in range(item_count)])
+    cursor.execute('SELECT item_id FROM items')
+    item_ids = [row[0] for row in cursor.fetchall()]
+    bts = [f'BT{n:04d}' for n in range(max(10, rows // 2000))]
+    pos = [f'PO{n:05d}' for n in range(max(10, rows // 500))]
+    data = []
+    for _ in range(rows):
+        box_count = random.randint(1, 40)
+        pieces_per_box = random.choice([6, 12, 24, 36, 48])
+        data.append((random.choice(bin_ids), random.choice(item_ids), random.choice(pos),
+                     random.choice(bts), box_count, pieces_per_box, box_count * pieces_per_box))
+    cursor.executemany('''
+        INSERT INTO inventory (bin_id, item_id, customer_po, BT, box_count, pieces_per_box, total_pieces)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', data)
+    db.commit()
+    db.close()
+    return bts, pos
+
+
+def time_call(func, repeat):
+    """返回多次调用的平均耗时（毫秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def prepare_server(rows):
+    """创建临时数据库并导入server模块（server导入时会初始化数据库）"""
+    temp_dir = tempfile.mkdtemp(prefix='inventory-bench-')
+    os.environ['INVENTORY_DB_PATH'] = os.path.join(temp_dir, 'inventory.db')
+    os.environ.pop('DATABASE_URL', None)
+    import server
+    bts, pos = seed_database(os.environ['INVENTORY_DB_PATH'], rows)
+    # 模拟数据直接写入inventory明细，需要同步重建汇总表
+    with server.app.app_context():
+        db = server.get_db()
+        server.rebuild_inventory_summary(server.get_cursor(db))
+        db.commit()
+    return server, bts, pos
+
+
+def bench_aggregation(args):
+    server, bts, pos = prepare_server(args.rows)
+    print(f"库存记录数 / inventory rows: {args.rows}, BT数: {len(bts)}")
+    with server.app.app_context():
+        cursor = server.get_cursor(server.get_db())
+        sample = bts[:args.samples]
+        
+        legacy = time_call(lambda: [legacy_bt_inventory(cursor, BT) for BT in sample], args.repeat)
+        structured = time_call(lambda: [server.build_item_location_entries(
+            server.fetch_inventory_groups(cursor, ['item_code', 'bin_code'], 'inv.BT = ?', (BT,)))
+            for BT in sample], args.repeat)
+    
+    print(f"GROUP_CONCAT + 字符串解析 / legacy:     {legacy / len(sample):8.2f} ms per BT")
+    print(f"扁平分组行 + 单次遍历 / structured:      {structured / len(sample):8.2f} ms per BT")
+
+
+# 查询接口及示例参数，用于检查每个接口的查询计划是否使用索引
+EXPLAIN_ENDPOINTS = [
+    '/api/inventory/item/{item}',
+    '/api/inventory/bin/{bin}',
+    '/api/inventory/locations/{item}',
+    '/api/inventory/BT/{bt}',
+    '/api/inventory/PO/{po}',
+    '/api/logs?date={date}',
+    '/api/logs?since_id=100&limit=50',
+]
+
+
+def find_table_scans(plan_rows):
+    """返回查询计划中没有使用索引的全表扫描"""
+    return [detail for detail in plan_rows if detail.startswith('SCAN') and 'INDEX' not in detail]
+
+
+def bench_explain(args):
+    server, bts, pos = prepare_server(args.rows)
+    db_path = os.environ['INVENTORY_DB_PATH']
+    plan_db = sqlite3.connect(db_path)
+    cursor = plan_db.cursor()
+    cursor.execute('SELECT item_code FROM items LIMIT 1')
+    item = cursor.fetchone()[0]
+    cursor.execute('SELECT bin_code FROM bins b JOIN inventory inv ON inv.bin_id = b.bin_id LIMIT 1')
+    bin_code = cursor.fetchone()[0]
+    params = {'item': item, 'bin': bin_code, 'bt': bts[0], 'po': pos[0],
+              'date': time.strftime('%Y-%m-%d')}
+    
+    client = server.app.test_client()
+    failures = 0
+    with server.app.app_context():
+        # 测试客户端与应用上下文在同一线程，复用同一个SQLite连接，可以捕获接口实际执行的SQL
+        statements = []
+        server.get_db().set_trace_callback(statements.append)
+        for endpoint in EXPLAIN_ENDPOINTS:
+            url = endpoint.format(**params)
+            statements.clear()
+            response = client.get(url)
+            print(f"\n{url}  [{response.status_code}]")
+            for sql in [sql for sql in statements if sql.lstrip().upper().startswith(('SELECT', 'WITH'))]:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = [row[3] for row in cursor.fetchall()]
+                scans = find_table_scans(plan)
+                failures += bool(scans)
+                status = 'FULL SCAN' if scans else 'ok'
+                print(f"  [{status}] {' '.join(sql.split())[:100]}")
+                for detail in plan:
+                    print(f"      {detail}")
+        server.get_db().set_trace_callback(None)
+    
+    print(f"\n未使用索引的查询数 / queries with full table scans: {failures}")
+    return 1 if failures else 0
+
+
+# 负载测试对比的两种部署方式：当前railway.toml中的gthread同步worker，以及ASGI入口
+LOAD_SERVER_COMMANDS = {
+    'wsgi (gunicorn gthread)': ['gunicorn', 'server:app', '--bind=127.0.0.1:{port}',
+                                '--worker-class', 'gthread', '--threads', '32'],
+    'asgi (uvicorn)': ['uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', '{port}',
+                       '--log-level', 'warning'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def http_request(port, method, path, body=None, timeout=10):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        if body is None:
+            conn.request(method, path)
+        else:
+            conn.request(method, path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def http_get(port, path, timeout):
+    return http_request(port, 'GET', path, timeout=timeout)
+
+
+def start_load_server(command, port, env=None):
+    """启动服务进程（默认共用当前进程设置的临时数据库），等待端口可用"""
+    process = subprocess.Popen([part.format(port=port) for part in command],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            http_get(port, '/api/events/poll', timeout=1)
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"服务启动失败 / server failed to start: {' '.join(command)}")
+
+
+def run_load(command, bin_codes, args):
+    """挂起 clients 个长轮询连接（模拟空闲的扫码枪），同时测量普通查询的响应时间"""
+    port = free_port()
+    process = start_load_server(command, port)
+    try:
+        seq = json.loads(http_get(port, '/api/events/poll', timeout=5)[1])['seq']
+        
+        def poller():
+            while True:
+                try:
+                    http_get(port, f'/api/events/poll?since={seq}&timeout=30', timeout=40)
+                except OSError:
+                    time.sleep(0.5)
+        
+        for _ in range(args.clients):
+            threading.Thread(target=poller, daemon=True).start()
+        time.sleep(2)  # 等待长轮询连接全部挂起
+        
+        latencies = []
+        errors = 0
+        for n in range(args.requests):
+            start = time.perf_counter()
+            try:
+                status, _ = http_get(port, f'/api/inventory/bin/{bin_codes[n % len(bin_codes)]}',
+                                     timeout=args.request_timeout)
+                errors += status != 200
+            except OSError:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+        return latencies, errors
+    finally:
+        process.kill()
+        process.wait()
+
+
+def bench_load(args):
+    prepare_server(args.rows)
+    db = sqlite3.connect(os.environ['INVENTORY_DB_PATH'])
+    bin_codes = [row[0] for row in db.execute('''
+        SELECT DISTINCT b.bin_code FROM bins b JOIN inventory_summary inv ON inv.bin_id = b.bin_id LIMIT 50
+    ''')]
+    db.close()
+    print(f"挂起的长轮询连接 / parked long-poll clients: {args.clients}, "
+          f"查询次数 / lookups: {args.requests}")
+    
+    for mode, command in LOAD_SERVER_COMMANDS.items():
+        latencies, errors = run_load(command, bin_codes, args)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"{mode:26s} p50 {p50:9.1f} ms   p95 {p95:9.1f} ms   max {latencies[-1]:9.1f} ms   "
+              f"errors {errors}")
+
+
+# 并发读写测试对比的SQLite配置：legacy为默认回滚日志、各线程直接提交；tuned为WAL+单写线程合并提交
+CONCURRENCY_PROFILES = ['legacy', 'tuned']
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_concurrency(profile, db_path, bin_codes, item_codes, args):
+    """writers个线程持续入库，同时readers个线程轮询历史记录和库位库存（模拟扫码枪和5秒轮询的页面）"""
+    env = dict(os.environ, SQLITE_PROFILE=profile, INVENTORY_DB_PATH=db_path, CHECKPOINT_INTERVAL_SECONDS='0')
+    port = free_port()
+    process = start_load_server(LOAD_SERVER_COMMANDS['wsgi (gunicorn gthread)'], port, env)
+    latencies = {'write': [], 'read': []}
+    errors = {'write': 0, 'read': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+    
+    def client(kind, seed):
+        rng = random.Random(seed)
+        while time.time() < deadline:
+            if kind == 'write':
+                method, body = 'POST', {'bin_code': rng.choice(bin_codes), 'item_code': rng.choice(item_codes),
+                                        'box_count': rng.randint(1, 10), 'pieces_per_box': 12}
+                path = '/api/inventory'
+            elif rng.random() < 0.5:
+                method, body, path = 'GET', None, '/api/logs?since_id=0&limit=200'
+            else:
+                method, body, path = 'GET', None, f'/api/inventory/bin/{rng.choice(bin_codes)}'
+            start = time.perf_counter()
+            try:
+                status, data = http_request(port, method, path, body, timeout=args.request_timeout)
+                failed, locked = status != 200, b'locked' in data
+            except OSError:
+                failed, locked = True, False
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies[kind].append(elapsed)
+                errors[kind] += failed
+                errors['locked'] += locked
+    
+    try:
+        threads = [threading.Thread(target=client, args=('write', n)) for n in range(args.writers)]
+        threads += [threading.Thread(target=client, args=('read', 1000 + n)) for n in range(args.readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db_metrics = json.loads(http_get(port, '/api/metrics/db', timeout=5)[1])
+    finally:
+        process.kill()
+        process.wait()
+    return latencies, errors, db_metrics
+
+
+def bench_concurrency(args):
+    prepare_server(args.rows)
+    source = sqlite3.connect(os.environ['INVENTORY_DB_PATH'])
+    bin_codes = [row[0] for row in source.execute('SELECT bin_code FROM bins LIMIT 200')]
+    item_codes = [row[0] for row in source.execute('SELECT item_code FROM items LIMIT 200')]
+    print(f"入库线程 / writers: {args.writers}, 查询线程 / readers: {args.readers}, "
+          f"时长 / duration: {args.duration}s")
+    
+    for profile in CONCURRENCY_PROFILES:
+        # 每种配置使用同一份数据的独立副本
+        db_path = os.path.join(os.path.dirname(os.environ['INVENTORY_DB_PATH']), f'{profile}.db')
+        target = sqlite3.connect(db_path)
+        source.backup(target)
+        target.close()
+        
+        latencies, errors, db_metrics = run_concurrency(profile, db_path, bin_codes, item_codes, args)
+        writes = sorted(latencies['write'])
+        reads = sorted(latencies['read'])
+        print(f"{profile:7s} writes {len(writes) / args.duration:7.1f}/s   "
+              f"write p50 {percentile(writes, 0.5):7.1f} ms  p95 {percentile(writes, 0.95):7.1f} ms   "
+              f"read p50 {percentile(reads, 0.5):7.1f} ms  p95 {percentile(reads, 0.95):7.1f} ms   "
+              f"errors {errors['write'] + errors['read']} (locked {errors['locked']})")
+        if db_metrics.get('writer', {}).get('batches'):
+            print(f"{'':7s} group commit: {db_metrics['writer']['jobs_per_batch_avg']} writes per commit")
+    source.close()
+
+
+BENCHMARKS = {
+    'aggregation': bench_aggregation,
+    'explain': bench_explain,
+    'load': bench_load,
+    'concurrency': bench_concurrency,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inventory performance benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=200000, help='模拟库存记录数 / synthetic inventory rows')
+    parser.add_argument('--samples', type=int, default=5, help='每轮查询的样本数 / lookups per round')
+    parser.add_argument('--repeat', type=int, default=3, help='重复轮数 / rounds')
+    parser.add_argument('--clients', type=int, default=200, help='挂起的长轮询连接数 / parked long-poll clients')
+    parser.add_argument('--requests', type=int, default=50, help='负载测试中的查询次数 / lookups under load')
+    parser.add_argument('--request-timeout', type=float, default=10, help='单次查询超时（秒）/ lookup timeout')
+    parser.add_argument('--writers', type=int, default=16, help='并发入库线程数 / concurrent writer threads')
+    parser.add_argument('--readers', type=int, default=16, help='并发查询线程数 / concurrent reader threads')
+    parser.add_argument('--duration', type=float, default=10, help='并发测试时长（秒）/ concurrency test duration')
+    args = parser.parse_args()
+    return BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
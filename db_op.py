@@ -1,5 +1,6 @@
 import os
 import sqlite3
+import sys
 from datetime import datetime
 
 class DatabaseManager:
@@ -7,6 +8,9 @@ class DatabaseManager:
         self.messages = {
             'no_db': "数据库文件不存在\nDatabase file does not exist",
             'backup_success': "数据库已备份到\nDatabase backed up to:\n{}",
+            'backup_incremental': "上次备份到历史记录 {}，只备份之后的历史记录（增量备份）？\n"
+                                  "Last backup ends at history id {}. Back up only newer history (incremental)? (y/N): ",
+            'backup_error': "备份数据库时出错\nError backing up database:\n{}",
             'db_clean_success': "数据库清理完成\nDatabase cleaned successfully",
             'db_clean_error': "清理过程中出错\nError during cleaning:\n{}",
             'db_deleted': "数据库文件已删除\nDatabase file deleted",
@@ -15,7 +19,28 @@ class DatabaseManager:
             'menu_1': "1. 备份当前数据库（包含库存和历史记录）\n   Backup current database (including inventory and history)",
             'menu_2': "2. 清空库存和历史记录（保留商品和库位数据）\n   Clear inventory and history (keep items and bins)",
             'menu_3': "3. 完全删除数据库（需要重新导入商品和库位数据）\n   Delete database completely (requires re-import of items and bins)",
-            'input_prompt': "\n请输入选项\nEnter option (1-3): ",
+            'menu_4': "4. 重建库存汇总表（根据库存明细重新计算）\n   Rebuild inventory summary (recompute from inventory rows)",
+            'summary_success': "库存汇总表已重建，共 {} 行\nInventory summary rebuilt, {} rows",
+            'summary_error': "重建库存汇总表时出错\nError rebuilding inventory summary:\n{}",
+            'menu_5': "5. 导入/同步库位CSV（新增库位，标记已移除的库位）\n   Import/sync bins from CSV (add new bins, flag removed ones)",
+            'bins_path_prompt': "\n请输入库位CSV文件路径\nEnter bin CSV path [BIN.csv]: ",
+            'bins_not_found': "文件不存在\nFile does not exist:\n{}",
+            'bins_diff': "库位总数 / bins in file: {total}\n新增 / to add: {added}\n未变化 / unchanged: {unchanged}\n"
+                         "不在新文件中 / missing from file: {missing_count}\n其中仍有库存 / still holding inventory: {stocked_count}",
+            'bins_stocked': "以下库位仍有库存，不会删除\nThese bins still hold inventory and will not be removed:\n{}",
+            'bins_confirm': "\n确认导入？删除没有库存的已移除库位请输入 r\nApply import? (y = add only, r = add and remove empty missing bins, n = cancel): ",
+            'bins_success': "库位同步完成：新增 {added}，删除 {removed}\nBins synced: {added} added, {removed} removed",
+            'bins_cancelled': "已取消\nCancelled",
+            'bins_error': "导入库位时出错\nError importing bins:\n{}",
+            'menu_6': "6. 生成库存检查点（并按保留策略清理旧检查点）\n   Take an inventory checkpoint (and prune old checkpoints)",
+            'checkpoint_success': "已生成检查点：history_id {history_id}，{row_count} 行，{size} 字节，清理 {pruned} 个旧检查点\n"
+                                  "Checkpoint taken: history_id {history_id}, {row_count} rows, {size} bytes, {pruned} old checkpoints pruned",
+            'checkpoint_error': "生成检查点时出错\nError taking checkpoint:\n{}",
+            'menu_7': "7. 归档旧的历史记录（把已结束的旧月份移到归档库）\n   Archive old history (move closed months to the archive)",
+            'archive_success': "已归档 {} 条历史记录\nArchived {} history rows",
+            'archive_months': "  {month}: {row_count}",
+            'archive_error': "归档历史记录时出错\nError archiving history:\n{}",
+            'input_prompt': "\n请输入选项\nEnter option (1-7): ",
             'invalid_choice': "无效的选项，请重新选择\nInvalid option, please try again",
             'press_enter': "\n按回车键退出\nPress Enter to exit..."
         }
@@ -27,8 +52,22 @@ class DatabaseManager:
         """检查数据库是否存在"""
         return os.path.exists('inventory.db')
 
+    def latest_backup_history_id(self, backup_dir):
+        """最近一次备份中最大的history_id，没有备份时返回None"""
+        backups = [os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+                   if name.startswith('inventory_') and name.endswith('.db')]
+        if not backups:
+            return None
+        conn = sqlite3.connect(max(backups, key=os.path.getmtime))
+        try:
+            return conn.execute('SELECT MAX(history_id) FROM input_history').fetchone()[0]
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.close()
+
     def backup_db(self):
-        """备份数据库"""
+        """在线备份数据库（逐页复制，服务器运行时也可以备份）"""
         if not self.check_db_exists():
             print(self.msg('no_db'))
             return False
@@ -37,11 +76,28 @@ class DatabaseManager:
         if not os.path.exists(backup_dir):
             os.makedirs(backup_dir)
         
+        since_history_id = self.latest_backup_history_id(backup_dir)
+        if since_history_id is not None:
+            answer = input(self.msg('backup_incremental').format(since_history_id, since_history_id))
+            if answer.strip().lower() != 'y':
+                since_history_id = None
+        
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_file = f'{backup_dir}/inventory_{timestamp}.db'
+        if since_history_id is not None:
+            backup_file = f'{backup_dir}/inventory_{timestamp}_since_{since_history_id}.db'
         
-        with open('inventory.db', 'rb') as src, open(backup_file, 'wb') as dst:
-            dst.write(src.read())
+        from server import backup_sqlite_database, get_history_archive_path
+        
+        try:
+            backup_sqlite_database(backup_file, since_history_id)
+            # 完整备份同时备份历史归档库（增量备份之间归档的记录已包含在之前的备份中）
+            if since_history_id is None and os.path.exists(get_history_archive_path()):
+                backup_sqlite_database(f'{backup_dir}/archive_{timestamp}.db', database='archive')
+        except Exception as e:
+            print(self.msg('backup_error').format(e))
+            input(self.msg('press_enter'))
+            return False
         
         print(self.msg('backup_success').format(backup_file))
         input(self.msg('press_enter'))
@@ -53,13 +109,30 @@ class DatabaseManager:
             print(self.msg('no_db'))
             return
         
+        from server import get_history_archive_path
+        
         conn = sqlite3.connect('inventory.db')
         cursor = conn.cursor()
         
         try:
+            cursor.execute('ATTACH DATABASE ? AS archive', (get_history_archive_path(),))
             cursor.execute('DELETE FROM inventory')
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='inventory_summary'")
+            if cursor.fetchone():
+                cursor.execute('DELETE FROM inventory_summary')
             cursor.execute('DELETE FROM input_history')
+            # 历史记录清空后检查点对应的history_id不再有效
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='inventory_checkpoints'")
+            if cursor.fetchone():
+                cursor.execute('DELETE FROM inventory_checkpoints')
             cursor.execute('DELETE FROM sqlite_sequence WHERE name IN ("inventory", "input_history")')
+            # 清空历史归档（主库中的归档目录和归档库中的月份表）
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='history_archive_months'")
+            if cursor.fetchone():
+                cursor.execute('DELETE FROM history_archive_months')
+            cursor.execute("SELECT name FROM archive.sqlite_master WHERE type='table'")
+            for (table,) in cursor.fetchall():
+                cursor.execute(f'DROP TABLE archive.{table}')
             conn.commit()
             print(self.msg('db_clean_success'))
             input(self.msg('press_enter'))
@@ -80,12 +153,115 @@ class DatabaseManager:
             
         try:
             os.remove('inventory.db')
+            from server import get_history_archive_path
+            if os.path.exists(get_history_archive_path()):
+                os.remove(get_history_archive_path())
             print(self.msg('db_deleted'))
             input(self.msg('press_enter'))
         except Exception as e:
             print(self.msg('delete_error').format(e))
             input(self.msg('press_enter'))
 
+    def rebuild_summary(self):
+        """根据inventory明细重建库存汇总表"""
+        if not self.check_db_exists():
+            print(self.msg('no_db'))
+            return
+        
+        from server import app, get_db, get_cursor, rebuild_inventory_summary
+        
+        with app.app_context():
+            db = get_db()
+            try:
+                row_count = rebuild_inventory_summary(get_cursor(db))
+                db.commit()
+                print(self.msg('summary_success').format(row_count, row_count))
+            except Exception as e:
+                db.rollback()
+                print(self.msg('summary_error').format(e))
+        input(self.msg('press_enter'))
+
+    def import_bins(self):
+        """从CSV导入/同步库位：先显示差异，确认后在同一个事务中写入"""
+        if not self.check_db_exists():
+            print(self.msg('no_db'))
+            return
+        
+        path = input(self.msg('bins_path_prompt')).strip() or 'BIN.csv'
+        if not os.path.exists(path):
+            print(self.msg('bins_not_found').format(path))
+            input(self.msg('press_enter'))
+            return
+        
+        from server import app, get_db, get_cursor, read_bin_codes, sync_bins
+        
+        with app.app_context():
+            db = get_db()
+            cursor = get_cursor(db)
+            try:
+                with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+                    bin_codes = list(read_bin_codes(f))
+                preview = sync_bins(cursor, bin_codes)
+                db.rollback()
+                print(self.msg('bins_diff').format(missing_count=len(preview['missing']),
+                                                   stocked_count=len(preview['missing_with_inventory']),
+                                                   **preview))
+                if preview['missing_with_inventory']:
+                    print(self.msg('bins_stocked').format(', '.join(preview['missing_with_inventory'])))
+                
+                choice = input(self.msg('bins_confirm')).strip().lower()
+                if choice not in ('y', 'r'):
+                    print(self.msg('bins_cancelled'))
+                else:
+                    result = sync_bins(cursor, bin_codes, remove_missing=(choice == 'r'))
+                    db.commit()
+                    print(self.msg('bins_success').format(**result))
+            except Exception as e:
+                db.rollback()
+                print(self.msg('bins_error').format(e))
+        input(self.msg('press_enter'))
+
+    def create_checkpoint(self, interactive=True):
+        """生成库存检查点并清理旧检查点（也可以用 python db_op.py checkpoint 从定时任务调用）"""
+        if not self.check_db_exists():
+            print(self.msg('no_db'))
+            return
+        
+        from server import app, get_db, create_inventory_checkpoint, prune_inventory_checkpoints
+        
+        with app.app_context():
+            db = get_db()
+            try:
+                checkpoint = create_inventory_checkpoint(db)
+                checkpoint['pruned'] = prune_inventory_checkpoints(db)
+                print(self.msg('checkpoint_success').format(**checkpoint))
+            except Exception as e:
+                db.rollback()
+                print(self.msg('checkpoint_error').format(e))
+        if interactive:
+            input(self.msg('press_enter'))
+
+    def archive_history(self, interactive=True):
+        """归档旧的历史记录（也可以用 python db_op.py archive 从定时任务调用）"""
+        if not self.check_db_exists():
+            print(self.msg('no_db'))
+            return
+        
+        from server import app, get_db, archive_history
+        
+        with app.app_context():
+            try:
+                archived = archive_history()
+                row_count = sum(archived.values())
+                print(self.msg('archive_success').format(row_count, row_count))
+                for month, month_rows in archived.items():
+                    print(self.msg('archive_months').format(month=month, row_count=month_rows))
+            except Exception as e:
+                get_db().rollback()
+                print(self.msg('archive_error').format(e))
+        if interactive:
+            input(self.msg('press_enter'))
+
     def run(self):
         """运行主程序"""
         # 首先检查数据库是否存在
@@ -102,6 +278,14 @@ class DatabaseManager:
             print(self.msg('menu_2'))
             print()  # 空行分隔
             print(self.msg('menu_3'))
+            print()  # 空行分隔
+            print(self.msg('menu_4'))
+            print()  # 空行分隔
+            print(self.msg('menu_5'))
+            print()  # 空行分隔
+            print(self.msg('menu_6'))
+            print()  # 空行分隔
+            print(self.msg('menu_7'))
             
             choice = input(self.msg('input_prompt')).strip()
             
@@ -114,9 +298,26 @@ class DatabaseManager:
             elif choice == '3':
                 self.delete_db()
                 break
+            elif choice == '4':
+                self.rebuild_summary()
+                break
+            elif choice == '5':
+                self.import_bins()
+                break
+            elif choice == '6':
+                self.create_checkpoint()
+                break
+            elif choice == '7':
+                self.archive_history()
+                break
             else:
                 print(self.msg('invalid_choice'))
 
 if __name__ == '__main__':
     db_manager = DatabaseManager()
-    db_manager.run() 
\ No newline at end of file
+    if sys.argv[1:] == ['checkpoint']:
+        db_manager.create_checkpoint(interactive=False)
+    elif sys.argv[1:] == ['archive']:
+        db_manager.archive_history(interactive=False)
+    else:
+        db_manager.run() 
\ No newline at end of file
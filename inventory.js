@@ -15,19 +15,134 @@ const API_URL = getApiUrl();
 // 设置自动更新间隔（毫秒）
 const UPDATE_INTERVAL = 5000;
 
-// 上次更新时间
-let lastUpdateTime = null;
+// 历史记录每页条数：服务器返回已合并"清空并添加"的记录，每次只渲染当前页
+const HISTORY_PAGE_SIZE = 50;
 
-// 缓存最近一次获取的日志，语言切换时直接使用本地渲染以避免重复网络请求
-let cachedLogs = [];
+// 最近一次获取的历史记录页，语言切换时直接使用本地渲染以避免重复网络请求
+let recentHistoryPage = null;
+let fullHistoryPage = null;
+
+// 历史记录标签页的分页游标：第n页请求的before_id（第一页为null）
+let fullHistoryCursors = [null];
+let fullHistoryPageIndex = 0;
 
 // 定义更新间隔变量
 let recentHistoryUpdateInterval = null;
 let fullHistoryUpdateInterval = null;
 
+// 服务器推送通道（SSE），连接成功后停止定时轮询
+let changeEventSource = null;
+let pushConnected = false;
+
+// 历史记录标签页是否处于打开状态
+let historyTabActive = false;
+
+// 待提交的录入队列：扫码连续录入时合并为批量请求
+let pendingInventoryEntries = [];
+let inventoryFlushTimer = null;
+let inventoryFlushRequest = null;
+const INVENTORY_FLUSH_DELAY = 1500;  // 最后一次录入后等待多久提交（毫秒）
+const INVENTORY_BATCH_SIZE = 50;     // 队列达到该数量时立即提交
+const INVENTORY_BATCH_MAX_LINES = 2000;  // 单次请求最多提交的行数（与服务器端上限一致）
+const INVENTORY_RETRY_DELAY = 5000;  // 网络中断后重试的间隔（毫秒）
+// 提交失败、等待重试的批次：保留原batch_id，服务器已经提交过的批次不会重复入库
+let inventoryRetryBatch = null;
+
 // 跟踪用户选择的日期
 let userSelectedDate = null;
 
+// ETag缓存：请求URL -> { etag, data }，服务器返回304时复用上次的数据
+const etagCache = new Map();
+const ETAG_CACHE_SIZE = 100;
+
+// 与$.ajax用法相同的GET请求：自动携带If-None-Match，304时用缓存数据调用success
+function etagAjax(options) {
+    const key = options.data ? `${options.url}?${$.param(options.data)}` : options.url;
+    const cached = etagCache.get(key);
+    const deferred = $.Deferred();
+    
+    $.ajax({
+        url: options.url,
+        type: 'GET',
+        data: options.data,
+        headers: cached ? { 'If-None-Match': cached.etag } : {}
+    }).done(function(data, textStatus, xhr) {
+        etagCache.delete(key);
+        if (xhr.status === 304 && cached) {
+            data = cached.data;
+            etagCache.set(key, cached);
+        } else if (xhr.getResponseHeader('ETag')) {
+            etagCache.set(key, { etag: xhr.getResponseHeader('ETag'), data: data });
+            if (etagCache.size > ETAG_CACHE_SIZE) {
+                // Map按插入顺序遍历，第一个即最久未使用的条目
+                etagCache.delete(etagCache.keys().next().value);
+            }
+        }
+        if (options.success) options.success(data, textStatus, xhr);
+        deferred.resolve(data, textStatus, xhr);
+    }).fail(function(xhr, textStatus, error) {
+        if (options.error) options.error(xhr, textStatus, error);
+        deferred.reject(xhr, textStatus, error);
+    });
+    return deferred.promise();
+}
+
+// 解码紧凑格式（?format=compact）的表：字符串列存的是strings中的下标（-1表示null），还原为对象数组
+function decodeCompactRows(table) {
+    const stringColumns = new Set(table.string_columns);
+    const count = table.data.length ? table.data[0].length : 0;
+    const rows = [];
+    for (let i = 0; i < count; i++) {
+        const row = {};
+        table.columns.forEach((column, index) => {
+            const value = table.data[index][i];
+            row[column] = stringColumns.has(column) ? (value < 0 ? null : table.strings[value]) : value;
+        });
+        rows.push(row);
+    }
+    return rows;
+}
+
+// 把按 商品、库位、PO、BT、箱规 排序的分组行组装成 商品 -> 库位 -> PO/BT 的嵌套结构（与服务器端的普通格式相同）
+function buildItemLocations(rows) {
+    const items = [];
+    let item = null;
+    let location = null;
+    let group = null;
+    rows.forEach(row => {
+        if (!item || item.item_code !== row.item_code) {
+            item = { item_code: row.item_code, total_pieces: 0, total_boxes: 0, locations: [] };
+            items.push(item);
+            location = null;
+        }
+        if (!location || location.bin_code !== row.bin_code) {
+            location = { bin_code: row.bin_code, total_pieces: 0, total_boxes: 0, po_bt_groups: [] };
+            item.locations.push(location);
+            group = null;
+        }
+        if (!group || group.customer_po !== row.customer_po || group.BT !== row.BT) {
+            group = { customer_po: row.customer_po, BT: row.BT, pieces: 0, total_boxes: 0, box_details: [] };
+            location.po_bt_groups.push(group);
+        }
+        group.pieces += row.total_pieces;
+        group.total_boxes += row.box_count;
+        group.box_details.push({ box_count: row.box_count, pieces_per_box: row.pieces_per_box });
+        location.total_pieces += row.total_pieces;
+        location.total_boxes += row.box_count;
+        item.total_pieces += row.total_pieces;
+        item.total_boxes += row.box_count;
+    });
+    return items;
+}
+
+// BT/PO查询使用紧凑格式，收到后展开为items（304时复用的缓存对象已经展开过）
+function expandCompactInventory(data) {
+    if (data.format === 'compact' && !data.items) {
+        data.items = buildItemLocations(decodeCompactRows(data.rows));
+    }
+    return data;
+}
+
 // 兼容iPad的日期解析函数
 function parseDateSafely(timestamp) {
     try {
@@ -113,131 +228,32 @@ function formatDateSafely(date, locale = 'zh-CN') {
     }
 }
 
-// 合并"清空并添加"的历史记录（将紧邻的 清空库位 + 添加 组合为一条）
-function mergeClearAndAddLogs(logs) {
-    if (!Array.isArray(logs) || logs.length === 0) return [];
-    const result = [];
-    const usedIndexSet = new Set();
-    const isClear = (code) => code === '清空库位' || code === 'Clear Bin';
-    const isClearBinItem = (code) => code && code.startsWith('清空库位') && !isClear(code);
-    const isClearItem = (code) => code && (code.startsWith('清空商品') || code.startsWith('Clear Item'));
-    const withinMs = 5000; // 允许合并的最大时间差（毫秒）
-
-    for (let i = 0; i < logs.length; i++) {
-        if (usedIndexSet.has(i)) continue;
-        const current = logs[i];
-
-        // 收集同一库位、同一时间段内的所有清空记录
-        const clearRecords = [];
-        let addRecord = null;
-        
-        // 检查当前记录是否是添加记录
-        if (!isClear(current.item_code) && !isClearBinItem(current.item_code) && !isClearItem(current.item_code)) {
-            addRecord = current;
-            
-            // 向后查找可能的清空记录
-            for (let k = i + 1; k < logs.length && k <= i + 10; k++) { // 限制搜索范围
-                if (usedIndexSet.has(k)) continue;
-                const candidate = logs[k];
-                
-                // 使用安全的日期解析
-                const timeA = parseDateSafely(current.timestamp);
-                const timeB = parseDateSafely(candidate.timestamp);
-                const closeInTime = timeA && timeB && Math.abs(timeA.getTime() - timeB.getTime()) <= withinMs;
-                const sameBin = current.bin_code === candidate.bin_code;
-                
-                if (sameBin && closeInTime && (isClear(candidate.item_code) || isClearBinItem(candidate.item_code))) {
-                    clearRecords.push(candidate);
-                    usedIndexSet.add(k);
-                }
-            }
-        }
-        
-        // 检查当前记录是否是清空记录
-        else if (isClear(current.item_code) || isClearBinItem(current.item_code)) {
-            clearRecords.push(current);
-            
-            // 向前查找可能的添加记录
-            for (let k = i - 10; k < i; k++) { // 限制搜索范围
-                if (k < 0 || usedIndexSet.has(k)) continue;
-                const candidate = logs[k];
-                
-                // 使用安全的日期解析
-                const timeA = parseDateSafely(current.timestamp);
-                const timeB = parseDateSafely(candidate.timestamp);
-                const closeInTime = timeA && timeB && Math.abs(timeA.getTime() - timeB.getTime()) <= withinMs;
-                const sameBin = current.bin_code === candidate.bin_code;
-                
-                if (sameBin && closeInTime && !isClear(candidate.item_code) && 
-                    !isClearBinItem(candidate.item_code) && !isClearItem(candidate.item_code)) {
-                    if (!addRecord) { // 只取第一个匹配的添加记录
-                        addRecord = candidate;
-                        // 注意：这里不要立即标记为已使用，等确认合并后再标记
-                    }
-                }
-            }
-            
-            // 继续收集同一时间段的其他清空记录（只有在找到添加记录时才收集）
-            if (addRecord) {
-                for (let k = i + 1; k < logs.length && k <= i + 10; k++) {
-                    if (usedIndexSet.has(k)) continue;
-                    const candidate = logs[k];
-                    
-                    const timeA = parseDateSafely(current.timestamp);
-                    const timeB = parseDateSafely(candidate.timestamp);
-                    const closeInTime = timeA && timeB && Math.abs(timeA.getTime() - timeB.getTime()) <= withinMs;
-                    const sameBin = current.bin_code === candidate.bin_code;
-                    
-                    if (sameBin && closeInTime && (isClear(candidate.item_code) || isClearBinItem(candidate.item_code))) {
-                        clearRecords.push(candidate);
-                        // 注意：这里也不要立即标记为已使用，等确认合并后再标记
-                    }
-                }
-            }
-        }
-
-        // 如果找到了清空+添加的组合，创建合并记录
-        if (clearRecords.length > 0 && addRecord) {
-            // 现在才标记为已使用
-            for (let k = i - 10; k < i; k++) {
-                if (k < 0) continue;
-                const candidate = logs[k];
-                if (candidate === addRecord) {
-                    usedIndexSet.add(k);
-                    break;
-                }
-            }
-            
-            // 标记所有相关的清空记录为已使用
-            for (let k = i + 1; k < logs.length && k <= i + 10; k++) {
-                const candidate = logs[k];
-                if (clearRecords.includes(candidate)) {
-                    usedIndexSet.add(k);
-                }
-            }
-            
-            result.push({
-                __merged: true,
-                __clearRecords: clearRecords, // 保存所有被清空的记录
-                bin_code: addRecord.bin_code,
-                item_code: addRecord.item_code,
-                box_count: addRecord.box_count,
-                pieces_per_box: addRecord.pieces_per_box,
-                total_pieces: addRecord.total_pieces,
-                customer_po: addRecord.customer_po,
-                BT: addRecord.BT,
-                timestamp: addRecord.timestamp
-            });
-            usedIndexSet.add(i);
-            continue;
-        }
+// 本地日期 YYYY-MM-DD
+function localDateString(date) {
+    return date.getFullYear() + '-' + 
+           String(date.getMonth() + 1).padStart(2, '0') + '-' + 
+           String(date.getDate()).padStart(2, '0');
+}
 
-        // 无法合并则原样放入
-        result.push(current);
-        usedIndexSet.add(i);
-    }
+// 获取一页合并后的历史记录（按history_id倒序，日期按本地时区过滤）
+function fetchHistoryPage(params) {
+    return etagAjax({
+        url: `${API_URL}/api/history`,
+        data: Object.assign({ limit: HISTORY_PAGE_SIZE, tz_offset: new Date().getTimezoneOffset() }, params)
+    });
+}
 
-    return result;
+// 渲染一页历史记录
+function renderHistoryRecords(records, lang, locale) {
+    return records.map(record => {
+        // 使用安全的日期解析和格式化
+        const utcDate = parseDateSafely(record.timestamp);
+        if (!utcDate) {
+            // 如果日期解析失败，显示原始时间戳
+            return formatHistoryRecord(record, record.timestamp || 'Invalid Date', lang);
+        }
+        return formatHistoryRecord(record, formatDateSafely(utcDate, locale), lang);
+    }).join('');
 }
 
 // 格式化历史记录显示
@@ -273,11 +289,11 @@ function formatHistoryRecord(record, timestamp, lang) {
         (isZh ? `BT号 <span class="BT-number">${record.BT}</span>` :
          `BT <span class="BT-number">${record.BT}</span>`) : '';
     
-    // 构建合并记录的显示（清空+添加）
+    // 构建合并记录的显示（清空+添加），cleared为服务器合并进来的清空记录
     let mergedZh, mergedEn;
-    if (record.__clearRecords && record.__clearRecords.length > 0) {
+    if (record.cleared && record.cleared.length > 0) {
         // 有详细清空记录的情况
-        const clearDetailsZh = record.__clearRecords.map(clearRec => {
+        const clearDetailsZh = record.cleared.map(clearRec => {
             const clearItemCode = clearRec.item_code.startsWith('清空库位') ? 
                 clearRec.item_code.replace('清空库位', '') : 
                 (clearRec.item_code === '清空库位' ? '所有商品' : clearRec.item_code);
@@ -302,7 +318,7 @@ function formatHistoryRecord(record, timestamp, lang) {
             }
         }).join('<br>&nbsp;&nbsp;&nbsp;');
         
-        const clearDetailsEn = record.__clearRecords.map(clearRec => {
+        const clearDetailsEn = record.cleared.map(clearRec => {
             const clearItemCode = clearRec.item_code.startsWith('清空库位') ? 
                 clearRec.item_code.replace('清空库位', '') : 
                 (clearRec.item_code === '清空库位' ? 'All Items' : clearRec.item_code);
@@ -356,7 +372,7 @@ function formatHistoryRecord(record, timestamp, lang) {
                     ${boxCountDisplay} × ${piecesPerBoxDisplay} = ${totalPiecesDisplay}`;
 
     let lineHtml;
-    if (record.__merged) {
+    if (record.cleared) {
         lineHtml = isZh ? mergedZh : mergedEn;
     } else if (record.item_code === '清空库位' || record.item_code === 'Clear Bin') {
         // 空库位的简单清空记录
@@ -394,50 +410,6 @@ function formatHistoryRecord(record, timestamp, lang) {
             </div>`;
 }
 
-// 更新历史记录显示
-function updateHistoryDisplay(logsFromCache) {
-    const render = (logs) => {
-        const lang = document.body.className.includes('lang-en') ? 'en' : 'zh';
-        
-        // 检查是否有新记录
-        if (lastUpdateTime) {
-            const lastLog = logs[0];
-            if (!lastLog || lastLog.timestamp === lastUpdateTime) {
-                return; // 没有新记录，不更新显示
-            }
-        }
-        
-        lastUpdateTime = logs[0] ? logs[0].timestamp : null;
-        
-        const mergedLogs = mergeClearAndAddLogs(logs);
-        const html = mergedLogs.map(record => {
-            // 使用安全的日期解析和格式化
-            const utcDate = parseDateSafely(record.timestamp);
-            if (!utcDate) {
-                // 如果日期解析失败，显示原始时间戳
-                return formatHistoryRecord(record, record.timestamp || 'Invalid Date', lang);
-            }
-            const timestamp = formatDateSafely(utcDate, 'zh-CN');
-            return formatHistoryRecord(record, timestamp, lang);
-        }).join('');
-        
-        const recentHistoryList = document.getElementById('recent-history-list');
-        if (recentHistoryList) {
-            recentHistoryList.innerHTML = html;
-        }
-    };
-
-    if (logsFromCache && logsFromCache.length) {
-        render(logsFromCache);
-        return;
-    }
-
-    $.get(`${API_URL}/api/logs`, function(logs) {
-        cachedLogs = logs;
-        render(logs);
-    });
-}
-
 // 初始化自动完成功能
 $(document).ready(function() {
     console.log("初始化自动完成功能");
@@ -562,17 +534,11 @@ $(document).ready(function() {
     });
 
     // 页面加载时初始化历史记录显示
-    updateHistoryDisplay();
-    
-    // 设置定时更新
-    setInterval(updateHistoryDisplay, UPDATE_INTERVAL);
-
-    // 初始化历史记录更新
     updateRecentHistory();
-    if (recentHistoryUpdateInterval) {
-        clearInterval(recentHistoryUpdateInterval);
-    }
-    recentHistoryUpdateInterval = setInterval(updateRecentHistory, 5000);
+    
+    // 优先使用服务器推送，不支持或断开时回退到定时轮询
+    startHistoryPolling();
+    connectChangeEvents();
 
     // 当切换到历史记录标签页时开始更新
     $('.tab-button[data-tab="history"]').on('click', function() {
@@ -580,28 +546,15 @@ $(document).ready(function() {
         const today = new Date().toISOString().split('T')[0];
         $("#historyDate").val(today);
         showTodayHistory();
-        if (fullHistoryUpdateInterval) {
-            clearInterval(fullHistoryUpdateInterval);
-        }
-        // 使用自定义的定时器函数，保持当前选择的日期
-        fullHistoryUpdateInterval = setInterval(function() {
-            if (userSelectedDate) {
-                // 如果用户选择了日期，继续使用该日期
-                filterHistoryByDate();
-            } else {
-                // 否则显示所有记录
-                updateFullHistory();
-            }
-        }, 5000);
+        historyTabActive = true;
+        startFullHistoryPolling();
     });
 
     // 当切换离开历史记录标签页时停止更新
     $('.tab-button:not([data-tab="history"])').each(function() {
         $(this).on('click', function() {
-            if (fullHistoryUpdateInterval) {
-                clearInterval(fullHistoryUpdateInterval);
-                fullHistoryUpdateInterval = null;
-            }
+            historyTabActive = false;
+            stopFullHistoryPolling();
         });
     });
 
@@ -621,6 +574,93 @@ $(document).ready(function() {
     }, 200);
 });
 
+// 刷新历史记录标签页，保持当前选择的日期和页码
+function refreshFullHistory() {
+    updateFullHistory();
+}
+
+// 启动首页历史记录的定时轮询（推送通道已连接时不需要）
+function startHistoryPolling() {
+    if (pushConnected) return;
+    if (!recentHistoryUpdateInterval) {
+        recentHistoryUpdateInterval = setInterval(updateRecentHistory, UPDATE_INTERVAL);
+    }
+    if (historyTabActive) {
+        startFullHistoryPolling();
+    }
+}
+
+// 停止所有历史记录定时轮询
+function stopHistoryPolling() {
+    if (recentHistoryUpdateInterval) {
+        clearInterval(recentHistoryUpdateInterval);
+        recentHistoryUpdateInterval = null;
+    }
+    stopFullHistoryPolling();
+}
+
+function startFullHistoryPolling() {
+    if (pushConnected || fullHistoryUpdateInterval) return;
+    fullHistoryUpdateInterval = setInterval(refreshFullHistory, UPDATE_INTERVAL);
+}
+
+function stopFullHistoryPolling() {
+    if (fullHistoryUpdateInterval) {
+        clearInterval(fullHistoryUpdateInterval);
+        fullHistoryUpdateInterval = null;
+    }
+}
+
+// 连接服务器推送通道，收到变更事件时只刷新受影响的面板
+function connectChangeEvents() {
+    if (!window.EventSource) return;
+    
+    changeEventSource = new EventSource(`${API_URL}/api/events`);
+    
+    changeEventSource.addEventListener('open', function() {
+        pushConnected = true;
+        stopHistoryPolling();
+        // 连接（或重连）期间可能错过了变更，补一次同步
+        updateRecentHistory();
+    });
+    
+    changeEventSource.addEventListener('change', function(e) {
+        handleChangeEvent(JSON.parse(e.data));
+    });
+    
+    changeEventSource.addEventListener('error', function() {
+        // EventSource会自动重连，断开期间先回退到定时轮询
+        pushConnected = false;
+        startHistoryPolling();
+    });
+}
+
+// 处理一条库存变更事件
+function handleChangeEvent(event) {
+    updateRecentHistory();
+    if (historyTabActive) {
+        refreshFullHistory();
+    }
+    
+    const resync = event.type === 'resync';
+    const affectedItems = event.item_codes || (event.item_code ? [event.item_code] : []);
+    const affectedBins = event.bin_codes || (event.bin_code ? [event.bin_code] : []);
+    
+    // 当前查看的库位受影响时刷新库位内容
+    const binCode = $("#binSearch").val().trim();
+    if (binCode && $('#binContentsResult').children().length > 0 &&
+        (resync || affectedBins.includes(binCode))) {
+        searchBinContents();
+    }
+    
+    // 当前查看的商品受影响时刷新商品数量和库位
+    const itemCode = $("#itemSearch").val().trim();
+    if (itemCode && $('#itemTotalResult').children().length > 0 &&
+        (resync || affectedItems.includes(itemCode))) {
+        searchItemTotal();
+    }
+}
+
 // 提交盘点表单
 $("#inventoryForm").submit(function(e) {
     e.preventDefault();
@@ -650,6 +690,14 @@ $("#inventoryForm").submit(function(e) {
 
 // 检查库位状态并显示相应的确认对话框
 function checkBinStatus(binCode, itemCode, customerPO, BTNumber, boxCount, piecesPerBox) {
+    // 队列中还有同一库位未提交的记录时先提交，保证看到的库位内容是最新的
+    if (pendingInventoryEntries.some(entry => entry.bin_code === binCode)) {
+        flushInventoryQueue().always(function() {
+            checkBinStatus(binCode, itemCode, customerPO, BTNumber, boxCount, piecesPerBox);
+        });
+        return;
+    }
+    
     const encodedBinCode = binCode.trim()
         .replace(/\//g, '___SLASH___')
         .replace(/\s/g, '___SPACE___');
@@ -915,52 +963,159 @@ function clearBinAndAdd(binCode, itemCode, customerPO, BTNumber, boxCount, piece
         .replace(/\//g, '___SLASH___')
         .replace(/\s/g, '___SPACE___');
     
-    $.ajax({
-        url: `${API_URL}/api/inventory/bin/${encodedBinCode}/clear`,
-        type: 'DELETE',
-        success: function(response) {
-            // 清空成功后添加新库存
-            addInventory(binCode, itemCode, customerPO, BTNumber, boxCount, piecesPerBox);
-        },
-        error: function(xhr, status, error) {
-            alert(document.body.className.includes('lang-en')
-                ? "Failed to clear bin, please try again"
-                : "清空库位失败，请重试");
-        }
+    // 先提交队列中的记录，避免清空后才写入之前录入的库存
+    flushInventoryQueue().always(function() {
+        $.ajax({
+            url: `${API_URL}/api/inventory/bin/${encodedBinCode}/clear`,
+            type: 'DELETE',
+            success: function(response) {
+                // 清空成功后添加新库存
+                addInventory(binCode, itemCode, customerPO, BTNumber, boxCount, piecesPerBox);
+            },
+            error: function(xhr, status, error) {
+                alert(document.body.className.includes('lang-en')
+                    ? "Failed to clear bin, please try again"
+                    : "清空库位失败，请重试");
+            }
+        });
     });
 }
 
-// 添加库存
+// 添加库存：放入队列，稍后与其他录入合并成一次批量请求
 function addInventory(binCode, itemCode, customerPO, BTNumber, boxCount, piecesPerBox) {
-        $.ajax({
-            url: `${API_URL}/api/inventory`,
-            type: 'POST',
-            contentType: 'application/json',
-            data: JSON.stringify({
-                bin_code: binCode,
-                item_code: itemCode,
-                customer_po: customerPO,
-                BT: BTNumber,
-                box_count: boxCount,
-                pieces_per_box: piecesPerBox
-            }),
-            success: function(response) {
-                // 成功后再更新显示并重置表单
-                setTimeout(updateHistoryDisplay, 100);
+    pendingInventoryEntries.push({
+        bin_code: binCode,
+        item_code: itemCode,
+        customer_po: customerPO,
+        BT: BTNumber,
+        box_count: boxCount,
+        pieces_per_box: piecesPerBox
+    });
+    
+    // 重置表单（包括BT输入框），可以立即扫下一条
+    $("#inventoryForm")[0].reset();
+    
+    if (pendingInventoryEntries.length >= INVENTORY_BATCH_SIZE) {
+        flushInventoryQueue();
+    } else {
+        scheduleInventoryFlush();
+    }
+}
+
+function scheduleInventoryFlush(delay) {
+    if (inventoryFlushTimer) {
+        clearTimeout(inventoryFlushTimer);
+    }
+    inventoryFlushTimer = setTimeout(flushInventoryQueue, delay || INVENTORY_FLUSH_DELAY);
+}
+
+function newBatchId() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+}
+
+// 取出下一批要提交的记录：优先重试失败的批次，否则从队列头部取出不超过单批上限的记录
+function takeInventoryBatch() {
+    if (inventoryRetryBatch) {
+        const batch = inventoryRetryBatch;
+        inventoryRetryBatch = null;
+        return batch;
+    }
+    if (pendingInventoryEntries.length === 0) {
+        return null;
+    }
+    return { batch_id: newBatchId(), entries: pendingInventoryEntries.splice(0, INVENTORY_BATCH_MAX_LINES) };
+}
+
+// 提交队列中的所有录入，返回可等待的Promise
+function flushInventoryQueue() {
+    if (inventoryFlushTimer) {
+        clearTimeout(inventoryFlushTimer);
+        inventoryFlushTimer = null;
+    }
+    // 上一批还在提交中，等它完成后再提交剩余的记录
+    if (inventoryFlushRequest) {
+        return inventoryFlushRequest.then(flushInventoryQueue, flushInventoryQueue);
+    }
+    const batch = takeInventoryBatch();
+    if (!batch) {
+        return $.Deferred().resolve().promise();
+    }
+    const entries = batch.entries;
+    
+    inventoryFlushRequest = $.ajax({
+        url: `${API_URL}/api/inventory/batch`,
+        type: 'POST',
+        contentType: 'application/json',
+        data: JSON.stringify({ batch_id: batch.batch_id, entries: entries }),
+        success: function(response) {
+            setTimeout(updateRecentHistory, 100);
             
-            // 重置表单（包括BT输入框）
-                $("#inventoryForm")[0].reset();
-            },
-            error: function(xhr, status, error) {
-                let errorMsg = "添加失败，请检查输入！";
-                if (xhr.responseJSON && xhr.responseJSON.error) {
-                    errorMsg = xhr.responseJSON.error;
+            const failed = response.results.filter(result => !result.success);
+            if (failed.length > 0) {
+                const isEn = document.body.className.includes('lang-en');
+                const lines = failed.map(result => {
+                    const entry = entries[result.index];
+                    return `${entry.bin_code} / ${entry.item_code}: ${isEn ? result.error_en : result.error}`;
+                });
+                alert((isEn ? "Some entries were not added:\n" : "以下记录添加失败：\n") + lines.join('\n'));
+            }
+        },
+        error: function(xhr, status, error) {
+            const isEn = document.body.className.includes('lang-en');
+            if (xhr.status === 0 || xhr.status === 503) {
+                // 网络中断或服务器暂时不可用：用同一个batch_id稍后重试，只在第一次失败时提示
+                inventoryRetryBatch = batch;
+                scheduleInventoryFlush(INVENTORY_RETRY_DELAY);
+                if (!batch.retrying) {
+                    batch.retrying = true;
+                    alert(isEn ? "Network error, the entries will be resubmitted automatically"
+                               : "网络异常，录入的记录将自动重新提交");
                 }
-                alert(errorMsg);
+                return;
             }
-        });
+            
+            // 其他错误重试也不会成功：放弃这一批并列出未提交的记录
+            let errorMsg = isEn ? "Failed to add, please check the input!" : "添加失败，请检查输入！";
+            if (xhr.responseJSON && xhr.responseJSON.error) {
+                errorMsg = isEn ? (xhr.responseJSON.error_en || xhr.responseJSON.error) : xhr.responseJSON.error;
+            }
+            const lines = entries.map(entry => `${entry.bin_code} / ${entry.item_code}`);
+            alert(errorMsg + '\n' + (isEn ? "Entries not added:\n" : "以下记录未添加：\n") + lines.join('\n'));
+            if (pendingInventoryEntries.length > 0) {
+                scheduleInventoryFlush();
+            }
+        },
+        complete: function() {
+            inventoryFlushRequest = null;
+        }
+    });
+    // 超过单批上限的剩余记录继续分批提交，调用方等待整个队列提交完成
+    return inventoryFlushRequest.then(function() {
+        if (pendingInventoryEntries.length > 0) {
+            return flushInventoryQueue();
+        }
+    });
 }
 
+// 离开页面前尽量把未提交的录入发送出去
+window.addEventListener('pagehide', function() {
+    if (!navigator.sendBeacon) {
+        return;
+    }
+    let batch;
+    while ((batch = takeInventoryBatch())) {
+        const payload = new Blob([JSON.stringify({ batch_id: batch.batch_id, entries: batch.entries })],
+                                 { type: 'application/json' });
+        if (!navigator.sendBeacon(`${API_URL}/api/inventory/batch`, payload)) {
+            inventoryRetryBatch = batch;
+            break;
+        }
+    }
+});
+
 // 查询商品总数量和所在库位
 function searchItemTotal() {
     const itemCode = $("#itemSearch").val();
@@ -978,8 +1133,8 @@ function searchItemTotal() {
     
     // 同时获取总数量和库位信息
     $.when(
-        $.get(`${API_URL}/api/inventory/item/${encodedItemCode}`),
-        $.get(`${API_URL}/api/inventory/locations/${encodedItemCode}`)
+        etagAjax({ url: `${API_URL}/api/inventory/item/${encodedItemCode}` }),
+        etagAjax({ url: `${API_URL}/api/inventory/locations/${encodedItemCode}` })
     ).done(function(totalData, locationsData) {
         const total = totalData[0];
         const locations = locationsData[0];
@@ -1122,9 +1277,8 @@ function searchBinContents() {
         .replace(/\s/g, '___SPACE___');
     const url = `${API_URL}/api/inventory/bin/${encodedBinCode}`;
     
-    $.ajax({
+    etagAjax({
         url: url,
-        type: 'GET',
         success: function(contents) {
             // 计算统计信息
             const totalItems = contents.length;
@@ -1262,96 +1416,116 @@ function exportBins() {
     window.location.href = `${API_URL}/api/export/bins`;
 }
 
+// 后台导出任务的轮询间隔（毫秒）
+const EXPORT_JOB_POLL_INTERVAL = 1000;
+
+// 以后台任务方式导出（耗时较长的导出不占用服务器请求线程），完成后自动下载
+function runExportJob(exportPath) {
+    const separator = exportPath.includes('?') ? '&' : '?';
+    
+    function handleJob(job) {
+        if (job.status === 'done') {
+            window.location.href = `${API_URL}${job.download_url}`;
+        } else if (job.status === 'failed') {
+            alert(document.body.className.includes('lang-en') ? job.error_en : job.error);
+        } else {
+            setTimeout(function() {
+                $.get(`${API_URL}/api/export/jobs/${job.job_id}`).done(handleJob).fail(handleError);
+            }, EXPORT_JOB_POLL_INTERVAL);
+        }
+    }
+    
+    function handleError(xhr) {
+        let errorMsg = "导出失败！ / Export failed!";
+        if (xhr.responseJSON && xhr.responseJSON.error) {
+            errorMsg = document.body.className.includes('lang-en') ? xhr.responseJSON.error_en : xhr.responseJSON.error;
+        }
+        alert(errorMsg);
+    }
+    
+    $.get(`${API_URL}${exportPath}${separator}async=1`).done(handleJob).fail(handleError);
+}
+
 // 导出商品明细
 function exportItemDetails() {
-    window.location.href = `${API_URL}/api/export/item-details`;
+    runExportJob('/api/export/item-details');
 }
 
 // 显示今天的历史记录
 function showTodayHistory() {
     // 使用用户本地时区的日期
-    const today = new Date();
-    const todayStr = today.getFullYear() + '-' + 
-                    String(today.getMonth() + 1).padStart(2, '0') + '-' + 
-                    String(today.getDate()).padStart(2, '0');
+    const todayStr = localDateString(new Date());
     $("#historyDate").val(todayStr);
     userSelectedDate = todayStr; // 设置用户选择的日期为今天
     filterHistoryByDate();
 }
 
-// 根据日期过滤历史记录
+// 根据日期过滤历史记录（由服务器按本地日期过滤），从第一页开始显示
 function filterHistoryByDate() {
-    const selectedDate = $("#historyDate").val();
-    if (!selectedDate) {
-        userSelectedDate = null;
-        updateFullHistory();
-        return;
-    }
-    
-    // 设置用户选择的日期
-    userSelectedDate = selectedDate;
-    
-    // 获取所有记录，然后在客户端进行过滤
-    $.ajax({
-        url: `${API_URL}/api/logs`,
-        type: 'GET',
-        success: function(logs) {
-            cachedLogs = logs;
-            // 在客户端过滤指定日期的记录
-            const filteredLogs = logs.filter(record => {
-                // 使用安全的日期解析
-                const recordDate = parseDateSafely(record.timestamp);
-                if (!recordDate) {
-                    // 如果日期解析失败，仍然显示该记录（不过滤掉）
-                    return true;
-                }
-                const recordDateStr = recordDate.getFullYear() + '-' + 
-                                     String(recordDate.getMonth() + 1).padStart(2, '0') + '-' + 
-                                     String(recordDate.getDate()).padStart(2, '0');
-                return recordDateStr === selectedDate;
-            });
-            renderFilteredHistory(filteredLogs, selectedDate);
-        },
-        error: function(xhr, status, error) {
-            console.error('Error fetching filtered history:', error);
+    userSelectedDate = $("#historyDate").val() || null;
+    fullHistoryCursors = [null];
+    loadFullHistoryPage(0);
+}
+
+// 加载历史记录标签页的第pageIndex页
+function loadFullHistoryPage(pageIndex) {
+    const params = {};
+    if (userSelectedDate) params.date = userSelectedDate;
+    if (fullHistoryCursors[pageIndex]) params.before_id = fullHistoryCursors[pageIndex];
+    
+    fetchHistoryPage(params)
+        .done(function(page) {
+            const pageChanged = pageIndex !== fullHistoryPageIndex;
+            fullHistoryPageIndex = pageIndex;
+            // 只保留到下一页的游标
+            fullHistoryCursors = fullHistoryCursors.slice(0, pageIndex + 1);
+            if (page.has_more) fullHistoryCursors.push(page.next_before_id);
+            // 304时etagAjax返回同一个对象，数据没有变化不需要重新渲染
+            if (page !== fullHistoryPage || pageChanged) {
+                renderFullHistory(page);
+            }
+        })
+        .fail(function(error) {
+            console.error('Error fetching history:', error);
             $("#full-history-list").html(`
                 <span class="lang-zh">获取历史记录失败！</span>
                 <span class="lang-en">Failed to fetch history!</span>
             `);
-        }
-    });
+        });
+}
+
+function showPreviousHistoryPage() {
+    if (fullHistoryPageIndex > 0) loadFullHistoryPage(fullHistoryPageIndex - 1);
 }
 
-// 渲染过滤后的历史记录
-function renderFilteredHistory(logs, date) {
+function showNextHistoryPage() {
+    if (fullHistoryCursors[fullHistoryPageIndex + 1]) loadFullHistoryPage(fullHistoryPageIndex + 1);
+}
+
+// 渲染历史记录标签页的当前页
+function renderFullHistory(page) {
+    fullHistoryPage = page;
     const isZh = document.body.className.includes('lang-zh');
     const lang = isZh ? 'zh' : 'en';
     
-    if (!logs || logs.length === 0) {
-        const noDataMsg = isZh ? 
-            `没有找到 ${date} 的历史记录` : 
-            `No history records found for ${date}`;
-        $("#full-history-list").html(`<div class="no-data">${noDataMsg}</div>`);
-        return;
-    }
-    
-    // 合并清空并添加的记录
-    const mergedLogs = mergeClearAndAddLogs(logs);
+    $('#history-prev-page').prop('disabled', fullHistoryPageIndex === 0);
+    $('#history-next-page').prop('disabled', !fullHistoryCursors[fullHistoryPageIndex + 1]);
+    $('#full-history-pager .page-number').text(fullHistoryPageIndex + 1);
     
-    let html = '';
-    mergedLogs.forEach(record => {
-        // 使用安全的日期解析和格式化
-        const utcDate = parseDateSafely(record.timestamp);
-        if (!utcDate) {
-            // 如果日期解析失败，显示原始时间戳
-            html += formatHistoryRecord(record, record.timestamp || 'Invalid Date', lang);
+    if (!page.records.length) {
+        let noDataMsg;
+        if (userSelectedDate) {
+            noDataMsg = isZh ? `没有找到 ${userSelectedDate} 的历史记录` : `No history records found for ${userSelectedDate}`;
         } else {
-            const timestamp = formatDateSafely(utcDate, isZh ? 'zh-CN' : 'en-US');
-            html += formatHistoryRecord(record, timestamp, lang);
+            noDataMsg = isZh ? '暂无历史记录' : 'No history records';
         }
-    });
+        $("#full-history-list").html(`<div class="no-data">${noDataMsg}</div>`);
+        return;
+    }
     
-    $("#full-history-list").html(html);
+    const fullHistoryList = document.getElementById('full-history-list');
+    fullHistoryList.innerHTML = renderHistoryRecords(page.records, lang, isZh ? 'zh-CN' : 'en-US');
+    fullHistoryList.scrollTop = 0;
 }
 
 // 导出指定日期的历史记录
@@ -1385,10 +1559,12 @@ function searchBT() {
         return;
     }
     
-    $.ajax({
+    etagAjax({
         url: `${API_URL}/api/inventory/BT/${encodeURIComponent(BTNumber)}`,
         type: 'GET',
+        data: { format: 'compact' },
         success: function(data) {
+            expandCompactInventory(data);
             if (!data.items || data.items.length === 0) {
                 $("#BTSearchResult").html(`
                     <div class="result-item">
@@ -1523,10 +1699,12 @@ function searchPO() {
         return;
     }
     
-    $.ajax({
+    etagAjax({
         url: `${API_URL}/api/inventory/PO/${encodeURIComponent(PONumber)}`,
         type: 'GET',
+        data: { format: 'compact' },
         success: function(data) {
+            expandCompactInventory(data);
             if (!data.items || data.items.length === 0) {
                 $("#POSearchResult").html(`
                     <div class="result-item">
@@ -1655,7 +1833,7 @@ function exportDatabase() {
 
 // 导出所有PO详细信息
 function exportAllPOs() {
-    window.location.href = `${API_URL}/api/export/all-pos`;
+    runExportJob('/api/export/all-pos');
 }
 
 // 导出BT搜索结果
@@ -1696,9 +1874,8 @@ function switchLanguage(lang) {
     updateSearchPlaceholders(lang);
     
     // 使用缓存立即重渲染，避免重复请求
-    updateHistoryDisplay(cachedLogs);
-    updateRecentHistory(cachedLogs);
-    updateFullHistory(cachedLogs);
+    updateRecentHistory(true);
+    updateFullHistory(true);
 }
 
 // 更新搜索框占位符
@@ -1765,99 +1942,54 @@ function switchQueryTab(tabId) {
     }
 }
 
-// 更新今日录入记录
-function updateRecentHistory(logsFromCache) {
-    const render = (logs) => {
-        const mergedLogs = mergeClearAndAddLogs(logs);
-        
-        // 获取今日日期（使用本地时区）
-        const today = new Date();
-        const todayStr = today.getFullYear() + '-' + 
-                        String(today.getMonth() + 1).padStart(2, '0') + '-' + 
-                        String(today.getDate()).padStart(2, '0');
-        
-        // 过滤出今日的记录（使用安全的日期解析）
-        const todayLogs = mergedLogs.filter(record => {
-            // 使用安全的日期解析
-            const recordDate = parseDateSafely(record.timestamp);
-            if (!recordDate) {
-                // 如果日期解析失败，仍然显示该记录（不过滤掉）
-                return true;
-            }
-            const recordDateStr = recordDate.getFullYear() + '-' + 
-                                 String(recordDate.getMonth() + 1).padStart(2, '0') + '-' + 
-                                 String(recordDate.getDate()).padStart(2, '0');
-            return recordDateStr === todayStr;
-        });
-        
-        const html = todayLogs.map(record => {
-            // 使用安全的日期解析和格式化
-            const utcDate = parseDateSafely(record.timestamp);
-            if (!utcDate) {
-                // 如果日期解析失败，显示原始时间戳
-                return formatHistoryRecord(record, record.timestamp || 'Invalid Date', document.body.className.includes('lang-en') ? 'en' : 'zh');
-            }
-            const timestamp = formatDateSafely(utcDate, 'zh-CN');
-            return formatHistoryRecord(record, timestamp, document.body.className.includes('lang-en') ? 'en' : 'zh');
-        }).join('');
-        
+// 更新今日录入记录（只显示最新的一页）
+function updateRecentHistory(fromCache) {
+    const render = (page) => {
+        recentHistoryPage = page;
+        const lang = document.body.className.includes('lang-en') ? 'en' : 'zh';
         const recentHistoryList = document.getElementById('recent-history-list');
-        if (recentHistoryList) {
-            if (todayLogs.length === 0) {
-                const lang = document.body.className.includes('lang-en') ? 'en' : 'zh';
-                const noDataText = lang === 'zh' ? '今日暂无录入记录' : 'No input records today';
-                recentHistoryList.innerHTML = `<div style="text-align: center; color: #666; padding: 20px;">${noDataText}</div>`;
-            } else {
-            recentHistoryList.innerHTML = html;
-        }
+        if (!recentHistoryList) return;
+        
+        if (page.records.length === 0) {
+            const noDataText = lang === 'zh' ? '今日暂无录入记录' : 'No input records today';
+            recentHistoryList.innerHTML = `<div style="text-align: center; color: #666; padding: 20px;">${noDataText}</div>`;
+        } else {
+            recentHistoryList.innerHTML = renderHistoryRecords(page.records, lang, 'zh-CN');
         }
     };
 
-    if (logsFromCache && logsFromCache.length) {
-        render(logsFromCache);
+    if (fromCache) {
+        if (recentHistoryPage) render(recentHistoryPage);
         return;
     }
 
-    $.get(`${API_URL}/api/logs`, function(logs) {
-        cachedLogs = logs;
-        render(logs);
-    });
+    fetchHistoryPage({ date: localDateString(new Date()) })
+        .done(page => {
+            // 304时etagAjax返回同一个对象，数据没有变化不需要重新渲染
+            if (page !== recentHistoryPage) render(page);
+        })
+        .fail(error => console.error('History fetch error:', error));
 }
 
-// 更新完整历史记录
-function updateFullHistory(logsFromCache) {
-    const render = (logs) => {
-        const mergedLogs = mergeClearAndAddLogs(logs);
-        const html = mergedLogs.map(record => {
-            // 使用安全的日期解析和格式化
-            const utcDate = parseDateSafely(record.timestamp);
-            if (!utcDate) {
-                // 如果日期解析失败，显示原始时间戳
-                return formatHistoryRecord(record, record.timestamp || 'Invalid Date', document.body.className.includes('lang-en') ? 'en' : 'zh');
-            }
-            const timestamp = formatDateSafely(utcDate, 'zh-CN');
-            return formatHistoryRecord(record, timestamp, document.body.className.includes('lang-en') ? 'en' : 'zh');
-        }).join('');
-        
-        const fullHistoryList = document.getElementById('full-history-list');
-        if (fullHistoryList) {
-            fullHistoryList.innerHTML = html;
-        }
-    };
-
-    if (logsFromCache && logsFromCache.length) {
-        render(logsFromCache);
+// 更新历史记录标签页（保持当前日期和页码）
+function updateFullHistory(fromCache) {
+    if (fromCache) {
+        if (fullHistoryPage) renderFullHistory(fullHistoryPage);
         return;
     }
-
-    $.get(`${API_URL}/api/logs`, function(logs) {
-        cachedLogs = logs;
-        render(logs);
-    });
+    loadFullHistoryPage(fullHistoryPageIndex);
 }
 
 // 清空库位中特定商品
 function clearItemAtBin(binCode, itemCode) {
+    // 先提交队列中同一库位的记录，避免清空后才写入之前录入的库存
+    if (pendingInventoryEntries.some(entry => entry.bin_code === binCode)) {
+        flushInventoryQueue().always(function() {
+            clearItemAtBin(binCode, itemCode);
+        });
+        return;
+    }
+    
     const encodedBinCode = binCode.trim()
         .replace(/\//g, '___SLASH___')
         .replace(/\s/g, '___SPACE___');
@@ -1914,7 +2046,7 @@ function clearItemAtBin(binCode, itemCode) {
             success: function(response) {
                 // 清空成功后刷新显示
                 setTimeout(searchBinContents, 100);
-                setTimeout(updateHistoryDisplay, 100);
+                setTimeout(updateRecentHistory, 100);
             },
             error: function(xhr, status, error) {
                 alert(document.body.className.includes('lang-en')
@@ -1935,6 +2067,14 @@ function clearItemAtBin(binCode, itemCode) {
 
 // 清除库位库存
 function clearBinInventory(binCode) {
+    // 先提交队列中同一库位的记录，避免清空后才写入之前录入的库存
+    if (pendingInventoryEntries.some(entry => entry.bin_code === binCode)) {
+        flushInventoryQueue().always(function() {
+            clearBinInventory(binCode);
+        });
+        return;
+    }
+    
     // 移除之前可能存在的事件处理器
     $("#confirm-yes").off('click');
     $("#confirm-no").off('click');
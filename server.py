@@ -1,23 +1,84 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, g
 import sqlite3
+import asyncio
+import codecs
 import csv
+import heapq
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import os
+import json
+import queue
+import tempfile
+import threading
+import time
 import traceback
-import pandas as pd
-from io import BytesIO
-from datetime import datetime
+import uuid
+import xlsxwriter
+import zlib
+from io import BufferedReader, StringIO, TextIOWrapper
+from itertools import chain, islice
+from bisect import bisect_left
+from collections import deque, defaultdict, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import wraps
 
 # 条件导入PostgreSQL驱动，仅在需要时导入
 try:
     import psycopg2
     import psycopg2.extras
+    import psycopg2.pool
     PSYCOPG2_AVAILABLE = True
 except ImportError:
     PSYCOPG2_AVAILABLE = False
 
+# 条件导入pyarrow，仅Parquet/Arrow格式导出需要
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# 条件导入orjson：序列化比标准库json快数倍，不可用时使用Flask默认的JSON实现
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# 条件导入brotli：客户端支持br时优先使用，否则使用gzip压缩响应
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+class OrjsonProvider(DefaultJSONProvider):
+    """用orjson序列化jsonify的响应；orjson不直接支持的类型（Decimal、日期）仍按Flask默认的方式转换"""
+    
+    @staticmethod
+    def _dumps(obj):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    
+    def dumps(self, obj, **kwargs):
+        return self._dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._dumps(obj), mimetype=self.mimetype)
+
 app = Flask(__name__)
-CORS(app)
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
+# 跨域时前端需要读取ETag和备份位置响应头
+CORS(app, expose_headers=['ETag', 'X-Backup-History-Id'])
 
 # 全局变量跟踪数据库是否已初始化
 _db_initialized = False
@@ -36,6 +97,385 @@ def ensure_db_initialized():
             print(traceback.format_exc())
             raise
 
+# 库存变更广播：写操作提交后发布事件，SSE / 长轮询连接据此推送给前端
+class ChangeBroadcaster:
+    def __init__(self, max_events=1000):
+        self._events = deque(maxlen=max_events)  # 只保留最近的事件用于断线重连补发
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # ASGI模式下在事件循环中等待的 (loop, future)
+
+    @property
+    def seq(self):
+        with self._cond:
+            return self._seq
+
+    def publish(self, event_type, **data):
+        """发布一个变更事件并唤醒所有等待中的连接"""
+        with self._cond:
+            self._seq += 1
+            event = {'seq': self._seq, 'type': event_type, **data}
+            self._events.append(event)
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+        return event
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def _events_since(self, seq):
+        # 客户端的序号不在缓冲区内（服务重启或断线太久），通知其整体刷新
+        if seq > self._seq or (self._events and seq < self._events[0]['seq'] - 1):
+            return [{'seq': self._seq, 'type': 'resync'}]
+        return [event for event in self._events if event['seq'] > seq]
+
+    def wait_for_events(self, seq, timeout):
+        """阻塞直到有序号大于seq的事件或超时，返回新事件列表"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != seq, timeout)
+            return self._events_since(seq)
+
+    async def wait_for_events_async(self, seq, timeout):
+        """wait_for_events的协程版本：在事件循环中等待，不占用线程"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if self._seq != seq:
+                return self._events_since(seq)
+            self._async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                if (loop, future) in self._async_waiters:
+                    self._async_waiters.remove((loop, future))
+        with self._cond:
+            return self._events_since(seq)
+
+change_broadcaster = ChangeBroadcaster()
+
+def data_version():
+    """
+    数据版本号 (epoch, version)，用于缓存失效和ETag。库存汇总、商品、库位表的每次写入都由触发器
+    在同一事务中递增version，其他worker和db_op.py的写入同样生效；epoch在建库时随机生成，
+    删除数据库重建后旧的ETag不会误命中
+    """
+    cursor = get_cursor(get_db())
+    cursor.execute('SELECT epoch, version FROM data_version WHERE id = 1')
+    row = cursor.fetchone()
+    return (row['epoch'], row['version'])
+
+# 读接口的响应缓存最多保存的条目数
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '512'))
+
+# 读接口响应缓存：按 (接口, 参数, 数据版本) 缓存JSON响应，LRU淘汰。
+# 数据版本变化后旧条目不会再命中，整体清空释放内存
+class ResponseCache:
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get((key, version))
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end((key, version))
+            self._hits += 1
+            return entry
+
+    def set(self, key, version, entry):
+        with self._lock:
+            if version != self._version:
+                if self._version is not None and version[0] == self._version[0] and version[1] < self._version[1]:
+                    return  # 计算期间已有新的写入，旧结果不再需要
+                self._entries.clear()
+                self._version = version
+            self._entries[(key, version)] = entry
+            self._entries.move_to_end((key, version))
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'version': self._version,
+                'entries': len(self._entries),
+                'max_size': self._max_size,
+                'hits': self._hits,
+                'misses': self._misses
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def cached_response(view):
+    """缓存读接口的JSON响应（200/404），数据版本变化后自动失效"""
+    @wraps(view)
+    def wrapper(**view_args):
+        # 先取版本号再查询：查询期间发生写入时结果只会被存到旧版本下
+        version = data_version()
+        key = (request.endpoint, tuple(sorted(view_args.items())),
+               tuple(sorted(request.args.items(multi=True))))
+        entry = response_cache.get(key, version)
+        if entry is not None:
+            body, status, mimetype = entry
+            return Response(body, status=status, mimetype=mimetype)
+        
+        response = app.make_response(view(**view_args))
+        if response.status_code in (200, 404) and response.is_json and not response.is_streamed:
+            response_cache.set(key, version, (response.get_data(), response.status_code, response.mimetype))
+        return response
+    return wrapper
+
+# 进程启动标识：搜索索引的版本号只在进程内递增，重启后需要让旧的ETag失效
+PROCESS_TAG = uuid.uuid4().hex[:8]
+
+def conditional_get(etag_func):
+    """
+    为GET接口添加ETag：etag_func返回代表当前数据状态的廉价标识，
+    客户端的If-None-Match与之相同时直接返回304，不再查询和序列化
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**view_args):
+            etag = etag_func()
+            # 弱ETag：同一份数据gzip/br压缩后的响应也使用同一个ETag
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = app.make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            return response
+        return wrapper
+    return decorator
+
+def data_version_etag():
+    epoch, version = data_version()
+    return f'{epoch}-{version}'
+
+# SSE心跳间隔与长轮询最长等待时间（秒）
+SSE_HEARTBEAT_SECONDS = 15
+LONG_POLL_MAX_SECONDS = 30
+
+# 内存中的编码搜索索引：排序数组+二分查找处理前缀，三元组倒排索引处理子串
+# 与原先 LIKE 查询一致：不区分大小写，前缀匹配排在前面，其余按编码排序
+class CodeSearchIndex:
+    def __init__(self, table, id_column, code_column):
+        self.table = table
+        self.id_column = id_column
+        self.code_column = code_column
+        self._lock = threading.RLock()
+        self._codes = {}  # id -> code
+        self._lowered = {}  # id -> 小写编码
+        self._keys = []  # 排序后的 (小写编码, 编码, id)
+        self._trigrams = defaultdict(set)  # 三元组 -> id集合
+        self._max_id = 0
+        self._synced_at = None
+        self._version = 0  # 索引内容每次变化时递增，用于ETag
+
+    @staticmethod
+    def _sort_key(code, code_id):
+        return (code.lower(), code, code_id)
+
+    @staticmethod
+    def _trigrams_of(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @property
+    def loaded(self):
+        return self._synced_at is not None
+
+    @property
+    def version(self):
+        return self._version
+
+    def _add_locked(self, code_id, code):
+        if code_id in self._codes:
+            return False
+        self._codes[code_id] = code
+        self._lowered[code_id] = code.lower()
+        self._max_id = max(self._max_id, code_id)
+        self._version += 1
+        for trigram in self._trigrams_of(code.lower()):
+            self._trigrams[trigram].add(code_id)
+        return True
+
+    def load(self, cursor):
+        """从数据库全量构建索引"""
+        cursor.execute(f'SELECT {self.id_column}, {self.code_column} FROM {self.table}')
+        self._replace([(row[self.id_column], row[self.code_column]) for row in cursor.fetchall()])
+
+    def _replace(self, rows):
+        with self._lock:
+            self._codes = {}
+            self._lowered = {}
+            self._trigrams = defaultdict(set)
+            self._max_id = 0
+            for code_id, code in rows:
+                self._add_locked(code_id, code)
+            self._keys = sorted(self._sort_key(code, code_id) for code_id, code in self._codes.items())
+            self._version += 1
+            self._synced_at = time.monotonic()
+
+    def sync(self, cursor):
+        """增量同步其他进程新插入的记录（只查询比已知最大ID更大的行）"""
+        placeholder = get_placeholder()
+        cursor.execute(f'''
+            SELECT {self.id_column}, {self.code_column} FROM {self.table}
+            WHERE {self.id_column} > {placeholder}
+        ''', (self._max_id,))
+        for row in cursor.fetchall():
+            self.add(row[self.code_column], row[self.id_column])
+        self._synced_at = time.monotonic()
+
+    def needs_sync(self, max_age):
+        return self._synced_at is None or time.monotonic() - self._synced_at > max_age
+
+    def sync_now(self, cursor, max_age=None):
+        """
+        加锁后同步索引：尚未加载时全量构建，否则增量同步。
+        指定max_age时，等待锁期间已被其他线程同步过的索引不再重复同步
+        """
+        with self._lock:
+            if max_age is not None and not self.needs_sync(max_age):
+                return
+            if self.loaded:
+                self.sync(cursor)
+            else:
+                self.load(cursor)
+
+    def reload(self, cursor):
+        """加锁后全量重建索引（有记录被删除时增量同步无法处理）"""
+        with self._lock:
+            self.load(cursor)
+
+    def add(self, code, code_id):
+        """插入新编码后增量更新索引"""
+        with self._lock:
+            if self._add_locked(code_id, code):
+                key = self._sort_key(code, code_id)
+                self._keys.insert(bisect_left(self._keys, key), key)
+
+    def remove(self, code_id):
+        with self._lock:
+            code = self._codes.pop(code_id, None)
+            if code is None:
+                return
+            del self._lowered[code_id]
+            self._version += 1
+            key = self._sort_key(code, code_id)
+            index = bisect_left(self._keys, key)
+            if index < len(self._keys) and self._keys[index] == key:
+                del self._keys[index]
+            for trigram in self._trigrams_of(code.lower()):
+                self._trigrams[trigram].discard(code_id)
+
+    def search(self, term, limit=10):
+        """返回 [(id, code)]，前缀匹配优先，其次是包含搜索词的编码"""
+        term = term.lower()
+        with self._lock:
+            keys = self._keys
+            results = []
+            prefix_ids = set()
+            index = bisect_left(keys, (term,))
+            while index < len(keys) and len(results) < limit and keys[index][0].startswith(term):
+                results.append((keys[index][2], keys[index][1]))
+                prefix_ids.add(keys[index][2])
+                index += 1
+            if len(results) >= limit:
+                return results
+            
+            if len(term) >= 3:
+                # 取各三元组倒排列表的交集作为候选，再校验子串
+                postings = sorted((self._trigrams.get(t, set()) for t in self._trigrams_of(term)), key=len)
+                candidates = set.intersection(*postings) if postings else set()
+                lowered = self._lowered
+                matches = heapq.nsmallest(limit - len(results), (
+                    (lowered[i], self._codes[i], i) for i in candidates
+                    if i not in prefix_ids and term in lowered[i]))
+            else:
+                # 过短的搜索词无法使用三元组，直接按顺序扫描
+                matches = []
+                for key in keys:
+                    if term in key[0] and key[2] not in prefix_ids:
+                        matches.append(key)
+                        if len(results) + len(matches) >= limit:
+                            break
+            
+            results.extend((key[2], key[1]) for key in matches)
+            return results
+
+bin_search_index = CodeSearchIndex('bins', 'bin_id', 'bin_code')
+item_search_index = CodeSearchIndex('items', 'item_id', 'item_code')
+
+# BT/客户订单号自动补全索引：汇总表中出现过的不重复值，复用编码索引的前缀/子串查找。
+# 值本身没有ID，按加载顺序分配；入库时增量加入新值，清空库存后可能有值消失，标记过期后重新加载
+class DistinctValueIndex(CodeSearchIndex):
+    def __init__(self, column):
+        super().__init__('inventory_summary', None, column)
+        self._value_ids = {}
+
+    def load(self, cursor):
+        # DISTINCT走汇总表上以该列开头的覆盖索引，不需要扫描整张表
+        cursor.execute(f'''
+            SELECT DISTINCT {self.code_column} AS value FROM {self.table}
+            WHERE {self.code_column} IS NOT NULL AND {self.code_column} != ''
+        ''')
+        values = [row['value'] for row in cursor.fetchall()]
+        with self._lock:
+            self._value_ids = {value: value_id for value_id, value in enumerate(values, start=1)}
+            self._replace([(value_id, value) for value, value_id in self._value_ids.items()])
+
+    def sync(self, cursor):
+        # 没有自增ID可用于增量同步，定期全量重新加载（同时处理其他进程的写入）
+        self.load(cursor)
+
+    def add_value(self, value):
+        """入库提交后加入新出现的值"""
+        if not value:
+            return
+        with self._lock:
+            if value in self._value_ids or not self.loaded:
+                return
+            value_id = self._value_ids[value] = len(self._value_ids) + 1
+            self.add(value, value_id)
+
+    def invalidate(self):
+        """清空库存后调用：下次查询时重新加载"""
+        self._synced_at = None
+
+bt_value_index = DistinctValueIndex('BT')
+po_value_index = DistinctValueIndex('customer_po')
+
+def normalize_lookup_value(value):
+    """客户订单号/BT的统一写入形式：空值（空字符串、只有空格）一律存为NULL，与未填写相同"""
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    return value
+
+def record_lookup_values(customer_po, BT):
+    po_value_index.add_value(customer_po)
+    bt_value_index.add_value(BT)
+
+# 索引定期从数据库增量同步的间隔（秒），用于获取其他worker新增的编码
+SEARCH_INDEX_SYNC_SECONDS = 30
+
 # 获取环境变量
 is_production = os.getenv('RAILWAY_ENVIRONMENT') == 'production'
 port = int(os.getenv('PORT', '5001'))  # 本地开发使用5001，生产环境使用环境变量
@@ -59,6 +499,35 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
+# 响应压缩：按Accept-Encoding协商br（需要brotli）或gzip，只压缩超过该大小（字节）的JSON响应
+RESPONSE_COMPRESS_MIN_SIZE = int(os.getenv('RESPONSE_COMPRESS_MIN_SIZE', '1024'))
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if BROTLI_AVAILABLE and request.accept_encodings.quality('br') > 0:
+        encoding = 'br'
+    elif request.accept_encodings.quality('gzip') > 0:
+        encoding = 'gzip'
+    else:
+        return response
+    body = response.get_data()
+    if len(body) < RESPONSE_COMPRESS_MIN_SIZE:
+        return response
+    if encoding == 'br':
+        body = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    else:
+        compressor = zlib.compressobj(RESPONSE_GZIP_LEVEL, zlib.DEFLATED, 31)
+        body = compressor.compress(body) + compressor.flush()
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 # 添加路由来提供前端文件
 @app.route('/')
 def index():
@@ -116,8 +585,6 @@ def debug_init_db():
         else:
             bin_count = 0
         
-        db.close()
-        
         result = {
             'database_type': 'PostgreSQL' if is_postgresql() else 'SQLite',
             'tables_created': tables,
@@ -137,21 +604,336 @@ def debug_init_db():
             'traceback': traceback.format_exc()
         }), 500
 
-# 数据库连接
-def get_db():
-    database_url = os.environ.get('DATABASE_URL')
-    if database_url and PSYCOPG2_AVAILABLE:
-        # 生产环境使用PostgreSQL
-        conn = psycopg2.connect(database_url)
-        return conn
+# 根据inventory明细重建库存汇总表
+@app.route('/debug/rebuild-summary', methods=['POST'])
+def debug_rebuild_summary():
+    def write(cursor):
+        if is_postgresql():
+            # 重建期间阻塞其他写入，避免并发录入的增量在重算前后被重复或遗漏
+            cursor.execute('LOCK TABLE inventory, inventory_summary IN SHARE ROW EXCLUSIVE MODE')
+        return rebuild_inventory_summary(cursor)
+    
+    try:
+        # 与其他写入一样经run_write执行：SQLite下由单写线程串行提交
+        row_count = run_write(write)
+        bt_value_index.invalidate()
+        po_value_index.invalidate()
+        # 汇总表整体重算，客户端刷新所有正在查看的内容
+        change_broadcaster.publish('resync', reason='summary_rebuilt')
+        print(f"库存汇总表已重建，共 {row_count} 行")
+        return jsonify({'success': True, 'summary_rows': row_count})
+    except Exception as e:
+        print(f"重建库存汇总表失败: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+# 数据库连接池配置
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))  # 等待空闲连接的最长时间（秒）
+
+# SQLite引擎配置：tuned 为WAL日志 + synchronous=NORMAL + 内存映射读，写事务经单写线程合并提交；
+# legacy 为原先的默认回滚日志配置（仅用于对比测试）
+SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'tuned')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+# 单写线程一次提交最多合并的写事务数
+SQLITE_GROUP_COMMIT_MAX = int(os.getenv('SQLITE_GROUP_COMMIT_MAX', '64'))
+
+def get_db_path():
+    # 可通过环境变量指定SQLite数据库文件（例如性能测试使用临时库）
+    return os.environ.get('INVENTORY_DB_PATH') or os.path.join(os.path.dirname(__file__), 'inventory.db')
+
+def get_history_archive_path():
+    # 历史归档库默认与主数据库放在同一目录
+    return os.environ.get('HISTORY_ARCHIVE_PATH') or os.path.join(
+        os.path.dirname(os.path.abspath(get_db_path())), 'inventory_archive.db')
+
+def connect_sqlite(isolation_level=''):
+    db = sqlite3.connect(get_db_path(), timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=isolation_level)
+    db.row_factory = sqlite3.Row
+    if SQLITE_PROFILE == 'tuned':
+        # WAL下读不阻塞写、写不阻塞读；NORMAL同步在WAL下只在检查点时fsync，断电最多丢失最后几个事务
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
     else:
-        # 本地开发使用SQLite或PostgreSQL不可用时的回退
-        if database_url and not PSYCOPG2_AVAILABLE:
-            print("警告: DATABASE_URL已设置但psycopg2未安装，回退到SQLite")
-        db_path = os.path.join(os.path.dirname(__file__), 'inventory.db')
-        db = sqlite3.connect(db_path)
-        db.row_factory = sqlite3.Row
-        return db
+        db.execute('PRAGMA journal_mode=DELETE')
+    # 已归档的历史记录在附加的归档库中（每月一张表），见 archive_history
+    db.execute('ATTACH DATABASE ? AS archive', (get_history_archive_path(),))
+    return db
+
+class PoolTimeout(RuntimeError):
+    """连接池在DB_POOL_TIMEOUT内没有空闲连接"""
+
+# 按进程管理数据库连接：PostgreSQL使用线程安全连接池，SQLite每个线程复用一个连接
+class ConnectionManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pool = None
+        self._slots = None  # 限制同时借出的连接数，连接耗尽时阻塞等待而不是直接报错
+        self._local = threading.local()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._in_use = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _ensure_process(self):
+        # gunicorn fork出的worker不能复用父进程的连接
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pool = None
+            self._slots = None
+            self._local = threading.local()
+            self._reset_stats()
+            if is_postgresql():
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, os.environ.get('DATABASE_URL'))
+                self._slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            self._pid = pid
+
+    def acquire(self):
+        self._ensure_process()
+        start = time.perf_counter()
+        if self._pool is not None:
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                with self._lock:
+                    self._timeouts += 1
+                raise PoolTimeout(f'等待数据库连接超时 ({DB_POOL_TIMEOUT}s)')
+            try:
+                conn = self._pool.getconn()
+            except Exception:
+                self._slots.release()
+                raise
+        else:
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                database_url = os.environ.get('DATABASE_URL')
+                if database_url and not PSYCOPG2_AVAILABLE:
+                    print("警告: DATABASE_URL已设置但psycopg2未安装，回退到SQLite")
+                conn = self._local.conn = connect_sqlite()
+        wait = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        if self._pool is not None:
+            try:
+                # 归还前回滚未提交的事务，避免把脏状态留给下一个请求
+                if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            finally:
+                self._pool.putconn(conn)
+                self._slots.release()
+        else:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.ProgrammingError:
+                # 连接已被关闭，下次重新创建
+                self._local.conn = None
+
+    def stats(self):
+        self._ensure_process()
+        with self._lock:
+            stats = {
+                'backend': 'postgresql' if self._pool is not None else 'sqlite',
+                'pid': self._pid,
+                'in_use': self._in_use,
+                'acquired_total': self._acquired,
+                'wait_timeouts': self._timeouts,
+                'wait_seconds_total': round(self._total_wait, 6),
+                'wait_seconds_avg': round(self._total_wait / self._acquired, 6) if self._acquired else 0,
+                'wait_seconds_max': round(self._max_wait, 6)
+            }
+            if self._pool is not None:
+                # 按自己记录的借出数计算，不读取连接池的内部结构
+                stats['pool_min'] = DB_POOL_MIN
+                stats['pool_max'] = DB_POOL_MAX
+                stats['pool_available'] = DB_POOL_MAX - self._in_use
+        return stats
+
+connection_manager = ConnectionManager()
+
+# 锁等待、语句超时、连接池耗尽都是暂时性错误：返回503让客户端稍后重试，而不是当作失败
+TRANSIENT_DB_ERRORS = (sqlite3.OperationalError, PoolTimeout) + (
+    (psycopg2.OperationalError,) if PSYCOPG2_AVAILABLE else ())
+
+class WriteRejected(Exception):
+    """写事务中的校验失败：只回滚这一个事务，并把错误返回给客户端"""
+    def __init__(self, error, error_en, status=400):
+        super().__init__(error_en)
+        self.error = error
+        self.error_en = error_en
+        self.status = status
+
+    def response(self):
+        return jsonify({'error': self.error, 'error_en': self.error_en}), self.status
+
+# SQLite单写线程：各请求线程把写事务放入队列，写线程把排队中的事务合并到一次提交里
+# （每个事务一个SAVEPOINT，失败只回滚自己），避免多个线程争抢写锁出现 database is locked
+class SQLiteWriter:
+    def __init__(self, max_batch):
+        self._max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._jobs = 0
+        self._failed = 0
+        self._largest_batch = 0
+        self._commit_seconds = 0.0
+
+    def _ensure_process(self):
+        # gunicorn fork出的worker需要各自的写线程和连接
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._queue = queue.Queue()
+            self._reset_stats()
+            threading.Thread(target=self._run, args=(self._queue,), name='sqlite-writer', daemon=True).start()
+            self._pid = pid
+
+    def submit(self, work):
+        """执行写事务work(cursor)，阻塞到提交完成后返回work的返回值（或抛出其异常）"""
+        self._ensure_process()
+        future = Future()
+        self._queue.put((work, future))
+        return future.result()
+
+    def _run(self, jobs):
+        conn = None
+        while True:
+            batch = [jobs.get()]
+            while len(batch) < self._max_batch:
+                try:
+                    batch.append(jobs.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if conn is None:
+                    # 自动提交模式，事务由写线程显式控制
+                    conn = connect_sqlite(isolation_level=None)
+                self._commit_batch(conn, batch)
+            except Exception as e:
+                print(f"写线程提交失败: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                if conn is not None:
+                    try:
+                        if conn.in_transaction:
+                            conn.execute('ROLLBACK')
+                    except sqlite3.Error:
+                        conn.close()
+                        conn = None
+
+    def _commit_batch(self, conn, batch):
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        outcomes = []
+        cursor.execute('BEGIN IMMEDIATE')
+        for work, future in batch:
+            cursor.execute('SAVEPOINT write_job')
+            try:
+                outcomes.append((future, work(cursor), None))
+                cursor.execute('RELEASE write_job')
+            except Exception as e:
+                cursor.execute('ROLLBACK TO write_job')
+                cursor.execute('RELEASE write_job')
+                outcomes.append((future, None, e))
+        cursor.execute('COMMIT')
+        
+        # 提交成功后才通知各请求线程
+        failed = 0
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                failed += 1
+                future.set_exception(error)
+        with self._lock:
+            self._batches += 1
+            self._jobs += len(batch)
+            self._failed += failed
+            self._largest_batch = max(self._largest_batch, len(batch))
+            self._commit_seconds += time.perf_counter() - start
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize() if self._queue is not None else 0,
+                'batches': self._batches,
+                'jobs': self._jobs,
+                'failed_jobs': self._failed,
+                'jobs_per_batch_avg': round(self._jobs / self._batches, 2) if self._batches else 0,
+                'largest_batch': self._largest_batch,
+                'commit_seconds_avg': round(self._commit_seconds / self._batches, 6) if self._batches else 0
+            }
+
+sqlite_writer = SQLiteWriter(SQLITE_GROUP_COMMIT_MAX)
+
+def run_write(work):
+    """
+    执行一个写事务：work(cursor)只执行SQL、不提交，返回值原样返回。
+    SQLite（tuned配置）交给单写线程合并提交，其他情况在当前请求的连接上执行并提交。
+    work抛出异常时只回滚这个事务，异常抛给调用方
+    """
+    if not is_postgresql() and SQLITE_PROFILE == 'tuned':
+        return sqlite_writer.submit(work)
+    db = get_db()
+    try:
+        result = work(get_cursor(db))
+        db.commit()
+        return result
+    except Exception:
+        db.rollback()
+        raise
+
+# 数据库连接：在同一个应用上下文内复用，上下文结束时自动归还
+def get_db():
+    if 'db' not in g:
+        g.db = connection_manager.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        connection_manager.release(db)
+
+@app.route('/api/metrics/db', methods=['GET'])
+def db_metrics():
+    stats = connection_manager.stats()
+    if stats['backend'] == 'sqlite':
+        stats['profile'] = SQLITE_PROFILE
+        stats['writer'] = sqlite_writer.stats()
+    return jsonify(stats)
+
+@app.route('/api/metrics/cache', methods=['GET'])
+def cache_metrics():
+    return jsonify(response_cache.stats())
 
 # 获取数据库游标
 def get_cursor(db):
@@ -162,7 +944,7 @@ def get_cursor(db):
 
 # 确保数据库目录存在
 def ensure_db_directory():
-    db_dir = os.path.dirname(os.path.join(os.path.dirname(__file__), 'inventory.db'))
+    db_dir = os.path.dirname(get_db_path())
     if not os.path.exists(db_dir):
         os.makedirs(db_dir)
 
@@ -180,6 +962,457 @@ def convert_sql(sql):
         return sql.replace('?', '%s')
     return sql
 
+# SQL中NULL安全的相等比较（customer_po / BT 可以为NULL）
+def null_safe_equals():
+    return 'IS NOT DISTINCT FROM' if is_postgresql() else 'IS'
+
+def table_exists(cursor, table_name):
+    placeholder = get_placeholder()
+    if is_postgresql():
+        cursor.execute(f'''
+            SELECT table_name FROM information_schema.tables 
+            WHERE table_schema = 'public' AND table_name = {placeholder}
+        ''', (table_name,))
+    else:
+        cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name = {placeholder}", (table_name,))
+    return cursor.fetchone() is not None
+
+# 库存汇总表：按 (库位, 商品, PO, BT, 箱规) 维护当前库存，由写操作在同一事务中更新，读接口直接查询
+def ensure_inventory_summary(cursor):
+    if table_exists(cursor, 'inventory_summary'):
+        return
+    print("创建库存汇总表inventory_summary...")
+    id_column = 'summary_id SERIAL PRIMARY KEY' if is_postgresql() else 'summary_id INTEGER PRIMARY KEY AUTOINCREMENT'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS inventory_summary (
+            {id_column},
+            bin_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            customer_po TEXT,
+            BT TEXT,
+            pieces_per_box INTEGER NOT NULL,
+            box_count INTEGER NOT NULL,
+            total_pieces INTEGER NOT NULL,
+            FOREIGN KEY (bin_id) REFERENCES bins (bin_id),
+            FOREIGN KEY (item_id) REFERENCES items (item_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventory_summary_key
+        ON inventory_summary (bin_id, item_id, pieces_per_box)
+    ''')
+    rebuild_inventory_summary(cursor)
+
+def rebuild_inventory_summary(cursor):
+    """根据inventory明细重新计算汇总表，返回汇总行数"""
+    cursor.execute('DELETE FROM inventory_summary')
+    cursor.execute('''
+        INSERT INTO inventory_summary (bin_id, item_id, customer_po, BT, pieces_per_box, box_count, total_pieces)
+        SELECT bin_id, item_id, customer_po, BT, pieces_per_box, SUM(box_count), SUM(total_pieces)
+        FROM inventory
+        GROUP BY bin_id, item_id, customer_po, BT, pieces_per_box
+    ''')
+    cursor.execute('SELECT COUNT(*) AS row_count FROM inventory_summary')
+    return cursor.fetchone()['row_count']
+
+def apply_inventory_delta(cursor, bin_id, item_id, customer_po, BT, pieces_per_box, box_count, total_pieces):
+    """把一次入库累加到汇总表（调用方负责提交事务）"""
+    placeholder = get_placeholder()
+    equals = null_safe_equals()
+    if is_postgresql():
+        # 同一库位的汇总更新串行执行，避免并发事务重复插入同一汇总行
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (bin_id,))
+    cursor.execute(f'''
+        UPDATE inventory_summary
+        SET box_count = box_count + {placeholder},
+            total_pieces = total_pieces + {placeholder}
+        WHERE bin_id = {placeholder} AND item_id = {placeholder} AND pieces_per_box = {placeholder}
+          AND customer_po {equals} {placeholder} AND BT {equals} {placeholder}
+    ''', (box_count, total_pieces, bin_id, item_id, pieces_per_box, customer_po, BT))
+    if cursor.rowcount == 0:
+        cursor.execute(f'''
+            INSERT INTO inventory_summary (bin_id, item_id, customer_po, BT, pieces_per_box, box_count, total_pieces)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+        ''', (bin_id, item_id, customer_po, BT, pieces_per_box, box_count, total_pieces))
+
+# 数据库结构迁移：按版本号顺序执行，已执行的版本记录在schema_migrations表中
+def migration_secondary_indexes(cursor):
+    # 汇总表的覆盖索引：按库位/商品/BT/PO查询时无需回表
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventory_summary_bin
+        ON inventory_summary (bin_id, item_id, customer_po, BT, pieces_per_box, box_count, total_pieces)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventory_summary_item
+        ON inventory_summary (item_id, bin_id, customer_po, BT, pieces_per_box, box_count, total_pieces)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventory_summary_bt
+        ON inventory_summary (BT, item_id, bin_id, customer_po, pieces_per_box, box_count, total_pieces)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventory_summary_po
+        ON inventory_summary (customer_po, item_id, bin_id, BT, pieces_per_box, box_count, total_pieces)
+    ''')
+    # 库存明细：清空库位/商品与合并入库按库位+商品+箱规查找
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_inventory_bin_item
+        ON inventory (bin_id, item_id, pieces_per_box)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_item ON inventory (item_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_input_history_time ON input_history (input_time)')
+
+def migration_history_input_date(cursor):
+    # 存储本地日期，按日期过滤历史记录时不再需要对每行计算 DATE(datetime(input_time, 'localtime'))
+    if is_postgresql():
+        cursor.execute('ALTER TABLE input_history ADD COLUMN IF NOT EXISTS input_date DATE')
+        cursor.execute('UPDATE input_history SET input_date = CAST(input_time AS DATE) WHERE input_date IS NULL')
+        cursor.execute('ALTER TABLE input_history ALTER COLUMN input_date SET DEFAULT CURRENT_DATE')
+    else:
+        cursor.execute("PRAGMA table_info(input_history)")
+        if 'input_date' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE input_history ADD COLUMN input_date TEXT')
+        cursor.execute('''
+            UPDATE input_history SET input_date = DATE(datetime(input_time, 'localtime'))
+            WHERE input_date IS NULL
+        ''')
+        # SQLite不能添加非常量默认值的列，用触发器为新记录填充本地日期
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_input_history_input_date
+            AFTER INSERT ON input_history
+            WHEN NEW.input_date IS NULL
+            BEGIN
+                UPDATE input_history SET input_date = DATE(datetime(NEW.input_time, 'localtime'))
+                WHERE history_id = NEW.history_id;
+            END
+        ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_input_history_date
+        ON input_history (input_date, input_time)
+    ''')
+
+def migration_count_sessions(cursor):
+    # 盘点：扫描先写入暂存表，核对差异后一次性调整库存
+    if is_postgresql():
+        session_id_column = 'session_id SERIAL PRIMARY KEY'
+        scan_id_column = 'scan_id SERIAL PRIMARY KEY'
+    else:
+        session_id_column = 'session_id INTEGER PRIMARY KEY AUTOINCREMENT'
+        scan_id_column = 'scan_id INTEGER PRIMARY KEY AUTOINCREMENT'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS count_sessions (
+            {session_id_column},
+            status TEXT NOT NULL DEFAULT 'open',
+            note TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            closed_at TIMESTAMP
+        )
+    ''')
+    # 已盘点的库位（包括盘点为空的库位），差异只在这些库位中计算
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS count_session_bins (
+            session_id INTEGER NOT NULL,
+            bin_id INTEGER NOT NULL,
+            PRIMARY KEY (session_id, bin_id),
+            FOREIGN KEY (session_id) REFERENCES count_sessions (session_id),
+            FOREIGN KEY (bin_id) REFERENCES bins (bin_id)
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS count_scans (
+            {scan_id_column},
+            session_id INTEGER NOT NULL,
+            bin_id INTEGER NOT NULL,
+            item_code TEXT NOT NULL,
+            customer_po TEXT,
+            BT TEXT,
+            box_count INTEGER NOT NULL,
+            pieces_per_box INTEGER NOT NULL,
+            total_pieces INTEGER NOT NULL,
+            scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES count_sessions (session_id),
+            FOREIGN KEY (bin_id) REFERENCES bins (bin_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_count_scans_session ON count_scans (session_id, bin_id)')
+
+def migration_inventory_checkpoints(cursor):
+    # 库存检查点：某个input_history位置上的完整库存（压缩存储），按时间点查询库存时从这里开始重放历史
+    if is_postgresql():
+        id_column = 'checkpoint_id SERIAL PRIMARY KEY'
+        payload_type = 'BYTEA'
+    else:
+        id_column = 'checkpoint_id INTEGER PRIMARY KEY AUTOINCREMENT'
+        payload_type = 'BLOB'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS inventory_checkpoints (
+            {id_column},
+            history_id INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            payload {payload_type} NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_checkpoints_history ON inventory_checkpoints (history_id)')
+
+def migration_history_archive(cursor):
+    # 历史归档目录：已归档的月份和已移出热表的history_id范围，查询时据此决定要合并哪些归档
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS history_archive_months (
+            month TEXT PRIMARY KEY,
+            first_history_id INTEGER NOT NULL,
+            last_history_id INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    if is_postgresql():
+        # 按input_date声明式分区，每月一个分区（归档时创建），按日期查询时只扫描相关分区
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS input_history_archive (
+                history_id INTEGER NOT NULL,
+                bin_code TEXT NOT NULL,
+                item_code TEXT NOT NULL,
+                customer_po TEXT,
+                BT TEXT,
+                box_count INTEGER NOT NULL,
+                pieces_per_box INTEGER NOT NULL,
+                total_pieces INTEGER NOT NULL,
+                input_time TIMESTAMP,
+                input_date DATE NOT NULL
+            ) PARTITION BY RANGE (input_date)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_input_history_archive_date
+            ON input_history_archive (input_date, input_time)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_input_history_archive_id ON input_history_archive (history_id)')
+
+def migration_inventory_batches(cursor):
+    # 已处理的批量录入：客户端重试同一批次（相同batch_id）时直接返回第一次的结果，不重复入库
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inventory_batches (
+            batch_id TEXT PRIMARY KEY,
+            response TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_batches_created ON inventory_batches (created_at)')
+
+# 写入后需要让读接口缓存失效的表（读接口只查询这些表，历史记录的写入总是伴随汇总表的更新）
+DATA_VERSION_TABLES = ('inventory_summary', 'items', 'bins')
+
+def migration_data_version(cursor):
+    # 数据版本号：单行计数器，由触发器在写事务中递增，所有进程共用
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY,
+            epoch TEXT NOT NULL,
+            version BIGINT NOT NULL
+        )
+    ''')
+    placeholder = get_placeholder()
+    cursor.execute(f'''
+        INSERT INTO data_version (id, epoch, version) VALUES (1, {placeholder}, 0)
+        ON CONFLICT (id) DO NOTHING
+    ''', (uuid.uuid4().hex[:8],))
+    if is_postgresql():
+        # 语句级触发器：一条语句无论影响多少行只递增一次
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+            BEGIN
+                UPDATE data_version SET version = version + 1 WHERE id = 1;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        for table in DATA_VERSION_TABLES:
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_{table}_data_version ON {table}')
+            cursor.execute(f'''
+                CREATE TRIGGER trg_{table}_data_version
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE PROCEDURE bump_data_version()
+            ''')
+    else:
+        # SQLite只有行级触发器
+        for table in DATA_VERSION_TABLES:
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_data_version
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE data_version SET version = version + 1 WHERE id = 1;
+                    END
+                ''')
+
+def migration_normalize_lookup_values(cursor):
+    # 统一PO/BT的空值：早期录入保存了空字符串，与NULL会被当作不同的分组（盘点差异、汇总行）
+    for table in ('inventory', 'input_history', 'count_scans'):
+        for column in ('customer_po', 'BT'):
+            cursor.execute(f"UPDATE {table} SET {column} = NULL WHERE TRIM({column}) = ''")
+    # 同一键原先分成空字符串和NULL两行的汇总合并为一行
+    rebuild_inventory_summary(cursor)
+
+SCHEMA_MIGRATIONS = [
+    (1, '库存汇总表 inventory_summary', ensure_inventory_summary),
+    (2, '二级索引', migration_secondary_indexes),
+    (3, 'input_history本地日期列', migration_history_input_date),
+    (4, '盘点暂存表 count_sessions / count_scans', migration_count_sessions),
+    (5, '库存检查点 inventory_checkpoints', migration_inventory_checkpoints),
+    (6, '历史归档 history_archive_months', migration_history_archive),
+    (7, '批量录入去重 inventory_batches', migration_inventory_batches),
+    (8, '数据版本号 data_version', migration_data_version),
+    (9, 'PO/BT空字符串统一为NULL', migration_normalize_lookup_values),
+]
+
+def run_migrations(cursor):
+    """执行尚未应用的结构迁移（调用方负责提交事务）"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT version FROM schema_migrations')
+    applied = {row['version'] for row in cursor.fetchall()}
+    placeholder = get_placeholder()
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        print(f"执行数据库迁移 {version}: {description}")
+        migrate(cursor)
+        cursor.execute(f'INSERT INTO schema_migrations (version, description) VALUES ({placeholder}, {placeholder})',
+                       (version, description))
+
+def read_bin_codes(lines, duplicates=None):
+    """
+    逐行读取库位CSV（第一行为标题，第一列为库位编号），按出现顺序返回去重后的库位编号。
+    duplicates不为None时记录重复出现的库位编号。
+    """
+    csv_reader = csv.reader(lines)
+    next(csv_reader, None)  # 跳过标题行
+    seen = set()
+    for row in csv_reader:
+        bin_code = row[0].strip() if row else ''
+        if not bin_code:
+            continue
+        if bin_code in seen:
+            if duplicates is not None:
+                duplicates.append(bin_code)
+            continue
+        seen.add(bin_code)
+        yield bin_code
+
+def sync_bins(cursor, bin_codes, remove_missing=False):
+    """
+    用新的库位列表同步bins表（调用方负责提交或回滚事务）：
+    新增的库位批量插入；不在新列表中的库位如果仍有库存只标记出来，
+    remove_missing为True时删除其余没有库存的库位。
+    """
+    placeholder = get_placeholder()
+    new_codes = set(bin_codes)
+    cursor.execute('SELECT bin_id, bin_code FROM bins')
+    existing = {row['bin_code']: row['bin_id'] for row in cursor.fetchall()}
+    
+    added = new_codes - existing.keys()
+    missing = existing.keys() - new_codes
+    
+    # inventory明细中仍有记录的库位不能删除（外键引用）
+    cursor.execute('SELECT DISTINCT bin_id FROM inventory')
+    stocked_ids = {row['bin_id'] for row in cursor.fetchall()}
+    missing_with_inventory = {code for code in missing if existing[code] in stocked_ids}
+    removable = missing - missing_with_inventory
+    
+    if added:
+        cursor.executemany(f'INSERT INTO bins (bin_code) VALUES ({placeholder})',
+                           [(code,) for code in sorted(added)])
+    removed = set()
+    if remove_missing and removable:
+        cursor.executemany(f'DELETE FROM bins WHERE bin_id = {placeholder}',
+                           [(existing[code],) for code in sorted(removable)])
+        removed = removable
+    
+    return {
+        'total': len(new_codes),
+        'added': len(added),
+        'unchanged': len(new_codes) - len(added),
+        'removed': len(removed),
+        'missing': sorted(missing - removed),
+        'missing_with_inventory': sorted(missing_with_inventory)
+    }
+
+# 商品CSV可能的编码：按顺序用文件开头的样本检测一次（latin-1能解码任何字节，放在最后）
+ITEM_CSV_ENCODINGS = ['utf-8-sig', 'gbk', 'cp1252', 'latin-1']
+ITEM_CSV_SAMPLE_SIZE = 64 * 1024
+# 每批写入的商品数，每批单独提交，导入大文件时不会长时间占用写锁
+ITEM_IMPORT_CHUNK_SIZE = 500
+
+def detect_csv_encoding(stream, encodings=ITEM_CSV_ENCODINGS):
+    """从缓冲流开头取样检测编码（不消耗流中的数据）"""
+    sample = stream.peek(ITEM_CSV_SAMPLE_SIZE)[:ITEM_CSV_SAMPLE_SIZE]
+    for encoding in encodings:
+        try:
+            # 样本末尾可能截断多字节字符，使用增量解码器且不要求完整结束
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return encodings[-1]
+
+def read_item_codes(lines, report):
+    """
+    逐行读取商品CSV（第一行为标题，第一列为商品编码），返回规范化（大写）且去重后的商品编码。
+    空行、不合格和重复的行记录在report中，行号为文件中的行号（标题为第1行）。
+    """
+    csv_reader = csv.reader(lines, skipinitialspace=True, strict=True)
+    next(csv_reader, None)  # 跳过标题行
+    first_lines = {}  # 规范化编码 -> 首次出现的行号
+    for row in csv_reader:
+        line = csv_reader.line_num
+        report['total_lines'] += 1
+        if not row or not any(cell.strip() for cell in row):
+            report['empty_lines'].append(line)
+            continue
+        
+        item_code = row[0].strip()
+        if not item_code:
+            report['invalid'].append({'line': line, 'item_code': '', 'reason': '空商品编码',
+                                      'reason_en': 'Empty item code'})
+            continue
+        if item_code.lower().startswith('item'):
+            report['invalid'].append({'line': line, 'item_code': item_code, 'reason': "以'Item'开头",
+                                      'reason_en': "Starts with 'Item'"})
+            continue
+        
+        normalized_code = item_code.upper()
+        if normalized_code in first_lines:
+            report['duplicates'].setdefault(normalized_code, [first_lines[normalized_code]]).append(line)
+            continue
+        first_lines[normalized_code] = line
+        yield normalized_code
+
+def import_item_codes(db, item_codes, chunk_size=ITEM_IMPORT_CHUNK_SIZE):
+    """分批插入商品编码，已存在的跳过；每批提交一次。返回 (新增数, 已存在数)"""
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
+    added = existing = 0
+    for chunk in iter_chunks(item_codes, chunk_size):
+        cursor.execute(f'''
+            SELECT item_code FROM items WHERE item_code IN ({', '.join([placeholder] * len(chunk))})
+        ''', chunk)
+        found = {row['item_code'] for row in cursor.fetchall()}
+        new_codes = [code for code in chunk if code not in found]
+        if new_codes:
+            cursor.executemany(f'''
+                INSERT INTO items (item_code) VALUES ({placeholder})
+                ON CONFLICT (item_code) DO NOTHING
+            ''', [(code,) for code in new_codes])
+        db.commit()
+        added += len(new_codes)
+        existing += len(found)
+    return added, existing
+
 # 初始化数据库
 def init_db():
     if not is_postgresql():
@@ -205,6 +1438,8 @@ def init_db():
         existing_tables = cursor.fetchall()
         if len(existing_tables) == 4:
             print("数据库已存在且包含所有必要的表")
+            run_migrations(cursor)
+            db.commit()
             return
         
         print("开始初始化数据库...")
@@ -337,9 +1572,7 @@ def init_db():
                     print("警告: BIN.csv文件不存在，跳过库位数据导入")
                 else:
                     with open('BIN.csv', 'r', encoding='utf-8') as f:
-                        csv_reader = csv.reader(f)
-                        next(csv_reader)  # 跳过标题行
-                        bin_data = [(row[0],) for row in csv_reader]
+                        bin_data = [(bin_code,) for bin_code in read_bin_codes(f)]
                         print(f"从CSV读取到 {len(bin_data)} 个库位")
                         if bin_data:  # 只有当有数据时才执行插入
                             if is_postgresql():
@@ -352,106 +1585,7 @@ def init_db():
             except Exception as e:
                 print(f"导入库位数据时出错: {str(e)}")
                 print("继续初始化过程...")
-        '''
-        #No need since no need to check item anymore
-        if 'items' not in [row[0] for row in existing_tables]:
-            print("导入商品数据...")
-            try:
-                encodings = ['utf-8', 'gbk', 'latin-1', 'iso-8859-1', 'cp1252']
-                items = set()  # 使用集合去重
-                duplicates = {}  # 记录重复的商品及其行号
-                invalid_items = []  # 记录不合格的商品及原因
-                empty_lines = []  # 记录空行的行号
-                total_lines = 0  # 总行数
-                processed_codes = {}  # 用于检测重复，存储商品编码及其首次出现的行号
-                successful_encoding = None
-                
-                for encoding in encodings:
-                    try:
-                        with open('Item.CSV', 'r', encoding=encoding) as f:
-                            content = f.read()
-                            successful_encoding = encoding
-                            break
-                    except UnicodeDecodeError:
-                        continue
-                
-                if not successful_encoding:
-                    raise Exception("无法读取Item.CSV文件，请检查文件编码和格式")
-                
-                # 直接使用已读取的内容
-                csv_reader = csv.reader(content.splitlines(), 
-                    quoting=csv.QUOTE_ALL,
-                    skipinitialspace=True,
-                    strict=True
-                )
-                
-                # 跳过标题行
-                next(csv_reader)
-                
-                # 读取每一行
-                for row in csv_reader:
-                    total_lines += 1
-                    try:
-                        # 检查空行
-                        if not row or len(row) == 0:
-                            empty_lines.append(total_lines)
-                            continue
-                        
-                        # 检查第一列是否为空
-                        if len(row[0].strip()) == 0:
-                            invalid_items.append((total_lines, "", "空商品编码"))
-                            continue
-                        
-                        if row and len(row) > 0:
-                            item_code = row[0].strip()
-                            normalized_code = item_code.upper().strip()
-                            
-                            # 检查是否以 "Item" 开头
-                            if item_code.lower().startswith('item'):
-                                invalid_items.append((total_lines, item_code, "以'Item'开头"))
-                                continue
-                            
-                            # 检查重复
-                            if normalized_code in processed_codes:
-                                if normalized_code not in duplicates:
-                                    duplicates[normalized_code] = [processed_codes[normalized_code]]
-                                duplicates[normalized_code].append(total_lines)
-                            else:
-                                processed_codes[normalized_code] = total_lines
-                                items.add(normalized_code)
-                    except Exception as e:
-                        invalid_items.append((total_lines, str(row), f"处理错误: {str(e)}"))
-                
-                print(f"从CSV读取到 {len(items)} 个商品")
-                print(f"\n处理统计:")
-                print(f"总行数: {total_lines}")
-                print(f"有效商品数: {len(items)}")
-                print(f"重复商品数: {len(duplicates)} (共 {sum(len(lines) for lines in duplicates.values())} 行)")
-                print(f"不合格商品数: {len(invalid_items)}")
-                print(f"空行数: {len(empty_lines)}")
-                
-                if duplicates:
-                    print("\n重复的商品编码:")
-                    for code in sorted(duplicates.keys()):
-                        print(f"- {code} (出现在第 {', '.join(map(str, duplicates[code]))} 行)")
-                
-                if invalid_items:
-                    print("\n不合格的商品:")
-                    for line, code, reason in sorted(invalid_items):
-                        print(f"第 {line} 行: {code} - {reason}")
-                
-                if empty_lines:
-                    print("\n空行:")
-                    print(f"第 {', '.join(map(str, empty_lines))} 行")
-                
-                # 插入数据
-                items = [(item,) for item in items]
-                cursor.executemany('INSERT INTO items (item_code) VALUES (?)', items)
-                
-            except Exception as e:
-                print(f"导入商品数据时出错: {e}")
-                raise
-        '''
+        run_migrations(cursor)
         db.commit()
         print("数据库初始化完成")
         
@@ -459,83 +1593,162 @@ def init_db():
         print(f"初始化数据库时出错: {str(e)}")
         print(traceback.format_exc())
         raise
-    finally:
-        db.close()
+
+# 确保搜索索引已构建并且不过时
+def ensure_search_index(index):
+    if index.needs_sync(SEARCH_INDEX_SYNC_SECONDS):
+        index.sync_now(get_cursor(get_db()), max_age=SEARCH_INDEX_SYNC_SECONDS)
 
 # 在应用启动时初始化数据库
 with app.app_context():
     try:
         init_db()
+        ensure_search_index(bin_search_index)
+        ensure_search_index(item_search_index)
     except Exception as e:
         print(f"启动时初始化数据库失败: {str(e)}")
 
+def search_index_etag(index):
+    def etag_func():
+        ensure_search_index(index)
+        return f'{PROCESS_TAG}-{index.version}'
+    return etag_func
+
 @app.route('/api/bins', methods=['GET'])
+@conditional_get(search_index_etag(bin_search_index))
 def get_bins():
     search = request.args.get('search', '')
-    db = get_db()
-    cursor = get_cursor(db)
-    search_pattern = f'%{search}%'
-    start_pattern = f'{search}%'
-    placeholder = get_placeholder()
-    cursor.execute(f'''
-        SELECT * FROM bins 
-        WHERE bin_code LIKE {placeholder}
-        ORDER BY 
-            CASE 
-                WHEN bin_code LIKE {placeholder} THEN 1
-                ELSE 2
-            END,
-            bin_code
-        LIMIT 10
-    ''', (search_pattern, start_pattern))
-    bins = [dict(row) for row in cursor.fetchall()]
+    ensure_search_index(bin_search_index)
+    bins = [{'bin_id': bin_id, 'bin_code': bin_code}
+            for bin_id, bin_code in bin_search_index.search(search, limit=10)]
     return jsonify(bins)
 
 @app.route('/api/items', methods=['GET'])
+@conditional_get(search_index_etag(item_search_index))
 def get_items():
     search = request.args.get('search', '')
+    ensure_search_index(item_search_index)
+    items = [{'item_id': item_id, 'item_code': item_code}
+             for item_id, item_code in item_search_index.search(search, limit=10)]
+    return jsonify(items)
+
+@app.route('/api/bins/import', methods=['POST'])
+def import_bins():
+    """
+    上传新的库位CSV并与bins表比较同步（单个事务）。
+    文件可以作为表单字段file上传，也可以直接作为请求体；
+    dry_run=1只返回差异不写入，remove=1删除不在新列表中且没有库存的库位。
+    """
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true')
+    remove_missing = request.args.get('remove', '').lower() in ('1', 'true')
+    
     db = get_db()
     cursor = get_cursor(db)
-    placeholder = get_placeholder()
-    cursor.execute(f'''
-        SELECT * FROM items 
-        WHERE item_code LIKE {placeholder}
-        ORDER BY 
-            CASE 
-                WHEN item_code LIKE {placeholder} THEN 1
-                ELSE 2
-            END,
-            item_code
-        LIMIT 10
-    ''', (f'%{search}%', f'{search}%'))
-    items = [dict(row) for row in cursor.fetchall()]
-    return jsonify(items)
+    duplicates = []
+    try:
+        # utf-8-sig：兼容Excel导出的带BOM的CSV
+        lines = TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        result = sync_bins(cursor, read_bin_codes(lines, duplicates), remove_missing)
+        if dry_run:
+            db.rollback()
+        else:
+            db.commit()
+    except UnicodeDecodeError:
+        db.rollback()
+        return jsonify({'error': '库位文件必须是UTF-8编码的CSV', 'error_en': 'Bin file must be a UTF-8 CSV'}), 400
+    except Exception as e:
+        print(f"导入库位时出错: {str(e)}")
+        print(f"错误详情: {traceback.format_exc()}")
+        db.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    if not dry_run and (result['added'] or result['removed']):
+        bin_search_index.reload(cursor)
+        change_broadcaster.publish('bins_imported', added=result['added'], removed=result['removed'])
+    
+    print(f"库位导入{'（预览）' if dry_run else ''}: 新增 {result['added']}，删除 {result['removed']}，"
+          f"仍有库存未删除 {len(result['missing_with_inventory'])}")
+    return jsonify({'success': True, 'dry_run': dry_run, 'duplicates': duplicates, **result})
+
+@app.route('/api/items/import', methods=['POST'])
+def import_items():
+    """
+    上传商品CSV并批量导入（编码自动检测，已存在的商品跳过）。
+    文件可以作为表单字段file上传，也可以直接作为请求体；返回重复、不合格和空行的统计。
+    """
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    if not hasattr(stream, 'peek'):
+        stream = BufferedReader(stream)
+    
+    encoding = detect_csv_encoding(stream)
+    report = {'total_lines': 0, 'duplicates': {}, 'invalid': [], 'empty_lines': []}
+    db = get_db()
+    try:
+        lines = TextIOWrapper(stream, encoding=encoding, newline='')
+        added, existing = import_item_codes(db, read_item_codes(lines, report))
+    except (UnicodeDecodeError, csv.Error) as e:
+        db.rollback()
+        return jsonify({
+            'error': f'第 {report["total_lines"] + 2} 行附近无法解析（编码 {encoding}）: {str(e)}',
+            'error_en': f'Could not parse the file near line {report["total_lines"] + 2} (encoding {encoding}): {str(e)}',
+            'partial': True
+        }), 400
+    except Exception as e:
+        print(f"导入商品时出错: {str(e)}")
+        print(f"错误详情: {traceback.format_exc()}")
+        db.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    if added:
+        item_search_index.sync_now(get_cursor(db))
+        change_broadcaster.publish('items_imported', added=added)
+    
+    print(f"商品导入: 编码 {encoding}，总行数 {report['total_lines']}，新增 {added}，已存在 {existing}，"
+          f"重复 {len(report['duplicates'])}，不合格 {len(report['invalid'])}，空行 {len(report['empty_lines'])}")
+    return jsonify({
+        'success': True,
+        'encoding': encoding,
+        'total_lines': report['total_lines'],
+        'valid': added + existing,
+        'added': added,
+        'existing': existing,
+        'duplicates': [{'item_code': code, 'lines': lines}
+                       for code, lines in sorted(report['duplicates'].items())],
+        'invalid': report['invalid'],
+        'empty_lines': report['empty_lines']
+    })
 
 @app.route('/api/inventory', methods=['POST'])
 def add_inventory():
     ensure_db_initialized()  # 确保数据库已初始化
     data = request.json
-    db = get_db()
-    cursor = get_cursor(db)
     placeholder = get_placeholder()
     
-    try:
+    # 获取客户订单号和BT，未填写时为None
+    customer_po = normalize_lookup_value(data.get('customer_po'))
+    BT = normalize_lookup_value(data.get('BT'))
+    
+    def write(cursor):
         # 先检查 bin_id 是否存在
         cursor.execute(f'SELECT bin_id FROM bins WHERE bin_code = {placeholder}', (data['bin_code'],))
         bin_result = cursor.fetchone()
         if not bin_result:
-            return jsonify({'error': '库位不存在', 'error_en': 'Bin location does not exist'}), 400
+            raise WriteRejected('库位不存在', 'Bin location does not exist')
         bin_id = bin_result['bin_id']
 
         # 检查商品是否存在，如果不存在则自动添加
         cursor.execute(f'SELECT item_id FROM items WHERE item_code = {placeholder}', (data['item_code'],))
         item_result = cursor.fetchone()
-        if not item_result:
+        new_item = not item_result
+        if new_item:
             # 商品不存在，自动添加到items表
             cursor.execute(f'INSERT INTO items (item_code) VALUES ({placeholder})', (data['item_code'],))
             if is_postgresql():
-                cursor.execute('SELECT lastval()')
-                item_id = cursor.fetchone()[0]
+                cursor.execute('SELECT lastval() AS item_id')
+                item_id = cursor.fetchone()['item_id']
             else:
                 item_id = cursor.lastrowid
         else:
@@ -545,33 +1758,210 @@ def add_inventory():
         box_count = int(data['box_count'])
         pieces_per_box = int(data['pieces_per_box'])
         total_pieces = box_count * pieces_per_box
-
-        # 获取客户订单号和BT，如果不存在则为None
-        customer_po = data.get('customer_po', None)
-        BT = data.get('BT', None)
         
         # 插入库存记录
         cursor.execute(f'''
             INSERT INTO inventory (bin_id, item_id, customer_po, BT, box_count, pieces_per_box, total_pieces)
             VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
         ''', (bin_id, item_id, customer_po, BT, box_count, pieces_per_box, total_pieces))
+        apply_inventory_delta(cursor, bin_id, item_id, customer_po, BT, pieces_per_box, box_count, total_pieces)
         
         # 记录输入历史
         cursor.execute(f'''
             INSERT INTO input_history (bin_code, item_code, customer_po, BT, box_count, pieces_per_box, total_pieces)
             VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
         ''', (data['bin_code'], data['item_code'], customer_po, BT, box_count, pieces_per_box, total_pieces))
-        
-        db.commit()
-        
-        return jsonify({'success': True})
+        return item_id if new_item else None
+    
+    try:
+        new_item_id = run_write(write)
+    except WriteRejected as e:
+        return e.response()
     except Exception as e:
         print(f"添加库存记录时出错: {str(e)}")
         print(f"错误详情: {traceback.format_exc()}")
-        db.rollback()
         return jsonify({'error': str(e)}), 500
+    
+    if new_item_id is not None:
+        item_search_index.add(data['item_code'], new_item_id)
+    record_lookup_values(customer_po, BT)
+    change_broadcaster.publish('inventory_added', bin_code=data['bin_code'], item_code=data['item_code'],
+                               customer_po=customer_po, BT=BT)
+    return jsonify({'success': True})
+
+# 批量提交的单批最大行数，以及IN查询每次携带的参数个数（SQLite默认上限999）
+INVENTORY_BATCH_MAX_LINES = 2000
+SQL_IN_CHUNK_SIZE = 500
+# 已处理批次的batch_id保留天数（客户端离线重试的最长时间）
+INVENTORY_BATCH_KEEP_DAYS = int(os.getenv('INVENTORY_BATCH_KEEP_DAYS', '7'))
+INVENTORY_BATCH_ID_MAX_LENGTH = 64
+
+def claim_inventory_batch(cursor, batch_id):
+    """
+    在写事务中登记batch_id。已处理过（或正在另一个事务中处理）时返回第一次的响应，否则返回None。
+    PostgreSQL中并发的重复请求会等待第一个事务提交后再判断
+    """
+    placeholder = get_placeholder()
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=INVENTORY_BATCH_KEEP_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute(f'DELETE FROM inventory_batches WHERE created_at < {placeholder}', (cutoff,))
+    cursor.execute(f'''
+        INSERT INTO inventory_batches (batch_id) VALUES ({placeholder})
+        ON CONFLICT (batch_id) DO NOTHING
+    ''', (batch_id,))
+    if cursor.rowcount:
+        return None
+    cursor.execute(f'SELECT response FROM inventory_batches WHERE batch_id = {placeholder}', (batch_id,))
+    row = cursor.fetchone()
+    return json.loads(row['response']) if row and row['response'] else {}
+
+def lookup_ids(cursor, table, id_column, code_column, codes):
+    """按编码集合批量查询ID，返回 {code: id}"""
+    placeholder = get_placeholder()
+    codes = list(codes)
+    result = {}
+    for start in range(0, len(codes), SQL_IN_CHUNK_SIZE):
+        chunk = codes[start:start + SQL_IN_CHUNK_SIZE]
+        cursor.execute(f'''
+            SELECT {id_column}, {code_column} FROM {table}
+            WHERE {code_column} IN ({', '.join([placeholder] * len(chunk))})
+        ''', chunk)
+        for row in cursor.fetchall():
+            result[row[code_column]] = row[id_column]
+    return result
+
+@app.route('/api/inventory/batch', methods=['POST'])
+def add_inventory_batch():
+    """批量录入库存：一次请求提交多行，集合查询库位/商品，批量插入并只提交一次事务"""
+    ensure_db_initialized()  # 确保数据库已初始化
+    data = request.get_json(silent=True)
+    entries = data.get('entries') if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'error': '没有要提交的记录', 'error_en': 'No entries to submit'}), 400
+    if len(entries) > INVENTORY_BATCH_MAX_LINES:
+        return jsonify({
+            'error': f'单次最多提交 {INVENTORY_BATCH_MAX_LINES} 行',
+            'error_en': f'At most {INVENTORY_BATCH_MAX_LINES} entries per batch'
+        }), 400
+    # 客户端为每个批次生成的ID，网络中断后重试时不变，用于忽略已提交过的批次
+    batch_id = data.get('batch_id')
+    if batch_id is not None and (not isinstance(batch_id, str) or not batch_id
+                                 or len(batch_id) > INVENTORY_BATCH_ID_MAX_LENGTH):
+        return jsonify({'error': 'batch_id格式错误', 'error_en': 'Invalid batch_id'}), 400
+    
+    placeholder = get_placeholder()
+    
+    # 与单条录入相同的校验：数量必须为整数
+    results = []
+    lines = []
+    for index, entry in enumerate(entries):
+        try:
+            box_count = int(entry['box_count'])
+            pieces_per_box = int(entry['pieces_per_box'])
+            lines.append({
+                'index': index,
+                'bin_code': entry['bin_code'],
+                'item_code': entry['item_code'],
+                'customer_po': normalize_lookup_value(entry.get('customer_po')),
+                'BT': normalize_lookup_value(entry.get('BT')),
+                'box_count': box_count,
+                'pieces_per_box': pieces_per_box,
+                'total_pieces': box_count * pieces_per_box
+            })
+            results.append({'index': index, 'success': True})
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results.append({'index': index, 'success': False,
+                            'error': f'记录格式错误: {str(e)}', 'error_en': f'Invalid entry: {str(e)}'})
+    
+    def write(cursor):
+        if batch_id is not None:
+            previous = claim_inventory_batch(cursor, batch_id)
+            if previous is not None:
+                return previous, None
+        
+        bin_ids = lookup_ids(cursor, 'bins', 'bin_id', 'bin_code', {line['bin_code'] for line in lines})
+        valid_lines = []
+        for line in lines:
+            if line['bin_code'] not in bin_ids:
+                results[line['index']] = {'index': line['index'], 'success': False,
+                                          'error': '库位不存在', 'error_en': 'Bin location does not exist'}
+            else:
+                valid_lines.append(line)
+        
+        # 商品不存在则自动添加
+        item_codes = {line['item_code'] for line in valid_lines}
+        item_ids = lookup_ids(cursor, 'items', 'item_id', 'item_code', item_codes)
+        new_item_codes = sorted(item_codes - set(item_ids))
+        if new_item_codes:
+            cursor.executemany(f'INSERT INTO items (item_code) VALUES ({placeholder})',
+                               [(code,) for code in new_item_codes])
+            new_item_ids = lookup_ids(cursor, 'items', 'item_id', 'item_code', new_item_codes)
+            item_ids.update(new_item_ids)
+        
+        cursor.executemany(f'''
+            INSERT INTO inventory (bin_id, item_id, customer_po, BT, box_count, pieces_per_box, total_pieces)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+        ''', [(bin_ids[line['bin_code']], item_ids[line['item_code']], line['customer_po'], line['BT'],
+               line['box_count'], line['pieces_per_box'], line['total_pieces']) for line in valid_lines])
+        
+        cursor.executemany(f'''
+            INSERT INTO input_history (bin_code, item_code, customer_po, BT, box_count, pieces_per_box, total_pieces)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+        ''', [(line['bin_code'], line['item_code'], line['customer_po'], line['BT'],
+               line['box_count'], line['pieces_per_box'], line['total_pieces']) for line in valid_lines])
+        
+        # 同一汇总键的多行先在内存中合并，再更新汇总表
+        deltas = {}
+        for line in valid_lines:
+            key = (bin_ids[line['bin_code']], item_ids[line['item_code']],
+                   line['customer_po'], line['BT'], line['pieces_per_box'])
+            box_total, pieces_total = deltas.get(key, (0, 0))
+            deltas[key] = (box_total + line['box_count'], pieces_total + line['total_pieces'])
+        for (bin_id, item_id, customer_po, BT, pieces_per_box), (box_count, total_pieces) in sorted(
+                deltas.items(), key=lambda delta: (delta[0][0], delta[0][1], delta[0][4])):
+            apply_inventory_delta(cursor, bin_id, item_id, customer_po, BT, pieces_per_box, box_count, total_pieces)
+        
+        response = {
+            'success': all(result['success'] for result in results),
+            'accepted': len(valid_lines),
+            'rejected': len(results) - len(valid_lines),
+            'results': results
+        }
+        if batch_id is not None:
+            cursor.execute(f'UPDATE inventory_batches SET response = {placeholder} WHERE batch_id = {placeholder}',
+                           (json.dumps(response), batch_id))
+        return response, (valid_lines, item_codes, item_ids, new_item_codes)
+    
+    try:
+        response, written = run_write(write)
+    except TRANSIENT_DB_ERRORS as e:
+        # 整批已回滚，客户端可用同一个batch_id重试
+        print(f"批量添加库存记录暂时失败: {str(e)}")
+        return jsonify({'error': f'数据库繁忙，请稍后重试: {str(e)}',
+                        'error_en': f'Database is busy, please retry: {str(e)}'}), 503
+    except Exception as e:
+        print(f"批量添加库存记录时出错: {str(e)}")
+        print(f"错误详情: {traceback.format_exc()}")
+        return jsonify({'error': str(e)}), 500
+    
+    if written is None:
+        # 重试的批次已经提交过，返回第一次的结果
+        return jsonify({**response, 'duplicate': True})
+    
+    valid_lines, item_codes, item_ids, new_item_codes = written
+    for code in new_item_codes:
+        item_search_index.add(code, item_ids[code])
+    for line in valid_lines:
+        record_lookup_values(line['customer_po'], line['BT'])
+    if valid_lines:
+        change_broadcaster.publish('inventory_batch',
+                                   bin_codes=sorted({line['bin_code'] for line in valid_lines}),
+                                   item_codes=sorted(item_codes))
+    
+    return jsonify(response)
 
 @app.route('/api/inventory/item/<item_id>', methods=['GET'])
+@conditional_get(data_version_etag)
+@cached_response
 def get_item_inventory(item_id):
     db = get_db()
     cursor = db.cursor()
@@ -590,13 +1980,26 @@ def get_item_inventory(item_id):
             'box_details': []
         })
     
+    as_of, error_response = get_as_of()
+    if error_response:
+        return error_response
+    if as_of:
+        rows = reconstruct_inventory(get_cursor(db), as_of, 'item_code', item_id)
+        return jsonify({
+            'item_code': item_id,
+            'as_of': as_of,
+            'total': sum(row[6] for row in rows),
+            'total_boxes': sum(row[5] for row in rows),
+            'box_details': [f'{row[5]}x{row[4]}' for row in rows]
+        })
+    
     cursor.execute('''
         SELECT 
             i.item_code,
             SUM(inv.total_pieces) as total_pieces,
             SUM(inv.box_count) as total_boxes,
             GROUP_CONCAT(inv.box_count || 'x' || inv.pieces_per_box) as box_details
-        FROM inventory inv
+        FROM inventory_summary inv
         JOIN items i ON inv.item_id = i.item_id
         WHERE i.item_code = ?
         GROUP BY i.item_code
@@ -618,610 +2021,1315 @@ def get_item_inventory(item_id):
         'box_details': result['box_details'].split(',') if result['box_details'] else []
     })
 
+# 按 (分组列, PO, BT, 箱规) 汇总库存，返回已排序的扁平行，供各查询接口在Python中单次遍历组装
+def fetch_inventory_groups(cursor, group_columns, where_clause, params):
+    column_sql = {
+        'item_code': 'i.item_code',
+        'bin_code': 'b.bin_code'
+    }
+    select_columns = ', '.join(f'{column_sql[column]} AS {column}' for column in group_columns)
+    group_by = ', '.join(column_sql[column] for column in group_columns)
+    cursor.execute(convert_sql(f'''
+        SELECT 
+            {select_columns},
+            inv.customer_po AS customer_po,
+            inv.BT AS "BT",
+            inv.pieces_per_box AS pieces_per_box,
+            SUM(inv.box_count) AS box_count,
+            SUM(inv.total_pieces) AS total_pieces
+        FROM inventory_summary inv
+        JOIN items i ON inv.item_id = i.item_id
+        JOIN bins b ON inv.bin_id = b.bin_id
+        WHERE {where_clause}
+        GROUP BY {group_by}, inv.customer_po, inv.BT, inv.pieces_per_box
+        ORDER BY {group_by}, inv.customer_po, inv.BT, inv.pieces_per_box
+    '''), params)
+    return cursor.fetchall()
+
+def build_inventory_entries(rows, key_column, group_total_boxes=False, merged_box_details=True):
+    """把按 key_column、PO、BT、箱规 排序的扁平行组装成带 po_bt_groups 的嵌套结构（单次线性遍历）"""
+    entries = []
+    entry = None
+    group = None
+    for row in rows:
+        if entry is None or entry[key_column] != row[key_column]:
+            entry = {
+                key_column: row[key_column],
+                'total_pieces': 0,
+                'total_boxes': 0,
+                'po_bt_groups': []
+            }
+            if merged_box_details:
+                entry['box_details'] = {}
+            entries.append(entry)
+            group = None
+        
+        if group is None or group['customer_po'] != row['customer_po'] or group['BT'] != row['BT']:
+            group = {
+                'customer_po': row['customer_po'],
+                'BT': row['BT'],
+                'pieces': 0,
+                'box_details': []
+            }
+            if group_total_boxes:
+                group['total_boxes'] = 0
+            entry['po_bt_groups'].append(group)
+        
+        box_count = row['box_count']
+        pieces_per_box = row['pieces_per_box']
+        group['pieces'] += row['total_pieces']
+        group['box_details'].append({'box_count': box_count, 'pieces_per_box': pieces_per_box})
+        if group_total_boxes:
+            group['total_boxes'] += box_count
+        entry['total_pieces'] += row['total_pieces']
+        entry['total_boxes'] += box_count
+        
+        # 合并所有箱规到总的box_details中
+        if merged_box_details:
+            merged = entry['box_details'].get(pieces_per_box)
+            if merged is None:
+                entry['box_details'][pieces_per_box] = {'box_count': box_count, 'pieces_per_box': pieces_per_box}
+            else:
+                merged['box_count'] += box_count
+    
+    if merged_box_details:
+        for entry in entries:
+            entry['box_details'] = list(entry['box_details'].values())
+    return entries
+
+def build_item_location_entries(rows):
+    """把按 商品、库位、PO、BT、箱规 排序的扁平行组装成 商品 -> 库位 -> PO/BT 的嵌套结构"""
+    items_list = []
+    start = 0
+    for end in range(1, len(rows) + 1):
+        if end < len(rows) and rows[end]['item_code'] == rows[start]['item_code']:
+            continue
+        locations = build_inventory_entries(rows[start:end], 'bin_code',
+                                            group_total_boxes=True, merged_box_details=False)
+        items_list.append({
+            'item_code': rows[start]['item_code'],
+            'total_pieces': sum(location['total_pieces'] for location in locations),
+            'total_boxes': sum(location['total_boxes'] for location in locations),
+            'locations': locations
+        })
+        start = end
+    return items_list
+
+# 按时间点查询库存（?as_of=）：从不晚于该时刻的最近检查点开始重放input_history
+# 检查点中每行的列（与inventory_summary的粒度相同）
+CHECKPOINT_COLUMNS = ('bin_code', 'item_code', 'customer_po', 'BT', 'pieces_per_box', 'box_count', 'total_pieces')
+# 检查点按列存储，字符串列共用一个字典（行里只存下标，-1表示NULL），整体zlib压缩
+CHECKPOINT_STRING_COLUMNS = 4
+# 内存中保留的已解码检查点个数
+CHECKPOINT_CACHE_SIZE = int(os.getenv('CHECKPOINT_CACHE_SIZE', '2'))
+
+def encode_columns(rows, columns, string_columns):
+    """
+    按列编码rows（元组按位置取值，其他按列名取值）：string_columns中的列共用一个字符串字典，
+    列里只存字典下标（-1表示NULL）。返回 (字符串字典, 每列的值列表)
+    """
+    string_indexes = {columns.index(column) for column in string_columns}
+    strings = []
+    string_ids = {}
+    data = [[] for _ in columns]
+    for row in rows:
+        for index, column in enumerate(columns):
+            value = row[index] if isinstance(row, tuple) else row[column]
+            if index in string_indexes:
+                if value is None:
+                    value = -1
+                else:
+                    string_id = string_ids.setdefault(value, len(strings))
+                    if string_id == len(strings):
+                        strings.append(value)
+                    value = string_id
+            data[index].append(value)
+    return strings, data
+
+def compact_table(rows, columns, string_columns):
+    """紧凑响应格式（?format=compact）：列名、字符串字典和按列存储的数据，重复的编码只传一次"""
+    strings, data = encode_columns(rows, columns, string_columns)
+    return {'columns': columns, 'string_columns': string_columns, 'strings': strings, 'data': data}
+
+def compact_requested():
+    return request.args.get('format', '').strip().lower() == 'compact'
+
+def encode_checkpoint(rows):
+    strings, columns = encode_columns(rows, CHECKPOINT_COLUMNS, CHECKPOINT_COLUMNS[:CHECKPOINT_STRING_COLUMNS])
+    payload = {'columns': CHECKPOINT_COLUMNS, 'strings': strings, 'data': columns}
+    return zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+def decode_checkpoint(payload):
+    """返回检查点的行列表，每行为按CHECKPOINT_COLUMNS排列的元组"""
+    payload = json.loads(zlib.decompress(bytes(payload)).decode('utf-8'))
+    strings = payload['strings']
+    columns = payload['data']
+    for index in range(CHECKPOINT_STRING_COLUMNS):
+        columns[index] = [strings[value] if value >= 0 else None for value in columns[index]]
+    return list(zip(*columns))
+
+# 已解码检查点的LRU缓存：检查点写入后不再修改，按ID缓存即可
+class CheckpointCache:
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, cursor, checkpoint_id):
+        with self._lock:
+            rows = self._entries.get(checkpoint_id)
+            if rows is not None:
+                self._entries.move_to_end(checkpoint_id)
+                return rows
+        placeholder = get_placeholder()
+        cursor.execute(f'SELECT payload FROM inventory_checkpoints WHERE checkpoint_id = {placeholder}',
+                       (checkpoint_id,))
+        rows = decode_checkpoint(cursor.fetchone()['payload'])
+        with self._lock:
+            self._entries[checkpoint_id] = rows
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return rows
+
+    def discard(self, checkpoint_id):
+        with self._lock:
+            self._entries.pop(checkpoint_id, None)
+
+checkpoint_cache = CheckpointCache(CHECKPOINT_CACHE_SIZE)
+
+def create_inventory_checkpoint(db):
+    """把当前库存汇总写成检查点并提交，返回检查点信息"""
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
+    # 同一条语句读取历史位置和库存，两者一定对应同一时刻（不需要显式的读事务）
+    cursor.execute(f'''
+        SELECT {latest_history_id_sql()} AS history_id,
+               NULL AS bin_code, NULL AS item_code, NULL AS customer_po, NULL AS "BT",
+               NULL AS pieces_per_box, NULL AS box_count, NULL AS total_pieces
+        UNION ALL
+        SELECT NULL, b.bin_code, i.item_code, s.customer_po, s.BT, s.pieces_per_box, s.box_count, s.total_pieces
+        FROM inventory_summary s
+        JOIN bins b ON b.bin_id = s.bin_id
+        JOIN items i ON i.item_id = s.item_id
+        WHERE s.total_pieces > 0
+    ''')
+    history_id = 0
+    rows = []
+    for row in iter_cursor_rows(cursor):
+        if row['bin_code'] is None:
+            history_id = row['history_id'] or 0
+        else:
+            rows.append(tuple(row[column] for column in CHECKPOINT_COLUMNS))
+    payload = encode_checkpoint(rows)
+    if is_postgresql():
+        payload = psycopg2.Binary(payload)
+    cursor.execute(f'''
+        INSERT INTO inventory_checkpoints (history_id, row_count, payload)
+        VALUES ({placeholder}, {placeholder}, {placeholder})
+    ''', (history_id, len(rows), payload))
+    db.commit()
+    return {'history_id': history_id, 'row_count': len(rows), 'size': len(payload)}
+
+def parse_as_of(value):
+    """
+    解析as_of参数（UTC，ISO格式，与input_time相同的时区）；只有日期时表示当天结束时的库存。
+    返回可与input_time比较的字符串，格式错误时返回None
+    """
+    value = value.strip().replace('T', ' ')
+    try:
+        if len(value) == 10:
+            return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d 23:59:59')
+        as_of = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if as_of.tzinfo is not None:
+        as_of = as_of.astimezone(timezone.utc).replace(tzinfo=None)
+    return as_of.strftime('%Y-%m-%d %H:%M:%S')
+
+def get_as_of():
+    """返回 (截止时间, 错误响应)；未指定as_of时两者都为None"""
+    value = request.args.get('as_of', '').strip()
+    if not value:
+        return None, None
+    as_of = parse_as_of(value)
+    if as_of is None:
+        return None, (jsonify({
+            'error': 'as_of格式错误，应为 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS（UTC）',
+            'error_en': 'Invalid as_of, expected YYYY-MM-DD or YYYY-MM-DD HH:MM:SS (UTC)'
+        }), 400)
+    return as_of, None
+
+def reconstruct_inventory(cursor, as_of, filter_column, value):
+    """
+    重建as_of时刻的库存（只包含filter_column等于value的行）：
+    从不晚于该时刻的最近检查点开始，按history_id顺序重放之后的历史记录。
+    返回与inventory_summary粒度相同的行 (库位, 商品, PO, BT, 箱规, 箱数, 件数)
+    """
+    placeholder = get_placeholder()
+    # input_date为本地日期，多包含一天以免时区差导致漏掉下个月的归档
+    end_date = (datetime.strptime(as_of[:10], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    cursor.execute(f'''
+        SELECT MAX(history_id) AS history_id FROM {history_source(cursor, end_date=end_date)}
+        WHERE input_time <= {placeholder}
+    ''', (as_of,))
+    target_id = cursor.fetchone()['history_id'] or 0
+    cursor.execute(f'''
+        SELECT checkpoint_id, history_id FROM inventory_checkpoints
+        WHERE history_id <= {placeholder}
+        ORDER BY history_id DESC LIMIT 1
+    ''', (target_id,))
+    checkpoint = cursor.fetchone()
+    
+    # (库位, 商品, PO, BT) -> {箱规: [箱数, 件数]}
+    stock = defaultdict(dict)
+    start_id = 0
+    if checkpoint:
+        start_id = checkpoint['history_id']
+        column_index = CHECKPOINT_COLUMNS.index(filter_column)
+        for row in checkpoint_cache.get(cursor, checkpoint['checkpoint_id']):
+            if row[column_index] == value:
+                # 早期检查点和归档中的PO/BT可能是空字符串，与NULL视为同一组
+                key = row[:2] + (normalize_lookup_value(row[2]), normalize_lookup_value(row[3]))
+                boxes = stock[key].setdefault(row[4], [0, 0])
+                boxes[0] += row[5]
+                boxes[1] += row[6]
+    
+    cursor.execute(convert_sql(f'''
+        SELECT bin_code, item_code, customer_po, BT AS "BT", box_count, pieces_per_box, total_pieces
+        FROM {history_source(cursor, since_history_id=start_id)}
+        WHERE history_id > ? AND history_id <= ? AND {filter_column} = ?
+        ORDER BY history_id
+    '''), (start_id, target_id, value))
+    for row in iter_cursor_rows(cursor):
+        key = (row['bin_code'], row['item_code'],
+               normalize_lookup_value(row['customer_po']), normalize_lookup_value(row['BT']))
+        # 清空记录的箱规和件数为负数，只记录了最大的箱规：按整组件数判断，整组为0即视为清空
+        boxes = stock[key].setdefault(abs(row['pieces_per_box']), [0, 0])
+        boxes[0] += row['box_count']
+        boxes[1] += row['total_pieces']
+        if sum(pieces for _, pieces in stock[key].values()) <= 0:
+            del stock[key]
+    
+    return [key + (pieces_per_box, box_count, total_pieces)
+            for key, boxes in stock.items()
+            for pieces_per_box, (box_count, total_pieces) in boxes.items() if total_pieces > 0]
+
+def fetch_inventory_groups_as_of(cursor, group_columns, filter_column, value, as_of):
+    """与fetch_inventory_groups返回相同结构的行，数据为as_of时刻的库存"""
+    sums = {}
+    for row in reconstruct_inventory(cursor, as_of, filter_column, value):
+        row = dict(zip(CHECKPOINT_COLUMNS, row))
+        key = tuple(row[column] for column in group_columns) + (row['customer_po'], row['BT'], row['pieces_per_box'])
+        box_count, total_pieces = sums.get(key, (0, 0))
+        sums[key] = (box_count + row['box_count'], total_pieces + row['total_pieces'])
+    # NULL排在前面（与SQLite的ORDER BY一致）
+    sort_key = lambda key: tuple((part is not None, part if part is not None else '') for part in key)
+    return [dict(zip(group_columns + ['customer_po', 'BT', 'pieces_per_box'], key),
+                 box_count=box_count, total_pieces=total_pieces)
+            for key, (box_count, total_pieces) in sorted(sums.items(), key=lambda entry: sort_key(entry[0]))]
+
+@app.route('/api/checkpoints', methods=['POST'])
+def create_checkpoint():
+    """立即生成一个库存检查点"""
+    db = get_db()
+    try:
+        checkpoint = create_inventory_checkpoint(db)
+        checkpoint['pruned'] = prune_inventory_checkpoints(db)
+    except Exception as e:
+        print(f"生成库存检查点时出错: {str(e)}")
+        print(f"错误详情: {traceback.format_exc()}")
+        db.rollback()
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'success': True, **checkpoint}), 201
+
+@app.route('/api/checkpoints', methods=['GET'])
+def list_checkpoints():
+    cursor = get_cursor(get_db())
+    cursor.execute('''
+        SELECT checkpoint_id, history_id, row_count, created_at FROM inventory_checkpoints
+        ORDER BY history_id DESC
+    ''')
+    return jsonify([{
+        'checkpoint_id': row['checkpoint_id'],
+        'history_id': row['history_id'],
+        'row_count': row['row_count'],
+        'created_at': row['created_at']
+    } for row in cursor.fetchall()])
+
+# 自动检查点：每隔CHECKPOINT_INTERVAL_SECONDS秒生成一次（0表示只手动生成）。
+# 保留最近CHECKPOINT_KEEP_RECENT个；更早的每天只保留当天最后一个，超过CHECKPOINT_KEEP_DAYS天的删除
+CHECKPOINT_INTERVAL_SECONDS = int(os.getenv('CHECKPOINT_INTERVAL_SECONDS', '3600'))
+CHECKPOINT_KEEP_RECENT = int(os.getenv('CHECKPOINT_KEEP_RECENT', '24'))
+CHECKPOINT_KEEP_DAYS = int(os.getenv('CHECKPOINT_KEEP_DAYS', '90'))
+
+def sql_seconds_ago(seconds):
+    """当前时间减去seconds秒的SQL表达式（可与CURRENT_TIMESTAMP默认值的列比较）"""
+    seconds = int(seconds)
+    if is_postgresql():
+        return f"CURRENT_TIMESTAMP - INTERVAL '{seconds} seconds'"
+    return f"datetime('now', '-{seconds} seconds')"
+
+def prune_inventory_checkpoints(db, keep_recent=CHECKPOINT_KEEP_RECENT, keep_days=CHECKPOINT_KEEP_DAYS):
+    """按保留策略删除旧检查点并提交，返回删除的个数"""
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
+    cursor.execute(f'''
+        SELECT checkpoint_id, created_at,
+               CASE WHEN created_at < {sql_seconds_ago(keep_days * 86400)} THEN 1 ELSE 0 END AS expired
+        FROM inventory_checkpoints
+        ORDER BY history_id DESC
+    ''')
+    kept_days = set()
+    evicted = []
+    for index, row in enumerate(cursor.fetchall()):
+        day = str(row['created_at'])[:10]
+        if index >= keep_recent and (row['expired'] or day in kept_days):
+            evicted.append(row['checkpoint_id'])
+        else:
+            kept_days.add(day)
+    if evicted:
+        cursor.executemany(f'DELETE FROM inventory_checkpoints WHERE checkpoint_id = {placeholder}',
+                           [(checkpoint_id,) for checkpoint_id in evicted])
+        db.commit()
+        for checkpoint_id in evicted:
+            checkpoint_cache.discard(checkpoint_id)
+    return len(evicted)
+
+def take_scheduled_checkpoint(db, min_interval=CHECKPOINT_INTERVAL_SECONDS):
+    """
+    生成检查点并清理旧检查点。自上个检查点以来没有新的历史记录，或者min_interval秒内
+    已经生成过（例如其他gunicorn worker刚生成）时跳过，返回None
+    """
+    cursor = get_cursor(db)
+    cursor.execute(f'''
+        SELECT
+            {latest_history_id_sql()} AS latest_history_id,
+            (SELECT MAX(history_id) FROM inventory_checkpoints) AS checkpoint_history_id,
+            (SELECT COUNT(*) FROM inventory_checkpoints
+             WHERE created_at > {sql_seconds_ago(min_interval)}) AS recent_count
+    ''')
+    state = cursor.fetchone()
+    if state['checkpoint_history_id'] is not None and (
+            state['checkpoint_history_id'] >= (state['latest_history_id'] or 0) or state['recent_count']):
+        return None
+    checkpoint = create_inventory_checkpoint(db)
+    checkpoint['pruned'] = prune_inventory_checkpoints(db)
+    return checkpoint
+
+# 每个进程一个后台线程定时生成检查点并归档旧的历史记录（首次处理请求时启动）
+class CheckpointScheduler:
+    def __init__(self, interval):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._runs = 0
+        self._last_run = None
+        self._last_result = None
+        self._last_error = None
+
+    def ensure_started(self):
+        # gunicorn fork出的worker需要各自启动线程
+        pid = os.getpid()
+        if self._interval <= 0 or self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            threading.Thread(target=self._loop, name='inventory-checkpoint', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self._interval)
+            self.run_once()
+
+    def run_once(self):
+        with app.app_context():
+            db = get_db()
+            try:
+                result = take_scheduled_checkpoint(db, self._interval)
+                error = None
+                if result:
+                    print(f"已生成库存检查点: history_id {result['history_id']}，{result['row_count']} 行，"
+                          f"{result['size']} 字节，清理 {result['pruned']} 个旧检查点")
+                # 检查点之后顺便归档已结束的旧月份（没有需要归档的记录时只有一次索引查询）
+                if HISTORY_ARCHIVE_AFTER_DAYS > 0:
+                    archived = archive_history()
+                    if archived:
+                        print(f"已归档历史记录: {archived}")
+            except Exception as e:
+                print(f"生成库存检查点或归档历史记录时出错: {str(e)}")
+                db.rollback()
+                result, error = None, str(e)
+        with self._lock:
+            self._runs += 1
+            self._last_run = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            self._last_result = result
+            self._last_error = error
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval_seconds': self._interval,
+                'running': self._pid == os.getpid(),
+                'runs': self._runs,
+                'last_run': self._last_run,
+                'last_result': self._last_result,
+                'last_error': self._last_error
+            }
+
+checkpoint_scheduler = CheckpointScheduler(CHECKPOINT_INTERVAL_SECONDS)
+
+@app.before_request
+def start_checkpoint_scheduler():
+    checkpoint_scheduler.ensure_started()
+
+@app.route('/api/metrics/checkpoints', methods=['GET'])
+def checkpoint_metrics():
+    cursor = get_cursor(get_db())
+    cursor.execute('''
+        SELECT COUNT(*) AS checkpoint_count, MAX(history_id) AS latest_history_id,
+               SUM(LENGTH(payload)) AS payload_bytes
+        FROM inventory_checkpoints
+    ''')
+    row = cursor.fetchone()
+    return jsonify({
+        'checkpoint_count': row['checkpoint_count'],
+        'latest_history_id': row['latest_history_id'],
+        'payload_bytes': row['payload_bytes'] or 0,
+        'keep_recent': CHECKPOINT_KEEP_RECENT,
+        'keep_days': CHECKPOINT_KEEP_DAYS,
+        'scheduler': checkpoint_scheduler.stats()
+    })
+
+# 历史归档：早于HISTORY_ARCHIVE_AFTER_DAYS天的整月历史记录移出热表input_history（0表示不自动归档）。
+# PostgreSQL归档到按月分区的input_history_archive表；SQLite归档到附加的归档库，每月一张表
+HISTORY_ARCHIVE_AFTER_DAYS = int(os.getenv('HISTORY_ARCHIVE_AFTER_DAYS', '90'))
+# 每个写事务移动的记录数，避免长时间占用写锁
+HISTORY_ARCHIVE_CHUNK_SIZE = int(os.getenv('HISTORY_ARCHIVE_CHUNK_SIZE', '5000'))
+HISTORY_COLUMNS = ('history_id, bin_code, item_code, customer_po, BT, box_count, pieces_per_box, '
+                   'total_pieces, input_time, input_date')
+
+def latest_history_id_sql():
+    """最大history_id的SQL表达式（包括已归档的记录，热表为空时也不会倒退）"""
+    greatest = 'GREATEST' if is_postgresql() else 'MAX'
+    return (f'{greatest}(COALESCE((SELECT MAX(history_id) FROM input_history), 0), '
+            f'COALESCE((SELECT MAX(last_history_id) FROM history_archive_months), 0))')
+
+def month_bounds(month):
+    """'YYYY-MM' -> (当月第一天, 下月第一天)"""
+    year, month_number = int(month[:4]), int(month[5:7])
+    if month_number == 12:
+        return f'{year:04d}-12-01', f'{year + 1:04d}-01-01'
+    return f'{year:04d}-{month_number:02d}-01', f'{year:04d}-{month_number + 1:02d}-01'
+
+def archive_table_name(month):
+    return 'input_history_' + month.replace('-', '')
+
+def history_source(cursor, start_date=None, end_date=None, since_history_id=None):
+    """
+    历史记录查询的FROM子句：热表加上与日期范围 [start_date, end_date]（本地日期）有重叠、
+    并且包含大于since_history_id记录的归档月份，用UNION ALL合并成名为input_history的子查询。
+    没有需要合并的归档时直接返回 input_history
+    """
+    cursor.execute('SELECT month, last_history_id FROM history_archive_months ORDER BY month')
+    months = [row for row in cursor.fetchall()
+              if (start_date is None or row['month'] >= start_date[:7])
+              and (end_date is None or row['month'] <= end_date[:7])
+              and (since_history_id is None or row['last_history_id'] > since_history_id)]
+    if not months:
+        return 'input_history'
+    parts = [f'SELECT {HISTORY_COLUMNS} FROM input_history']
+    if is_postgresql():
+        # 外层的input_date条件会下推到分区表，只扫描相关月份
+        parts.append(f'SELECT {HISTORY_COLUMNS} FROM input_history_archive')
+    else:
+        # 只读取目录中已确认移出热表的记录（归档中断时归档表里可能多出尚未从热表删除的副本）
+        parts.extend(f"SELECT {HISTORY_COLUMNS} FROM archive.{archive_table_name(row['month'])} "
+                     f"WHERE history_id <= {int(row['last_history_id'])}" for row in months)
+    return '(' + ' UNION ALL '.join(parts) + ') input_history'
+
+def create_history_archive_table(cursor, month):
+    start, end = month_bounds(month)
+    table = archive_table_name(month)
+    if is_postgresql():
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} PARTITION OF input_history_archive
+            FOR VALUES FROM ('{start}') TO ('{end}')
+        ''')
+        return
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS archive.{table} (
+            history_id INTEGER PRIMARY KEY,
+            bin_code TEXT NOT NULL,
+            item_code TEXT NOT NULL,
+            customer_po TEXT,
+            BT TEXT,
+            box_count INTEGER NOT NULL,
+            pieces_per_box INTEGER NOT NULL,
+            total_pieces INTEGER NOT NULL,
+            input_time TIMESTAMP,
+            input_date TEXT
+        )
+    ''')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS archive.idx_{table}_date ON {table} (input_date, input_time)')
+
+def archive_history_month(month):
+    """分批把一个月的历史记录从热表移到归档，返回移动的记录数"""
+    start, end = month_bounds(month)
+    placeholder = get_placeholder()
+    cursor = get_cursor(get_db())
+    cursor.execute(f'''
+        SELECT MIN(history_id) AS first_id, MAX(history_id) AS last_id FROM input_history
+        WHERE input_date >= {placeholder} AND input_date < {placeholder}
+    ''', (start, end))
+    bounds = cursor.fetchone()
+    if bounds['last_id'] is None:
+        return 0
+    run_write(lambda cursor: create_history_archive_table(cursor, month))
+    
+    if is_postgresql():
+        target = 'INSERT INTO input_history_archive'
+    else:
+        # 复制中断后重新归档时覆盖已复制的记录
+        target = f'INSERT OR REPLACE INTO archive.{archive_table_name(month)}'
+    selection = f'''
+        FROM input_history
+        WHERE input_date >= {placeholder} AND input_date < {placeholder}
+          AND history_id > {placeholder} AND history_id <= {placeholder}
+    '''
+    
+    def copy_chunk(cursor, after_id):
+        # 本批最后一条记录：按主键顺序数HISTORY_ARCHIVE_CHUNK_SIZE条
+        cursor.execute(f'''
+            SELECT history_id FROM input_history
+            WHERE history_id > {placeholder} AND history_id <= {placeholder}
+            ORDER BY history_id LIMIT 1 OFFSET {placeholder}
+        ''', (after_id, bounds['last_id'], HISTORY_ARCHIVE_CHUNK_SIZE - 1))
+        row = cursor.fetchone()
+        chunk = (after_id, row['history_id'] if row else bounds['last_id'])
+        cursor.execute(f'{target} ({HISTORY_COLUMNS}) SELECT {HISTORY_COLUMNS} {selection}', (start, end) + chunk)
+        return chunk
+    
+    def remove_chunk(cursor, chunk):
+        cursor.execute(f'DELETE {selection}', (start, end) + chunk)
+        row_count = cursor.rowcount
+        cursor.execute(f'''
+            INSERT INTO history_archive_months (month, first_history_id, last_history_id, row_count)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder})
+            ON CONFLICT (month) DO UPDATE SET
+                last_history_id = excluded.last_history_id,
+                row_count = history_archive_months.row_count + excluded.row_count,
+                archived_at = CURRENT_TIMESTAMP
+        ''', (month, bounds['first_id'], chunk[1], row_count))
+        return row_count
+    
+    moved = 0
+    chunk = (bounds['first_id'] - 1, bounds['first_id'] - 1)
+    while chunk[1] < bounds['last_id']:
+        after_id = chunk[1]
+        if is_postgresql():
+            # 复制和删除在同一个事务中
+            def move_chunk(cursor):
+                chunk = copy_chunk(cursor, after_id)
+                return chunk, remove_chunk(cursor, chunk)
+            chunk, row_count = run_write(move_chunk)
+        else:
+            # WAL模式下附加库与主库之间的事务不保证原子性：先复制到归档库并提交，
+            # 再从热表删除并更新目录；两步之间中断时归档中多出的副本不会被查询到，下次归档时覆盖
+            chunk = run_write(lambda cursor: copy_chunk(cursor, after_id))
+            row_count = run_write(lambda cursor: remove_chunk(cursor, chunk))
+        moved += row_count
+    return moved
+
+def history_archive_cutoff(after_days=HISTORY_ARCHIVE_AFTER_DAYS):
+    """早于该日期（本地日期，所在月份的第一天）的整月记录可以归档"""
+    return (datetime.now() - timedelta(days=after_days)).strftime('%Y-%m-01')
+
+def archive_history(after_days=HISTORY_ARCHIVE_AFTER_DAYS):
+    """归档早于after_days天的所有整月历史记录，返回 {月份: 移动的记录数}"""
+    cursor = get_cursor(get_db())
+    placeholder = get_placeholder()
+    month_column = "to_char(input_date, 'YYYY-MM')" if is_postgresql() else 'substr(input_date, 1, 7)'
+    cursor.execute(f'''
+        SELECT DISTINCT {month_column} AS month FROM input_history
+        WHERE input_date < {placeholder}
+        ORDER BY month
+    ''', (history_archive_cutoff(after_days),))
+    months = [row['month'] for row in cursor.fetchall()]
+    return {month: archive_history_month(month) for month in months}
+
+@app.route('/api/history/archive', methods=['POST'])
+def run_history_archive():
+    """立即归档旧的历史记录（after_days默认为HISTORY_ARCHIVE_AFTER_DAYS）"""
+    data = request.get_json(silent=True) or {}
+    try:
+        after_days = int(data.get('after_days', HISTORY_ARCHIVE_AFTER_DAYS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'after_days必须是整数', 'error_en': 'after_days must be an integer'}), 400
+    if after_days < 0:
+        return jsonify({'error': 'after_days不能为负数', 'error_en': 'after_days must not be negative'}), 400
+    try:
+        archived = archive_history(after_days)
+    except Exception as e:
+        print(f"归档历史记录时出错: {str(e)}")
+        print(f"错误详情: {traceback.format_exc()}")
+        get_db().rollback()
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'success': True, 'archived': archived, 'row_count': sum(archived.values())})
+
+@app.route('/api/history/archive', methods=['GET'])
+def list_history_archive():
+    cursor = get_cursor(get_db())
+    cursor.execute('''
+        SELECT month, first_history_id, last_history_id, row_count, archived_at
+        FROM history_archive_months
+        ORDER BY month
+    ''')
+    months = [dict(row) for row in cursor.fetchall()]
+    cursor.execute('SELECT COUNT(*) AS row_count, MIN(input_date) AS oldest_date FROM input_history')
+    hot = cursor.fetchone()
+    return jsonify({
+        'months': months,
+        'hot_row_count': hot['row_count'],
+        'hot_oldest_date': str(hot['oldest_date']) if hot['oldest_date'] else None,
+        'after_days': HISTORY_ARCHIVE_AFTER_DAYS
+    })
+
 @app.route('/api/inventory/bin/<bin_id>', methods=['GET'])
+@conditional_get(data_version_etag)
+@cached_response
 def get_bin_inventory(bin_id):
     db = get_db()
-    cursor = db.cursor()
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
     
     # 先通过库位编号获取库位ID
-    cursor.execute('SELECT bin_id FROM bins WHERE bin_code = ?', (bin_id,))
+    cursor.execute(f'SELECT bin_id FROM bins WHERE bin_code = {placeholder}', (bin_id,))
     bin_result = cursor.fetchone()
     
     if not bin_result:
         return jsonify({'error': '库位不存在', 'error_en': 'Bin location does not exist', 'inventory': []}), 404
     
+    as_of, error_response = get_as_of()
+    if error_response:
+        return error_response
+    
     # 按商品分组，保持PO和BT的对应关系
-    cursor.execute('''
-        WITH item_inventory AS (
-            SELECT 
-                i.item_code,
-                inv.customer_po,
-                inv.BT,
-                inv.pieces_per_box,
-                SUM(inv.box_count) as box_count,
-                SUM(inv.total_pieces) as total_pieces
-            FROM inventory inv
-            JOIN items i ON inv.item_id = i.item_id
-            WHERE inv.bin_id = ?
-            GROUP BY i.item_code, inv.customer_po, inv.BT, inv.pieces_per_box
-        ),
-        item_summary AS (
-            SELECT
-                item_code,
-                customer_po,
-                BT,
-                SUM(total_pieces) as po_bt_total_pieces,
-                GROUP_CONCAT(box_count || 'x' || pieces_per_box) as po_bt_box_details
-            FROM item_inventory
-            GROUP BY item_code, customer_po, BT
-        )
-        SELECT 
-            item_code,
-            SUM(po_bt_total_pieces) as total_pieces,
-            GROUP_CONCAT(
-                CASE 
-                    WHEN customer_po IS NOT NULL AND BT IS NOT NULL THEN customer_po || '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                    WHEN customer_po IS NOT NULL THEN customer_po || '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                    WHEN BT IS NOT NULL THEN '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                    ELSE '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                END
-            ) as po_bt_details
-        FROM item_summary
-        GROUP BY item_code
-        ORDER BY item_code
-    ''', (bin_result['bin_id'],))
-    
-    inventory = []
-    for row in cursor.fetchall():
-        item_info = {
-            'item_code': row['item_code'],
-            'total_pieces': row['total_pieces'],
-            'total_boxes': 0,  # 将在后面计算
-            'po_bt_groups': [],
-            'box_details': []
-        }
-        
-        # 解析PO-BT对应关系
-        if row['po_bt_details']:
-            details = row['po_bt_details'].split(',')
-            for detail in details:
-                parts = detail.split('|')
-                if len(parts) >= 4:
-                    customer_po = parts[0] if parts[0] else None
-                    BT = parts[1] if parts[1] else None
-                    pieces = int(parts[2]) if parts[2] else 0
-                    box_details_str = parts[3] if parts[3] else ''
-                    
-                    # 解析这个PO-BT组合的箱规
-                    group_box_details = []
-                    if box_details_str:
-                        box_details_list = box_details_str.split(',') if ',' in box_details_str else [box_details_str]
-                        for box_detail in box_details_list:
-                            if 'x' in box_detail:
-                                box_count, pieces_per_box = box_detail.split('x')
-                                group_box_details.append({
-                    'box_count': int(box_count),
-                                    'pieces_per_box': int(pieces_per_box)
-                                })
-                    
-                    item_info['po_bt_groups'].append({
-                        'customer_po': customer_po,
-                        'BT': BT,
-                        'pieces': pieces,
-                        'box_details': group_box_details
-                    })
-        
-        # 合并所有箱规到总的box_details中，同时计算总箱数
-        all_box_details = {}
-        total_boxes = 0
-        for group in item_info['po_bt_groups']:
-            for box_detail in group['box_details']:
-                key = f"{box_detail['pieces_per_box']}"
-                if key not in all_box_details:
-                    all_box_details[key] = {'box_count': 0, 'pieces_per_box': box_detail['pieces_per_box']}
-                all_box_details[key]['box_count'] += box_detail['box_count']
-                total_boxes += box_detail['box_count']
-        
-        item_info['box_details'] = list(all_box_details.values())
-        item_info['total_boxes'] = total_boxes
-        inventory.append(item_info)
-    
-    return jsonify(inventory)
+    if as_of:
+        rows = fetch_inventory_groups_as_of(cursor, ['item_code'], 'bin_code', bin_id, as_of)
+    else:
+        rows = fetch_inventory_groups(cursor, ['item_code'], 'inv.bin_id = ?', (bin_result['bin_id'],))
+    return jsonify(build_inventory_entries(rows, 'item_code'))
 
 @app.route('/api/inventory/locations/<item_id>', methods=['GET'])
+@conditional_get(data_version_etag)
+@cached_response
 def get_item_locations(item_id):
     db = get_db()
-    cursor = db.cursor()
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
     
     item_id = item_id.replace('___SLASH___', '/').replace('___SPACE___', ' ')
     
-    cursor.execute('SELECT item_id FROM items WHERE item_code = ?', (item_id,))
+    cursor.execute(f'SELECT item_id FROM items WHERE item_code = {placeholder}', (item_id,))
     item_result = cursor.fetchone()
     
     if not item_result:
         # 商品不存在，返回空结果
         return jsonify({'locations': []})
     
+    as_of, error_response = get_as_of()
+    if error_response:
+        return error_response
+    
     # 按库位分组，保持PO和BT的对应关系
-    cursor.execute('''
-        WITH location_inventory AS (
-            SELECT 
-                b.bin_code,
-                inv.customer_po,
-                inv.BT,
-                inv.pieces_per_box,
-                SUM(inv.box_count) as box_count,
-                SUM(inv.total_pieces) as total_pieces
-            FROM inventory inv
-            JOIN bins b ON inv.bin_id = b.bin_id
-            WHERE inv.item_id = ?
-            GROUP BY b.bin_code, inv.customer_po, inv.BT, inv.pieces_per_box
-        ),
-        location_summary AS (
-            SELECT
-                bin_code,
-                customer_po,
-                BT,
-                SUM(total_pieces) as po_bt_total_pieces,
-                GROUP_CONCAT(box_count || 'x' || pieces_per_box) as po_bt_box_details
-            FROM location_inventory
-            GROUP BY bin_code, customer_po, BT
-        )
-        SELECT 
-            bin_code,
-            SUM(po_bt_total_pieces) as total_pieces,
-            GROUP_CONCAT(
-                CASE 
-                    WHEN customer_po IS NOT NULL AND BT IS NOT NULL THEN customer_po || '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                    WHEN customer_po IS NOT NULL THEN customer_po || '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                    WHEN BT IS NOT NULL THEN '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                    ELSE '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                END
-            ) as po_bt_details
-        FROM location_summary
-        GROUP BY bin_code
-        ORDER BY bin_code
-    ''', (item_result['item_id'],))
-    
-    locations = []
-    for row in cursor.fetchall():
-        location_info = {
-            'bin_code': row['bin_code'],
-            'total_pieces': row['total_pieces'],
-            'total_boxes': 0,  # 将在后面计算
-            'po_bt_groups': [],
-            'box_details': []
-        }
-        
-        # 解析PO-BT对应关系
-        if row['po_bt_details']:
-            details = row['po_bt_details'].split(',')
-            for detail in details:
-                parts = detail.split('|')
-                if len(parts) >= 4:
-                    customer_po = parts[0] if parts[0] else None
-                    BT = parts[1] if parts[1] else None
-                    pieces = int(parts[2]) if parts[2] else 0
-                    box_details_str = parts[3] if parts[3] else ''
-                    
-                    # 解析这个PO-BT组合的箱规
-                    group_box_details = []
-                    if box_details_str:
-                        box_details_list = box_details_str.split(',') if ',' in box_details_str else [box_details_str]
-                        for box_detail in box_details_list:
-                            if 'x' in box_detail:
-                                box_count, pieces_per_box = box_detail.split('x')
-                                group_box_details.append({
-                    'box_count': int(box_count),
-                                    'pieces_per_box': int(pieces_per_box)
-                                })
-                    
-                    location_info['po_bt_groups'].append({
-                        'customer_po': customer_po,
-                        'BT': BT,
-                        'pieces': pieces,
-                        'box_details': group_box_details
-                    })
-        
-        # 合并所有箱规到总的box_details中，同时计算总箱数
-        all_box_details = {}
-        total_boxes = 0
-        for group in location_info['po_bt_groups']:
-            for box_detail in group['box_details']:
-                key = f"{box_detail['pieces_per_box']}"
-                if key not in all_box_details:
-                    all_box_details[key] = {'box_count': 0, 'pieces_per_box': box_detail['pieces_per_box']}
-                all_box_details[key]['box_count'] += box_detail['box_count']
-                total_boxes += box_detail['box_count']
-        
-        location_info['box_details'] = list(all_box_details.values())
-        location_info['total_boxes'] = total_boxes
-        locations.append(location_info)
-    
-    return jsonify(locations)
+    if as_of:
+        rows = fetch_inventory_groups_as_of(cursor, ['bin_code'], 'item_code', item_id, as_of)
+    else:
+        rows = fetch_inventory_groups(cursor, ['bin_code'], 'inv.item_id = ?', (item_result['item_id'],))
+    return jsonify(build_inventory_entries(rows, 'bin_code'))
+
+# 紧凑格式的BT/PO查询结果：不在服务器端展开为商品-库位-PO/BT的嵌套结构，直接返回分组行，由客户端组装
+INVENTORY_GROUP_COLUMNS = ['item_code', 'bin_code', 'customer_po', 'BT', 'pieces_per_box', 'box_count', 'total_pieces']
+INVENTORY_GROUP_STRING_COLUMNS = ['item_code', 'bin_code', 'customer_po', 'BT']
+
+def compact_inventory_response(key, value, rows, as_of):
+    response = {
+        key: value,
+        'format': 'compact',
+        'total_items': len({row['item_code'] for row in rows}),
+        'total_pieces': sum(row['total_pieces'] for row in rows),
+        'total_boxes': sum(row['box_count'] for row in rows),
+        'rows': compact_table(rows, INVENTORY_GROUP_COLUMNS, INVENTORY_GROUP_STRING_COLUMNS)
+    }
+    if as_of:
+        response['as_of'] = as_of
+    return response
 
 @app.route('/api/inventory/BT/<BT>', methods=['GET'])
+@conditional_get(data_version_etag)
+@cached_response
 def get_BT_inventory(BT):
     db = get_db()
-    cursor = db.cursor()
+    cursor = get_cursor(db)
     
     BT = BT.replace('___SLASH___', '/').replace('___SPACE___', ' ')
     
-    # 按商品分组，每个商品下按库位分组，保持PO和BT的对应关系
-    cursor.execute('''
-        WITH bt_inventory AS (
-            SELECT 
-                i.item_code,
-                b.bin_code,
-                inv.customer_po,
-                inv.BT,
-                inv.pieces_per_box,
-                SUM(inv.box_count) as box_count,
-                SUM(inv.total_pieces) as total_pieces
-            FROM inventory inv
-            JOIN items i ON inv.item_id = i.item_id
-            JOIN bins b ON inv.bin_id = b.bin_id
-            WHERE inv.BT = ?
-            GROUP BY i.item_code, b.bin_code, inv.customer_po, inv.BT, inv.pieces_per_box
-        ),
-        location_summary AS (
-            SELECT
-                item_code,
-                bin_code,
-                customer_po,
-                BT,
-                SUM(total_pieces) as po_bt_total_pieces,
-                GROUP_CONCAT(box_count || 'x' || pieces_per_box) as po_bt_box_details
-            FROM bt_inventory
-            GROUP BY item_code, bin_code, customer_po, BT
-        ),
-        item_location_summary AS (
-            SELECT 
-                item_code,
-                bin_code,
-                SUM(po_bt_total_pieces) as total_pieces,
-                GROUP_CONCAT(
-                    CASE 
-                        WHEN customer_po IS NOT NULL AND BT IS NOT NULL THEN customer_po || '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                        WHEN customer_po IS NOT NULL THEN customer_po || '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                        WHEN BT IS NOT NULL THEN '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                        ELSE '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                    END
-                ) as po_bt_details
-            FROM location_summary
-            GROUP BY item_code, bin_code
-        )
-        SELECT 
-            item_code,
-            SUM(total_pieces) as item_total_pieces,
-            GROUP_CONCAT(bin_code || '||' || total_pieces || '||' || po_bt_details, '|||') as location_details
-        FROM item_location_summary
-        GROUP BY item_code
-        ORDER BY item_code
-    ''', (BT,))
+    as_of, error_response = get_as_of()
+    if error_response:
+        return error_response
     
-    results = cursor.fetchall()
-    
-    if not results:
-        return jsonify({
-            'BT': BT,
-            'total_items': 0,
-            'total_pieces': 0,
-            'total_boxes': 0,
-            'items': []
-        })
-    
-    # 按商品分组整理数据
-    items_list = []
-    total_pieces = 0
-    total_boxes = 0
-    
-    for row in results:
-        item_info = {
-            'item_code': row['item_code'],
-            'total_pieces': row['item_total_pieces'],
-            'total_boxes': 0,  # 将在后面计算
-            'locations': []
-        }
-        
-        # 解析location详情
-        if row['location_details']:
-            location_groups = row['location_details'].split('|||')
-            for location_group in location_groups:
-                if location_group:
-                    parts = location_group.split('||')
-                    if len(parts) >= 3:
-                        bin_code = parts[0]
-                        location_pieces = int(parts[1])
-                        po_bt_details = parts[2]
-                        
-                        location_info = {
-                            'bin_code': bin_code,
-                            'total_pieces': location_pieces,
-                            'total_boxes': 0,  # 将在后面计算
-                            'po_bt_groups': []
-                        }
-                        
-                        # 解析PO-BT对应关系
-                        if po_bt_details:
-                            details = po_bt_details.split(',')
-                            for detail in details:
-                                detail_parts = detail.split('|')
-                                if len(detail_parts) >= 4:
-                                    customer_po = detail_parts[0] if detail_parts[0] else None
-                                    bt = detail_parts[1] if detail_parts[1] else None
-                                    pieces = int(detail_parts[2]) if detail_parts[2] else 0
-                                    box_details_str = detail_parts[3] if detail_parts[3] else ''
-                                    
-                                    # 解析这个PO-BT组合的箱规
-                                    group_box_details = []
-                                    group_total_boxes = 0
-                                    if box_details_str:
-                                        box_details_list = box_details_str.split(',') if ',' in box_details_str else [box_details_str]
-                                        for box_detail in box_details_list:
-                                            if 'x' in box_detail:
-                                                box_count, pieces_per_box = box_detail.split('x')
-                                                box_count = int(box_count)
-                                                group_box_details.append({
-                                                    'box_count': box_count,
-                                                    'pieces_per_box': int(pieces_per_box)
-                                                })
-                                                group_total_boxes += box_count
-                                    
-                                    location_info['po_bt_groups'].append({
-                                        'customer_po': customer_po,
-                                        'BT': bt,
-                                        'pieces': pieces,
-                                        'total_boxes': group_total_boxes,
-                                        'box_details': group_box_details
-                                    })
-                                    
-                                    location_info['total_boxes'] += group_total_boxes
-                        
-                        item_info['locations'].append(location_info)
-                        item_info['total_boxes'] += location_info['total_boxes']
-        
-        items_list.append(item_info)
-        total_pieces += item_info['total_pieces']
-        total_boxes += item_info['total_boxes']
+    # 按商品分组，每个商品下按库位分组，保持PO和BT的对应关系
+    if as_of:
+        rows = fetch_inventory_groups_as_of(cursor, ['item_code', 'bin_code'], 'BT', BT, as_of)
+    else:
+        rows = fetch_inventory_groups(cursor, ['item_code', 'bin_code'], 'inv.BT = ?', (BT,))
+    if compact_requested():
+        return jsonify(compact_inventory_response('BT', BT, rows, as_of))
+    items_list = build_item_location_entries(rows)
     
-    return jsonify({
+    response = {
         'BT': BT,
         'total_items': len(items_list),
-        'total_pieces': total_pieces,
-        'total_boxes': total_boxes,
+        'total_pieces': sum(item['total_pieces'] for item in items_list),
+        'total_boxes': sum(item['total_boxes'] for item in items_list),
         'items': items_list
-    })
+    }
+    if as_of:
+        response['as_of'] = as_of
+    return jsonify(response)
 
 @app.route('/api/BTs', methods=['GET'])
+@conditional_get(search_index_etag(bt_value_index))
 def get_BTs():
-    db = get_db()
-    cursor = db.cursor()
-    
     search_term = request.args.get('search', '').strip()
-    
-    if not search_term:
-        # 如果没有搜索词，返回所有BT
-        cursor.execute('''
-            SELECT DISTINCT BT 
-            FROM inventory 
-            WHERE BT IS NOT NULL AND BT != ''
-            ORDER BY BT
-        ''')
-    else:
-        # 如果有搜索词，进行模糊搜索
-        search_pattern = f'%{search_term}%'
-        cursor.execute('''
-            SELECT DISTINCT BT 
-            FROM inventory 
-            WHERE BT IS NOT NULL 
-            AND BT != '' 
-            AND BT LIKE ?
-            ORDER BY BT
-        ''', (search_pattern,))
-    
-    BTs = []
-    for row in cursor.fetchall():
-        BTs.append({
-            'BT': row['BT']
-        })
-    
+    ensure_search_index(bt_value_index)
+    BTs = [{'BT': BT} for _, BT in bt_value_index.search(search_term, limit=10)]
     return jsonify(BTs)
 
 @app.route('/api/inventory/PO/<PO>', methods=['GET'])
+@conditional_get(data_version_etag)
+@cached_response
 def get_PO_inventory(PO):
     db = get_db()
-    cursor = db.cursor()
+    cursor = get_cursor(db)
     
     PO = PO.replace('___SLASH___', '/').replace('___SPACE___', ' ')
     
-    # 按商品分组，每个商品下按库位分组，保持PO和BT的对应关系
-    cursor.execute('''
-        WITH po_inventory AS (
-            SELECT 
-                i.item_code,
-                b.bin_code,
-                inv.customer_po,
-                inv.BT,
-                inv.pieces_per_box,
-                SUM(inv.box_count) as box_count,
-                SUM(inv.total_pieces) as total_pieces
-            FROM inventory inv
-            JOIN items i ON inv.item_id = i.item_id
-            JOIN bins b ON inv.bin_id = b.bin_id
-            WHERE inv.customer_po = ?
-            GROUP BY i.item_code, b.bin_code, inv.customer_po, inv.BT, inv.pieces_per_box
-        ),
-        location_summary AS (
-            SELECT
-                item_code,
-                bin_code,
-                customer_po,
-                BT,
-                SUM(total_pieces) as po_bt_total_pieces,
-                GROUP_CONCAT(box_count || 'x' || pieces_per_box) as po_bt_box_details
-            FROM po_inventory
-            GROUP BY item_code, bin_code, customer_po, BT
-        ),
-        item_location_summary AS (
-            SELECT 
-                item_code,
-                bin_code,
-                SUM(po_bt_total_pieces) as total_pieces,
-                GROUP_CONCAT(
-                    CASE 
-                        WHEN customer_po IS NOT NULL AND BT IS NOT NULL THEN customer_po || '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                        WHEN customer_po IS NOT NULL THEN customer_po || '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                        WHEN BT IS NOT NULL THEN '|' || BT || '|' || po_bt_total_pieces || '|' || po_bt_box_details
-                        ELSE '||' || po_bt_total_pieces || '|' || po_bt_box_details
-                    END
-                ) as po_bt_details
-            FROM location_summary
-            GROUP BY item_code, bin_code
-        )
-        SELECT 
-            item_code,
-            SUM(total_pieces) as item_total_pieces,
-            GROUP_CONCAT(bin_code || '||' || total_pieces || '||' || po_bt_details, '|||') as location_details
-        FROM item_location_summary
-        GROUP BY item_code
-        ORDER BY item_code
-    ''', (PO,))
-    
-    results = cursor.fetchall()
+    as_of, error_response = get_as_of()
+    if error_response:
+        return error_response
     
-    if not results:
-        return jsonify({
-            'PO': PO,
-            'total_items': 0,
-            'total_pieces': 0,
-            'total_boxes': 0,
-            'items': []
-        })
-    
-    # 按商品分组整理数据
-    items_list = []
-    total_pieces = 0
-    total_boxes = 0
-    
-    for row in results:
-        item_info = {
-            'item_code': row['item_code'],
-            'total_pieces': row['item_total_pieces'],
-            'total_boxes': 0,  # 将在后面计算
-            'locations': []
-        }
-        
-        # 解析location详情
-        if row['location_details']:
-            location_groups = row['location_details'].split('|||')
-            for location_group in location_groups:
-                if location_group:
-                    parts = location_group.split('||')
-                    if len(parts) >= 3:
-                        bin_code = parts[0]
-                        location_pieces = int(parts[1])
-                        po_bt_details = parts[2]
-                        
-                        location_info = {
-                            'bin_code': bin_code,
-                            'total_pieces': location_pieces,
-                            'total_boxes': 0,  # 将在后面计算
-                            'po_bt_groups': []
-                        }
-                        
-                        # 解析PO-BT对应关系
-                        if po_bt_details:
-                            details = po_bt_details.split(',')
-                            for detail in details:
-                                detail_parts = detail.split('|')
-                                if len(detail_parts) >= 4:
-                                    customer_po = detail_parts[0] if detail_parts[0] else None
-                                    bt = detail_parts[1] if detail_parts[1] else None
-                                    pieces = int(detail_parts[2]) if detail_parts[2] else 0
-                                    box_details_str = detail_parts[3] if detail_parts[3] else ''
-                                    
-                                    # 解析这个PO-BT组合的箱规
-                                    group_box_details = []
-                                    group_total_boxes = 0
-                                    if box_details_str:
-                                        box_details_list = box_details_str.split(',') if ',' in box_details_str else [box_details_str]
-                                        for box_detail in box_details_list:
-                                            if 'x' in box_detail:
-                                                box_count, pieces_per_box = box_detail.split('x')
-                                                box_count = int(box_count)
-                                                group_box_details.append({
-                                                    'box_count': box_count,
-                                                    'pieces_per_box': int(pieces_per_box)
-                                                })
-                                                group_total_boxes += box_count
-                                    
-                                    location_info['po_bt_groups'].append({
-                                        'customer_po': customer_po,
-                                        'BT': bt,
-                                        'pieces': pieces,
-                                        'total_boxes': group_total_boxes,
-                                        'box_details': group_box_details
-                                    })
-                                    
-                                    location_info['total_boxes'] += group_total_boxes
-                        
-                        item_info['locations'].append(location_info)
-                        item_info['total_boxes'] += location_info['total_boxes']
-        
-        items_list.append(item_info)
-        total_pieces += item_info['total_pieces']
-        total_boxes += item_info['total_boxes']
+    # 按商品分组，每个商品下按库位分组，保持PO和BT的对应关系
+    if as_of:
+        rows = fetch_inventory_groups_as_of(cursor, ['item_code', 'bin_code'], 'customer_po', PO, as_of)
+    else:
+        rows = fetch_inventory_groups(cursor, ['item_code', 'bin_code'], 'inv.customer_po = ?', (PO,))
+    if compact_requested():
+        return jsonify(compact_inventory_response('PO', PO, rows, as_of))
+    items_list = build_item_location_entries(rows)
     
-    return jsonify({
+    response = {
         'PO': PO,
         'total_items': len(items_list),
-        'total_pieces': total_pieces,
-        'total_boxes': total_boxes,
+        'total_pieces': sum(item['total_pieces'] for item in items_list),
+        'total_boxes': sum(item['total_boxes'] for item in items_list),
         'items': items_list
-    })
+    }
+    if as_of:
+        response['as_of'] = as_of
+    return jsonify(response)
 
 @app.route('/api/POs', methods=['GET'])
+@conditional_get(search_index_etag(po_value_index))
 def get_POs():
-    db = get_db()
-    cursor = db.cursor()
-    
     search_term = request.args.get('search', '').strip()
+    ensure_search_index(po_value_index)
+    POs = [{'PO': PO} for _, PO in po_value_index.search(search_term, limit=10)]
+    return jsonify(POs)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# 导出格式：xlsx为默认格式，csv/parquet/arrow供机器读取（不做单元格格式和合并）
+EXPORT_MIMETYPES = {
+    'xlsx': XLSX_MIMETYPE,
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file'
+}
+
+# 数值列（Excel中使用number/count格式的列），在Parquet/Arrow中为整数类型
+NUMERIC_EXPORT_FORMATS = ('number', 'count')
+
+# 导出列定义：(标题, 列宽, 格式名)，Excel/CSV/Parquet/Arrow共用同一组列
+ITEMS_EXPORT_COLUMNS = [
+    ('Item Code', 20, 'item'),
+    ('Total Quantity', 15, 'number'),
+    ('Total Boxes', 12, 'number'),
+    ('Bin Locations', 40, 'bin'),
+    ('Customer PO', 20, 'customer_po'),
+    ('BT', 30, 'bt')
+]
+
+BINS_EXPORT_COLUMNS = [
+    ('Bin Location', 15, 'bin'),
+    ('Item Code', 20, 'item'),
+    ('Customer PO', 15, 'customer_po'),
+    ('BT Number', 18, 'bt'),
+    ('Box Count', 12, 'number'),
+    ('Pieces per Box', 12, 'number'),
+    ('Total Pieces', 12, 'number')
+]
+
+PO_EXPORT_COLUMNS = [
+    ('Customer PO', 15, 'customer_po'),
+    ('Item Code', 20, 'item'),
+    ('Bin Code', 15, 'bin'),
+    ('BT Number', 12, 'bt'),
+    ('Boxes in Bin', 12, 'number'),
+    ('Pieces per Box', 12, 'number'),
+    ('Pieces in Bin', 12, 'number'),
+    ('Item Total in PO', 15, 'number')
+]
+
+# 导出时每次从游标读取的行数
+EXPORT_FETCH_SIZE = 1000
+
+def iter_cursor_rows(cursor, size=EXPORT_FETCH_SIZE):
+    """分批从游标读取数据，避免fetchall把整个结果集载入内存"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
+
+def add_export_formats(workbook):
+    """导出Excel通用的单元格格式（与前端各字段颜色保持一致）"""
+    def cell_format(**options):
+        return workbook.add_format({'align': 'center', 'valign': 'vcenter', **options})
     
-    if not search_term:
-        # 如果没有搜索词，返回所有PO
-        cursor.execute('''
-            SELECT DISTINCT customer_po 
-            FROM inventory 
-            WHERE customer_po IS NOT NULL AND customer_po != ''
-            ORDER BY customer_po
-        ''')
-    else:
-        # 如果有搜索词，进行模糊搜索
-        search_pattern = f'%{search_term}%'
-        cursor.execute('''
-            SELECT DISTINCT customer_po 
-            FROM inventory 
-            WHERE customer_po IS NOT NULL 
-            AND customer_po != '' 
-            AND customer_po LIKE ?
-            ORDER BY customer_po
-        ''', (search_pattern,))
-    
-    POs = []
-    for row in cursor.fetchall():
-        POs.append({
-            'PO': row['customer_po']
-        })
+    return {
+        'header': cell_format(bold=True, bg_color='#f8f9fa'),
+        'item': cell_format(font_color='#2962ff'),         # 蓝色
+        'bin': cell_format(font_color='#e67e22'),          # 橙色
+        'customer_po': cell_format(font_color='#ff5722'),  # 橘红色
+        'bt': cell_format(font_color='#9c27b0'),           # 紫色
+        'number': cell_format(font_color='#27ae60'),       # 绿色
+        'count': cell_format(num_format='#,##0', font_color='#27ae60'),
+        'time': cell_format(num_format='yyyy-mm-dd hh:mm:ss', font_color='#666666')  # 灰色
+    }
+
+class XlsxStreamWriter:
+    """
+    按行顺序写出工作表数据（配合constant_memory模式，已写出的行会立即落盘）。
     
-    return jsonify(POs)
+    constant_memory模式下不能回头修改已写出的行，所以merge_range无法在整组写完后调用；
+    纵向合并时merge_range会先写到合并区域的最后一行，中间各行的其他列也就无法再写入。
+    需要合并单元格的导出按最外层分组缓冲一组数据：整组按行写出（合并列只在首行写值，
+    其余行写带格式的空白单元格），再登记合并区域。内存中最多只保留一组数据。
+    
+    合并区域登记在worksheet.merge中（merge_range内部使用的列表，写文件时输出为mergeCells），
+    依赖xlsxwriter的内部结构，因此requirements.txt中固定了xlsxwriter的版本。
+    同一列的合并区域互不相交，不同列的区域不在同一列，不会出现merge_range检查的重叠。
+    """
+    
+    def __init__(self, worksheet, columns, header_format, merge_keys=None):
+        # columns: [(标题, 列宽, 格式)]
+        # merge_keys: {列号: 取合并键的函数}，相邻行合并键相同则合并该列
+        if merge_keys and not isinstance(getattr(worksheet, 'merge', None), list):
+            raise RuntimeError(f'xlsxwriter {xlsxwriter.__version__} 不支持按行写出合并单元格，'
+                               f'请安装requirements.txt中指定的版本')
+        self.worksheet = worksheet
+        self.formats = [column_format for _, _, column_format in columns]
+        self.merge_keys = merge_keys or {}
+        self.row_num = 1
+        self.group = []
+        self.group_key = None
+        
+        # constant_memory模式下列格式必须在写入数据之前设置
+        for col, (_, width, column_format) in enumerate(columns):
+            worksheet.set_column(col, col, width, column_format)
+        for col, (header, _, _) in enumerate(columns):
+            worksheet.write(0, col, header, header_format)
+    
+    def write_row(self, values, group_key=None):
+        if not self.merge_keys:
+            self._write_values(values)
+            return
+        
+        if self.group and group_key != self.group_key:
+            self.flush_group()
+        self.group_key = group_key
+        self.group.append(values)
+    
+    def flush_group(self):
+        if not self.group:
+            return
+        
+        spans = {col: [] for col in self.merge_keys}
+        previous_keys = {}
+        for values in self.group:
+            merged_cols = set()
+            for col, key_func in self.merge_keys.items():
+                key = key_func(values)
+                if col in previous_keys and previous_keys[col] == key:
+                    # 与上一行属于同一合并区域
+                    spans[col][-1][1] = self.row_num
+                    merged_cols.add(col)
+                else:
+                    spans[col].append([self.row_num, self.row_num])
+                previous_keys[col] = key
+            self._write_values(values, merged_cols)
+        
+        for col, col_spans in spans.items():
+            for start_row, end_row in col_spans:
+                if end_row > start_row:
+                    # 单元格已经按行写出，这里只登记合并区域（与merge_range记录的内容一致）
+                    self.worksheet.merge.append([start_row, col, end_row, col])
+        
+        self.group = []
+    
+    def close(self):
+        self.flush_group()
+        return self.row_num - 1
+    
+    def _write_values(self, values, blank_cols=()):
+        for col, value in enumerate(values):
+            if col in blank_cols:
+                self.worksheet.write_blank(self.row_num, col, None, self.formats[col])
+            else:
+                self.worksheet.write(self.row_num, col, value, self.formats[col])
+        self.row_num += 1
+
+def send_xlsx_export(download_name, write_workbook):
+    """
+    在临时文件中以constant_memory模式生成工作簿，再以文件流返回。
+    临时文件没有文件名（关闭即删除），send_file直接透传文件对象时也不会残留。
+    write_workbook(workbook) 负责添加工作表并写入数据。
+    """
+    output = tempfile.TemporaryFile(prefix='inventory-export-', suffix='.xlsx')
+    try:
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+        try:
+            write_workbook(workbook)
+        finally:
+            workbook.close()
+        output.seek(0)
+    except Exception:
+        output.close()
+        raise
+    
+    return send_file(
+        output,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=download_name
+    )
+
+def get_export_format():
+    """读取format参数并检查是否支持，返回 (格式, 错误响应)"""
+    export_format = request.args.get('format', 'xlsx').strip().lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return export_format, (jsonify({
+            'error': f'不支持的导出格式 {export_format}',
+            'error_en': f'Unsupported export format {export_format}'
+        }), 400)
+    if export_format in ('parquet', 'arrow') and not PYARROW_AVAILABLE:
+        return export_format, (jsonify({
+            'error': f'服务器未安装pyarrow，无法导出{export_format}格式',
+            'error_en': f'pyarrow is not installed on the server, cannot export {export_format}'
+        }), 501)
+    return export_format, None
+
+def xlsx_columns(columns, formats):
+    """把导出列定义中的格式名换成工作簿中的格式对象"""
+    return [(header, width, formats[format_name]) for header, width, format_name in columns]
+
+def iter_chunks(rows, size=EXPORT_FETCH_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            break
+        yield chunk
+
+def send_csv_export(download_name, columns, rows):
+    """逐行生成CSV并以流的方式返回，每EXPORT_FETCH_SIZE行输出一次"""
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([header for header, _, _ in columns])
+        for chunk in iter_chunks(rows):
+            writer.writerows(chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype=EXPORT_MIMETYPES['csv'],
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+    )
+
+def send_arrow_export(download_name, export_format, columns, rows):
+    """按批写入Parquet/Arrow文件（每批EXPORT_FETCH_SIZE行），再以文件流返回"""
+    schema = pyarrow.schema([
+        (header, pyarrow.int64() if format_name in NUMERIC_EXPORT_FORMATS else pyarrow.string())
+        for header, _, format_name in columns
+    ])
+    output = tempfile.TemporaryFile(prefix='inventory-export-', suffix=f'.{export_format}')
+    try:
+        if export_format == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(output, schema)
+        else:
+            writer = pyarrow.ipc.new_file(output, schema)
+        try:
+            for chunk in iter_chunks(rows):
+                writer.write_batch(pyarrow.RecordBatch.from_arrays([
+                    pyarrow.array(values, type=field.type)
+                    for values, field in zip(zip(*chunk), schema)
+                ], schema=schema))
+        finally:
+            writer.close()
+        output.seek(0)
+    except Exception:
+        output.close()
+        raise
+    
+    return send_file(
+        output,
+        mimetype=EXPORT_MIMETYPES[export_format],
+        as_attachment=True,
+        download_name=download_name
+    )
+
+def send_export(export_format, filename, columns, rows, write_workbook):
+    """
+    按format参数返回导出文件。rows为按列顺序排列的行数据迭代器；
+    xlsx格式由write_workbook(workbook, rows)负责写入（含格式和合并单元格）。
+    """
+    download_name = f'{filename}.{export_format}'
+    if export_format == 'csv':
+        return send_csv_export(download_name, columns, rows)
+    if export_format in ('parquet', 'arrow'):
+        return send_arrow_export(download_name, export_format, columns, rows)
+    return send_xlsx_export(download_name, lambda workbook: write_workbook(workbook, rows))
+
+# 后台导出任务：线程数、结果文件目录，以及数据变更后旧结果保留多久（秒）供发起者下载
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '2'))
+EXPORT_JOB_DIR = os.getenv('EXPORT_JOB_DIR') or os.path.join(tempfile.gettempdir(), 'inventory-export-jobs')
+EXPORT_JOB_STALE_SECONDS = int(os.getenv('EXPORT_JOB_STALE_SECONDS', '600'))
+
+# 后台导出任务队列：导出在线程池中执行，不占用处理请求的线程。
+# 结果文件按 (导出路径, 参数, 数据版本) 缓存，
+# 下一次库存写入后不再复用旧结果，旧结果文件在EXPORT_JOB_STALE_SECONDS后删除
+class ExportJobQueue:
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._jobs = {}
+        self._cached = {}  # (路径, 参数, 数据版本) -> job_id
+
+    def _ensure_process(self):
+        # gunicorn fork出的worker不能复用父进程的线程池
+        pid = os.getpid()
+        if self._pid != pid:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers,
+                                                thread_name_prefix='export-job')
+            self._jobs = {}
+            self._cached = {}
+            self._pid = pid
+
+    def submit(self, endpoint, view_args, path, query_args):
+        """提交导出任务；相同数据版本下已有相同导出时直接返回该任务"""
+        version = data_version()
+        key = (path, tuple(sorted(query_args)), version)
+        with self._lock:
+            self._ensure_process()
+            self._expire(version)
+            job_id = self._cached.get(key)
+            if job_id is not None:
+                return dict(self._jobs[job_id])
+            
+            job = {
+                'job_id': uuid.uuid4().hex,
+                'status': 'queued',
+                'path': path,
+                'version': version,
+                'created_at': time.time(),
+                'finished_at': None
+            }
+            self._jobs[job['job_id']] = job
+            self._cached[key] = job['job_id']
+            self._executor.submit(self._run, job, key, endpoint, view_args, query_args)
+            return dict(job)
+
+    def cached_result(self, path, query_args):
+        """当前数据版本下已完成的相同导出任务，没有则返回None"""
+        version = data_version()
+        with self._lock:
+            self._ensure_process()
+            self._expire(version)
+            job_id = self._cached.get((path, tuple(sorted(query_args)), version))
+            job = self._jobs.get(job_id)
+            return dict(job) if job and job['status'] == 'done' else None
+
+    def get(self, job_id):
+        with self._lock:
+            self._ensure_process()
+            self._expire(data_version())
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _run(self, job, key, endpoint, view_args, query_args):
+        with self._lock:
+            job['status'] = 'running'
+        result = {}
+        try:
+            # 在模拟的请求上下文中调用原导出路由，生成的文件与同步导出完全一致
+            with app.test_request_context(job['path'], query_string=query_args):
+                response = app.make_response(app.view_functions[endpoint](**view_args))
+                try:
+                    if response.status_code != 200:
+                        body = response.get_json(silent=True) or {}
+                        result = {
+                            'status': 'failed',
+                            'error': body.get('error', f'导出失败 (HTTP {response.status_code})'),
+                            'error_en': body.get('error_en', f'Export failed (HTTP {response.status_code})')
+                        }
+                    else:
+                        os.makedirs(EXPORT_JOB_DIR, exist_ok=True)
+                        file_path = os.path.join(EXPORT_JOB_DIR, job['job_id'])
+                        with open(file_path, 'wb') as f:
+                            for chunk in response.iter_encoded():
+                                f.write(chunk)
+                        result = {
+                            'status': 'done',
+                            'file_path': file_path,
+                            'mimetype': response.mimetype,
+                            'content_disposition': response.headers.get('Content-Disposition')
+                        }
+                finally:
+                    response.close()
+        except Exception as e:
+            print(f"导出任务 {job['job_id']} 失败: {str(e)}")
+            print(traceback.format_exc())
+            result = {'status': 'failed', 'error': f'导出失败: {str(e)}', 'error_en': f'Export failed: {str(e)}'}
+        
+        with self._lock:
+            job.update(result, finished_at=time.time())
+            if job['status'] == 'failed' and self._cached.get(key) == job['job_id']:
+                # 失败的任务不缓存，下次重新导出
+                del self._cached[key]
+
+    def _expire(self, version):
+        # 调用方需持有self._lock
+        now = time.time()
+        for key in list(self._cached):
+            if key[2] != version:
+                del self._cached[key]
+        for job_id, job in list(self._jobs.items()):
+            if job['finished_at'] is None or job_id in self._cached.values():
+                continue
+            if now - job['finished_at'] > EXPORT_JOB_STALE_SECONDS:
+                del self._jobs[job_id]
+                if job.get('file_path'):
+                    try:
+                        os.remove(job['file_path'])
+                    except OSError:
+                        pass
+
+export_jobs = ExportJobQueue(EXPORT_JOB_WORKERS)
+
+def format_export_job(job):
+    result = {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at']
+    }
+    if job['status'] == 'done':
+        result['download_url'] = f"/api/export/jobs/{job['job_id']}/download"
+    elif job['status'] == 'failed':
+        result['error'] = job['error']
+        result['error_en'] = job['error_en']
+    return result
+
+def send_export_job_file(job):
+    try:
+        response = send_file(job['file_path'], mimetype=job['mimetype'])
+    except FileNotFoundError:
+        return None
+    if job['content_disposition']:
+        response.headers['Content-Disposition'] = job['content_disposition']
+    return response
+
+def export_job_route(view):
+    """
+    导出路由加上 async=1 参数时改为提交后台任务，立即返回任务ID（202）。
+    同步导出时如果当前数据版本下已有相同导出的结果文件，直接返回该文件。
+    """
+    @wraps(view)
+    def wrapper(**view_args):
+        query_args = [(name, value) for name, value in request.args.items(multi=True) if name != 'async']
+        if request.args.get('async', '').lower() not in ('1', 'true'):
+            job = export_jobs.cached_result(request.path, query_args)
+            response = send_export_job_file(job) if job else None
+            return response or view(**view_args)
+        job = export_jobs.submit(request.endpoint, view_args, request.path, query_args)
+        return jsonify(format_export_job(job)), 202
+    return wrapper
+
+@app.route('/api/export/jobs/<job_id>', methods=['GET'])
+def get_export_job(job_id):
+    job = export_jobs.get(job_id)
+    if not job:
+        return jsonify({
+            'error': '导出任务不存在或已过期',
+            'error_en': 'Export job not found or expired'
+        }), 404
+    return jsonify(format_export_job(job))
+
+@app.route('/api/export/jobs/<job_id>/download', methods=['GET'])
+def download_export_job(job_id):
+    job = export_jobs.get(job_id)
+    if not job:
+        return jsonify({
+            'error': '导出任务不存在或已过期',
+            'error_en': 'Export job not found or expired'
+        }), 404
+    if job['status'] != 'done':
+        return jsonify(format_export_job(job)), 409
+    
+    response = send_export_job_file(job)
+    if response is None:
+        return jsonify({
+            'error': '导出任务不存在或已过期',
+            'error_en': 'Export job not found or expired'
+        }), 404
+    return response
+
+def split_distinct_values(value):
+    """拆分GROUP_CONCAT结果，移除空值/NULL并保持顺序去重"""
+    if not value:
+        return ''
+    parts = [part.strip() for part in value.split(',')]
+    return ', '.join(dict.fromkeys(part for part in parts if part and part != 'None'))
 
 @app.route('/api/export/items', methods=['GET'])
+@export_job_route
 def export_items():
+    export_format, error_response = get_export_format()
+    if error_response:
+        return error_response
+    
     db = get_db()
     cursor = db.cursor()
     
-    # 使用迭代器而不是一次性获取所有数据
     cursor.execute('''
         WITH merged_locations AS (
             SELECT 
@@ -1231,7 +3339,7 @@ def export_items():
                 inv.BT,
                 SUM(inv.total_pieces) as bin_total,
                 SUM(inv.box_count) as bin_boxes
-            FROM inventory inv
+            FROM inventory_summary inv
             JOIN items i ON inv.item_id = i.item_id
             JOIN bins b ON inv.bin_id = b.bin_id
             GROUP BY i.item_code, b.bin_code, inv.customer_po, inv.BT
@@ -1248,117 +3356,36 @@ def export_items():
         ORDER BY item_code
     ''')
     
-    # 使用生成器创建数据
-    def generate_rows():
-        while True:
-            rows = cursor.fetchmany(1000)  # 每次获取1000行
-            if not rows:
-                break
-            for row in rows:
-                # 处理客户订单号列表，移除NULL值并去重
-                customer_po_list = row['customer_po_list'] if row['customer_po_list'] else ''
-                if customer_po_list:
-                    # 分割、去重、过滤空值
-                    customer_po_items = [po.strip() for po in customer_po_list.split(',') if po.strip() and po.strip() != 'None']
-                    customer_po_items = list(set(customer_po_items))  # 去重
-                    customer_po_list = ', '.join(customer_po_items)
-                
-                # 处理BT列表，移除NULL值并去重
-                bt_list = row['BT_list'] if row['BT_list'] else ''
-                if bt_list:
-                    # 分割、去重、过滤空值
-                    bt_items = [bt.strip() for bt in bt_list.split(',') if bt.strip() and bt.strip() != 'None']
-                    bt_items = list(set(bt_items))  # 去重
-                    bt_list = ', '.join(bt_items)
-                
-                # 创建包含处理后数据的行
-                processed_row = {
-                    'Item Code': row['item_code'],
-                    'Total Quantity': row['total_quantity'],
-                    'Total Boxes': row['total_boxes'],
-                    'Bin Locations': row['bin_locations'],
-                    'Customer PO': customer_po_list,
-                    'BT': bt_list
-                }
-                yield processed_row
-    
-    # 创建DataFrame，使用迭代器
-    df = pd.DataFrame(generate_rows(), columns=['Item Code', 'Total Quantity', 'Total Boxes', 'Bin Locations', 'Customer PO', 'BT'])
+    rows = (format_item_export_row(row) for row in iter_cursor_rows(cursor))
     
-    # 创建Excel文件
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='Items Inventory', index=False)
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Items Inventory']
-        
-        # 设置列宽
-        worksheet.set_column('A:A', 20)  # Item Code
-        worksheet.set_column('B:B', 15)  # Total Quantity
-        worksheet.set_column('C:C', 12)  # Total Boxes
-        worksheet.set_column('D:D', 40)  # Bin Locations
-        worksheet.set_column('E:E', 20)  # Customer PO
-        worksheet.set_column('F:F', 30)  # BT
-        
-        # 定义格式
-        item_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#2962ff'  # 蓝色
-        })
-        
-        number_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#27ae60'  # 绿色
-        })
-        
-        bin_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#e67e22'  # 橙色
-        })
-        
-        customer_po_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#ff5722'  # 橘红色
-        })
-        
-        bt_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#9c27b0'  # 紫色
-        })
-        
-        # 应用格式到整列
-        worksheet.set_column('A:A', 20, item_format)   # Item Code
-        worksheet.set_column('B:B', 15, number_format) # Total Quantity
-        worksheet.set_column('C:C', 12, number_format) # Total Boxes
-        worksheet.set_column('D:D', 40, bin_format)    # Bin Locations
-        worksheet.set_column('E:E', 20, customer_po_format) # Customer PO
-        worksheet.set_column('F:F', 30, bt_format)     # BT
-        
-        # 设置标题行格式
-        header_format = workbook.add_format({
-            'bold': True,
-            'align': 'center',
-            'valign': 'vcenter',
-            'bg_color': '#f8f9fa'
-        })
-        worksheet.set_row(0, None, header_format)
+    def write_workbook(workbook, rows):
+        formats = add_export_formats(workbook)
+        writer = XlsxStreamWriter(workbook.add_worksheet('Items Inventory'),
+                                  xlsx_columns(ITEMS_EXPORT_COLUMNS, formats), formats['header'])
+        for values in rows:
+            writer.write_row(values)
+        writer.close()
     
-    output.seek(0)
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name= f'Items-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    )
+    filename = f'Items-{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+    return send_export(export_format, filename, ITEMS_EXPORT_COLUMNS, rows, write_workbook)
+
+def format_item_export_row(row):
+    return [
+        row['item_code'],
+        row['total_quantity'],
+        row['total_boxes'],
+        row['bin_locations'],
+        split_distinct_values(row['customer_po_list']),
+        split_distinct_values(row['BT_list'])
+    ]
 
 @app.route('/api/export/bins', methods=['GET'])
+@export_job_route
 def export_bins():
+    export_format, error_response = get_export_format()
+    if error_response:
+        return error_response
+    
     db = get_db()
     cursor = db.cursor()
     
@@ -1373,186 +3400,452 @@ def export_bins():
             inv.pieces_per_box,
             SUM(inv.total_pieces) as total_pieces
         FROM bins b
-        LEFT JOIN inventory inv ON b.bin_id = inv.bin_id
+        LEFT JOIN inventory_summary inv ON b.bin_id = inv.bin_id
         LEFT JOIN items i ON inv.item_id = i.item_id
         GROUP BY b.bin_code, i.item_code, inv.customer_po, inv.BT, inv.box_count, inv.pieces_per_box
         ORDER BY b.bin_code, i.item_code, inv.customer_po, inv.BT, inv.box_count, inv.pieces_per_box
     ''')
     
-    bins_data = cursor.fetchall()
+    rows = (format_bin_export_row(row) for row in iter_cursor_rows(cursor))
     
-    # 创建DataFrame，包含客户订单号和BT信息
-    df = pd.DataFrame(bins_data, columns=['Bin Location', 'Item Code', 'Customer PO', 'BT Number', 'Box Count', 'Pieces per Box', 'Total Pieces'])
-    
-    # 创建Excel文件
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='Bins Inventory', index=False)
-        
-        workbook = writer.book
-        worksheet = writer.sheets['Bins Inventory']
-        
-        # 设置列宽
-        worksheet.set_column('A:A', 15)  # Bin Location
-        worksheet.set_column('B:B', 20)  # Item Code
-        worksheet.set_column('C:C', 15)  # Customer PO
-        worksheet.set_column('D:D', 18)  # BT Number
-        worksheet.set_column('E:G', 12)  # Box Count, Pieces per Box, Total Pieces
-        
-        # 定义格式
-        bin_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#e67e22'  # 橙色
-        })
-        
-        item_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#2962ff'  # 蓝色
-        })
-        
-        customer_po_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#ff5722'  # 橘红色
-        })
-        
-        BT_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#9c27b0'  # 紫色
-        })
-        
-        number_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#27ae60'  # 绿色
-        })
-        
-        # 应用格式到整列
-        worksheet.set_column('A:A', 15, bin_format)    # Bin Location
-        worksheet.set_column('B:B', 20, item_format)   # Item Code
-        worksheet.set_column('C:C', 15, customer_po_format) # Customer PO
-        worksheet.set_column('D:D', 18, BT_format) # BT Number
-        worksheet.set_column('E:G', 12, number_format) # Box Count, Pieces per Box, Total Pieces
-        
+    def write_workbook(workbook, rows):
+        formats = add_export_formats(workbook)
         # 合并相同库位的单元格
-        current_bin = None
-        start_row = 1  # 从第二行开始（跳过标题行）
-        
-        for row in range(1, len(df) + 1):
-            bin_loc = df.iloc[row-1]['Bin Location'] if row <= len(df) else None
-            
-            if current_bin != bin_loc:
-                if current_bin is not None and row - start_row > 1:
-                    # 合并前一个库位的单元格
-                    worksheet.merge_range(f'A{start_row+1}:A{row}', current_bin, bin_format)
-                current_bin = bin_loc
-                start_row = row
-        
-        # 处理最后一组
-        if start_row < len(df) and row - start_row > 0:
-            worksheet.merge_range(f'A{start_row+1}:A{len(df)+1}', current_bin, bin_format)
-        
-        # 设置标题行格式
-        header_format = workbook.add_format({
-            'bold': True,
-            'align': 'center',
-            'valign': 'vcenter',
-            'bg_color': '#f8f9fa'
-        })
-        worksheet.set_row(0, None, header_format)
+        writer = XlsxStreamWriter(workbook.add_worksheet('Bins Inventory'),
+                                  xlsx_columns(BINS_EXPORT_COLUMNS, formats), formats['header'],
+                                  merge_keys={0: lambda values: values[0]})
+        for values in rows:
+            writer.write_row(values, group_key=values[0])
+        writer.close()
     
-    output.seek(0)
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name= f'Bins-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    )
+    filename = f'Bins-{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+    return send_export(export_format, filename, BINS_EXPORT_COLUMNS, rows, write_workbook)
+
+def format_bin_export_row(row):
+    return [
+        row['bin_code'],
+        row['item_code'],
+        row['customer_po'],
+        row['BT'],
+        row['box_count'],
+        row['pieces_per_box'],
+        row['total_pieces']
+    ]
+
+# 增量日志接口每页默认/最大返回条数
+LOGS_PAGE_LIMIT = 500
+LOGS_PAGE_MAX_LIMIT = 5000
+
+def format_log_row(row):
+    return {
+        'history_id': row['history_id'],
+        'bin_code': row['bin_code'],
+        'item_code': row['item_code'],
+        'customer_po': row['customer_po'],
+        'BT': row['BT'],
+        'box_count': row['box_count'],
+        'pieces_per_box': row['pieces_per_box'],
+        'total_pieces': row['total_pieces'],
+        'timestamp': row['input_time']
+    }
+
+# 紧凑格式（?format=compact）的历史记录列
+LOG_COLUMNS = ['history_id', 'bin_code', 'item_code', 'customer_po', 'BT',
+               'box_count', 'pieces_per_box', 'total_pieces', 'timestamp']
+LOG_STRING_COLUMNS = ['bin_code', 'item_code', 'customer_po', 'BT']
+
+def compact_logs(logs):
+    return compact_table(logs, LOG_COLUMNS, LOG_STRING_COLUMNS)
+
+def resolve_since_time(cursor, since_time):
+    """
+    把时间游标换成history_id游标：返回input_time不早于since_time的第一条记录之前的history_id。
+    同一秒内可能有整批记录，只按时间翻页会漏掉分页边界之后同一秒的记录，所以之后一律按history_id翻页
+    """
+    placeholder = get_placeholder()
+    cursor.execute(f'''
+        SELECT history_id FROM input_history
+        WHERE input_time >= {placeholder}
+        ORDER BY history_id ASC
+        LIMIT 1
+    ''', (since_time,))
+    row = cursor.fetchone()
+    if row:
+        return row['history_id'] - 1
+    cursor.execute('SELECT MAX(history_id) AS max_id FROM input_history')
+    return cursor.fetchone()['max_id'] or 0
+
+def get_logs_since(cursor, since_id, limit):
+    """按history_id游标增量读取历史记录，按history_id升序返回（最多limit条）"""
+    placeholder = get_placeholder()
+    
+    # 多取一条用于判断是否还有下一页
+    cursor.execute(f'''
+        SELECT 
+            history_id,
+            bin_code,
+            item_code,
+            customer_po,
+            BT,
+            box_count,
+            pieces_per_box,
+            total_pieces,
+            input_time
+        FROM input_history
+        WHERE history_id > {placeholder}
+        ORDER BY history_id ASC
+        LIMIT {placeholder}
+    ''', (since_id, limit + 1))
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    return [format_log_row(row) for row in rows[:limit]], has_more
+
+def parse_history_date_range():
+    """
+    读取历史记录的日期过滤参数：date为单日，start_date/end_date为日期范围（包含两端，可只指定一端）。
+    返回 (开始日期, 结束日期, 错误响应)，未指定的一端为None
+    """
+    date_filter = request.args.get('date', '').strip()
+    start_date = request.args.get('start_date', '').strip() or date_filter or None
+    end_date = request.args.get('end_date', '').strip() or date_filter or None
+    for value in (start_date, end_date):
+        try:
+            if value is not None:
+                datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return None, None, (jsonify({
+                'error': '日期格式错误，应为 YYYY-MM-DD',
+                'error_en': 'Invalid date, expected YYYY-MM-DD'
+            }), 400)
+    return start_date, end_date, None
+
+def history_date_filter(start_date, end_date):
+    """按本地日期过滤历史记录的条件和参数（使用input_date索引）"""
+    placeholder = get_placeholder()
+    conditions = []
+    params = []
+    if start_date:
+        conditions.append(f'input_date >= {placeholder}')
+        params.append(start_date)
+    if end_date:
+        conditions.append(f'input_date <= {placeholder}')
+        params.append(end_date)
+    return conditions, params
+
+def logs_etag():
+    # history_id的最小/最大值走主键索引，历史新增、清空都会改变它们
+    # （MIN和MAX写在同一个SELECT里时SQLite会扫描整个索引，分成两个标量子查询才各自只读一端）
+    cursor = get_cursor(get_db())
+    cursor.execute('''
+        SELECT (SELECT MIN(history_id) FROM input_history) AS min_id,
+               (SELECT MAX(history_id) FROM input_history) AS max_id
+    ''')
+    row = cursor.fetchone()
+    return f"h{row['min_id'] or 0}-{row['max_id'] or 0}"
 
 @app.route('/api/logs', methods=['GET'])
+@conditional_get(logs_etag)
 def get_logs():
     db = get_db()
-    cursor = db.cursor()
+    cursor = get_cursor(db)
     
-    # 检查是否有日期过滤参数
-    date_filter = request.args.get('date', '').strip()
+    # 增量游标参数：since_id为继续翻页的游标；since_time只用于第一次请求，换算成对应的history_id
+    since_id = request.args.get('since_id', '').strip()
+    since_time = request.args.get('since_time', '').strip()
+    try:
+        since_id = int(since_id) if since_id else None
+        limit = int(request.args.get('limit', LOGS_PAGE_LIMIT))
+    except ValueError:
+        return jsonify({'error': '参数格式错误', 'error_en': 'Invalid cursor or limit'}), 400
+    limit = max(1, min(limit, LOGS_PAGE_MAX_LIMIT))
     
-    if date_filter:
-        # 如果有日期过滤，只返回指定日期的记录
-        cursor.execute('''
-            SELECT 
-                bin_code,
-                item_code,
-                            customer_po,
-                            BT,
-                            box_count,
-                            pieces_per_box,
-                            total_pieces,
-                            input_time
-                        FROM input_history
-                        WHERE DATE(datetime(input_time, 'localtime')) = ?
-                        ORDER BY input_time DESC
-                    ''', (date_filter,))
+    if since_id is not None or since_time:
+        # 历史表被清空后（history_id重新计数），通知客户端丢弃本地缓存重新同步
+        cursor.execute(f'SELECT {latest_history_id_sql()} AS max_id')
+        max_id = cursor.fetchone()['max_id'] or 0
+        if since_id is not None and since_id > max_id:
+            return jsonify({
+                'logs': [],
+                'next_since_id': 0,
+                'has_more': False,
+                'reset': True
+            })
+        
+        if since_time:
+            since_id = max(since_id or 0, resolve_since_time(cursor, since_time))
+        logs, has_more = get_logs_since(cursor, since_id, limit)
+        return jsonify({
+            'logs': compact_logs(logs) if compact_requested() else logs,
+            'next_since_id': logs[-1]['history_id'] if logs else since_id,
+            'has_more': has_more,
+            'reset': False
+        })
+    
+    start_date, end_date, error_response = parse_history_date_range()
+    if error_response:
+        return error_response
+    
+    if start_date or end_date:
+        # 按日期过滤时合并日期范围内已归档的月份
+        conditions, params = history_date_filter(start_date, end_date)
+        where_clause = f"WHERE {' AND '.join(conditions)}"
+        source = history_source(cursor, start_date, end_date)
     else:
-        # 否则返回所有记录
-        cursor.execute('''
-            SELECT 
-                bin_code,
-                item_code,
-                customer_po,
-                BT,
+        # 否则只返回热表中最新的limit条记录（走主键索引；更多记录用since_id游标或日期范围查询）
+        where_clause, params = '', [limit]
+        source = f'''(
+            SELECT * FROM input_history ORDER BY history_id DESC LIMIT {get_placeholder()}
+        ) input_history'''
+    
+    cursor.execute(f'''
+        SELECT 
+            history_id,
+            bin_code,
+            item_code,
+            customer_po,
+            BT,
             box_count,
             pieces_per_box,
             total_pieces,
             input_time
-        FROM input_history
-        ORDER BY input_time DESC
-    ''')
+        FROM {source}
+        {where_clause}
+        ORDER BY input_time DESC, history_id DESC
+    ''', params)
     
-    logs = []
-    for row in cursor.fetchall():
-        log_entry = {
-            'bin_code': row['bin_code'],
-            'item_code': row['item_code'],
-            'customer_po': row['customer_po'],
-            'BT': row['BT'],
-            'box_count': row['box_count'],
-            'pieces_per_box': row['pieces_per_box'],
-            'total_pieces': row['total_pieces'],
-            'timestamp': row['input_time']
-        }
-        logs.append(log_entry)
+    logs = [format_log_row(row) for row in cursor.fetchall()]
+    if compact_requested():
+        return jsonify(compact_logs(logs))
     
     return jsonify(logs)
 
+# 历史记录视图：服务器端合并"清空库位并添加"的记录并分页（按history_id降序的游标分页）。
+# 合并规则与前端原先的mergeClearAndAddLogs相同：添加记录吸收其后（更早）HISTORY_MERGE_WINDOW条以内、
+# 同一库位、时间相差不超过HISTORY_MERGE_SECONDS秒、尚未被吸收的清空库位记录
+HISTORY_MERGE_WINDOW = 10
+HISTORY_MERGE_SECONDS = 5
+HISTORY_PAGE_LIMIT = 50
+HISTORY_PAGE_MAX_LIMIT = 500
+
+def history_record_kind(item_code):
+    """旧版本写入的清空记录用商品编号标记：'清空库位'/'清空库位<商品>' 为清空库位，'清空商品<商品>' 为清空商品"""
+    item_code = item_code or ''
+    if item_code == 'Clear Bin' or item_code.startswith('清空库位'):
+        return 'clear_bin'
+    if item_code.startswith('清空商品') or item_code.startswith('Clear Item'):
+        return 'clear_item'
+    return 'add'
+
+def parse_history_time(value):
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+def merge_history_rows(rows, context=()):
+    """
+    rows按history_id降序；context为rows之前（更新）的最多HISTORY_MERGE_WINDOW条记录，
+    只用于判断rows开头的清空记录是否已被上一页的添加记录吸收。
+    返回 [(rows中的位置, 记录, 被吸收的清空记录列表)]，被吸收的记录不单独返回
+    """
+    sequence = list(context) + list(rows)
+    claimed = set()
+    merged = []
+    for index, row in enumerate(sequence):
+        if index in claimed:
+            continue
+        clears = []
+        if history_record_kind(row['item_code']) == 'add':
+            row_time = parse_history_time(row['input_time'])
+            for k in range(index + 1, min(index + 1 + HISTORY_MERGE_WINDOW, len(sequence))):
+                candidate = sequence[k]
+                if k in claimed or candidate['bin_code'] != row['bin_code'] \
+                        or history_record_kind(candidate['item_code']) != 'clear_bin':
+                    continue
+                candidate_time = parse_history_time(candidate['input_time'])
+                if row_time and candidate_time and \
+                        abs((row_time - candidate_time).total_seconds()) <= HISTORY_MERGE_SECONDS:
+                    clears.append(candidate)
+                    claimed.add(k)
+        if index >= len(context):
+            merged.append((index - len(context), row, clears))
+    return merged
+
+def parse_tz_offset():
+    """客户端时区（与JavaScript的getTimezoneOffset相同，单位分钟）；未指定或格式错误时返回None"""
+    try:
+        return int(request.args.get('tz_offset', ''))
+    except ValueError:
+        return None
+
+@app.route('/api/history', methods=['GET'])
+@conditional_get(logs_etag)
+def get_history_page():
+    """
+    合并后的历史记录，按history_id降序分页：before_id为上一页返回的next_before_id，limit为每页记录数。
+    可按日期过滤（date / start_date / end_date）；同时指定tz_offset时按客户端本地日期过滤，
+    否则按服务器本地日期（input_date）过滤。未指定日期时只查询热表
+    """
+    db = get_db()
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
+    try:
+        before_id = request.args.get('before_id', '').strip()
+        before_id = int(before_id) if before_id else None
+        limit = int(request.args.get('limit', HISTORY_PAGE_LIMIT))
+    except ValueError:
+        return jsonify({'error': '参数格式错误', 'error_en': 'Invalid cursor or limit'}), 400
+    limit = max(1, min(limit, HISTORY_PAGE_MAX_LIMIT))
+    start_date, end_date, error_response = parse_history_date_range()
+    if error_response:
+        return error_response
+    
+    tz_offset = parse_tz_offset()
+    if tz_offset is not None and (start_date or end_date):
+        # 客户端本地日期的起止换算为UTC时间（input_time为UTC）
+        conditions, params = [], []
+        if start_date:
+            conditions.append(f'input_time >= {placeholder}')
+            params.append((datetime.strptime(start_date, '%Y-%m-%d') + timedelta(minutes=tz_offset))
+                          .strftime('%Y-%m-%d %H:%M:%S'))
+        if end_date:
+            conditions.append(f'input_time < {placeholder}')
+            params.append((datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1, minutes=tz_offset))
+                          .strftime('%Y-%m-%d %H:%M:%S'))
+        # 按时间换算后的日期可能落在相邻的一天，归档月份的范围各放宽一天
+        source = history_source(
+            cursor,
+            start_date and (datetime.strptime(start_date, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d'),
+            end_date and (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+    elif start_date or end_date:
+        conditions, params = history_date_filter(start_date, end_date)
+        source = history_source(cursor, start_date, end_date)
+    else:
+        conditions, params, source = [], [], 'input_history'
+    
+    def fetch(cursor_condition, order, count):
+        page_conditions = conditions + ([cursor_condition] if cursor_condition else [])
+        where_clause = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ''
+        cursor.execute(f'''
+            SELECT history_id, bin_code, item_code, customer_po, BT AS "BT",
+                   box_count, pieces_per_box, total_pieces, input_time
+            FROM {source}
+            {where_clause}
+            ORDER BY history_id {order}
+            LIMIT {placeholder}
+        ''', params + ([before_id] if cursor_condition else []) + [count])
+        return cursor.fetchall()
+    
+    if before_id is None:
+        context = []
+        rows = fetch(None, 'DESC', limit + HISTORY_MERGE_WINDOW)
+    else:
+        # 上一页末尾的记录：可能吸收了本页开头的清空记录
+        context = fetch(f'history_id >= {placeholder}', 'ASC', HISTORY_MERGE_WINDOW)[::-1]
+        rows = fetch(f'history_id < {placeholder}', 'DESC', limit + HISTORY_MERGE_WINDOW)
+    exhausted = len(rows) < limit + HISTORY_MERGE_WINDOW
+    
+    records = []
+    # 下一页从第一个未返回的记录开始（之前未返回的只有已被吸收的清空记录）
+    next_index = len(rows)
+    for index, row, clears in merge_history_rows(rows, context):
+        # 只返回其后的合并窗口已完整读取的记录
+        if len(records) >= limit or not (exhausted or index < len(rows) - HISTORY_MERGE_WINDOW):
+            next_index = index
+            break
+        record = format_log_row(row)
+        if clears:
+            record['cleared'] = [format_log_row(clear) for clear in clears]
+        records.append(record)
+    
+    return jsonify({
+        'records': records,
+        'next_before_id': rows[next_index - 1]['history_id'] if next_index else before_id,
+        'has_more': next_index < len(rows) or not exhausted
+    })
+
+def parse_event_seq(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_poll_timeout(value):
+    try:
+        timeout = float(value) if value is not None else LONG_POLL_MAX_SECONDS
+    except ValueError:
+        timeout = LONG_POLL_MAX_SECONDS
+    return max(0, min(timeout, LONG_POLL_MAX_SECONDS))
+
+def sse_message(event):
+    return f"id: {event['seq']}\nevent: change\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """SSE推送通道：每次库存写入提交后推送一条精简的变更事件"""
+    # 断线重连时浏览器会带上Last-Event-ID，补发期间错过的事件
+    seq = parse_event_seq(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    if seq is None:
+        seq = change_broadcaster.seq
+    
+    def generate(seq):
+        yield f'retry: 3000\nid: {seq}\n\n'
+        while True:
+            events = change_broadcaster.wait_for_events(seq, SSE_HEARTBEAT_SECONDS)
+            if not events:
+                # 心跳，防止代理断开空闲连接
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                seq = event['seq']
+                yield sse_message(event)
+    
+    return Response(
+        stream_with_context(generate(seq)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/events/poll', methods=['GET'])
+def poll_events():
+    """长轮询通道：不支持SSE的客户端使用，有新事件或超时后返回"""
+    seq = parse_event_seq(request.args.get('since'))
+    if seq is None:
+        # 首次请求只返回当前序号作为游标
+        return jsonify({'seq': change_broadcaster.seq, 'events': []})
+    
+    timeout = parse_poll_timeout(request.args.get('timeout'))
+    events = change_broadcaster.wait_for_events(seq, timeout)
+    return jsonify({
+        'seq': events[-1]['seq'] if events else seq,
+        'events': events
+    })
+
 @app.route('/api/inventory/input', methods=['POST'])
 def input_inventory():
-    try:
-        data = request.json
-        db = get_db()
-        cursor = db.cursor()
-        
+    data = request.json
+    
+    def write(cursor):
         # 获取库位ID
         cursor.execute('SELECT bin_id FROM bins WHERE bin_code = ?', (data['bin_code'],))
         bin_result = cursor.fetchone()
         if not bin_result:
-            return jsonify({'error': '库位不存在', 'error_en': 'Bin location does not exist'}), 404
+            raise WriteRejected('库位不存在', 'Bin location does not exist', 404)
         
         # 获取商品ID
         cursor.execute('SELECT item_id FROM items WHERE item_code = ?', (data['item_code'],))
         item_result = cursor.fetchone()
         if not item_result:
-            return jsonify({'error': '商品不存在', 'error_en': 'Item does not exist'}), 404
+            raise WriteRejected('商品不存在', 'Item does not exist', 404)
         
         # 计算总件数
         total_pieces = data['box_count'] * data['pieces_per_box']
         
         # 检查是否已存在相同商品、库位和箱规的记录
         cursor.execute('''
-            SELECT inventory_id, total_pieces 
+            SELECT inventory_id, total_pieces, customer_po, BT 
             FROM inventory 
             WHERE bin_id = ? AND item_id = ? AND pieces_per_box = ?
         ''', (bin_result['bin_id'], item_result['item_id'], data['pieces_per_box']))
@@ -1567,6 +3860,7 @@ def input_inventory():
                     total_pieces = total_pieces + ?
                 WHERE inventory_id = ?
             ''', (data['box_count'], total_pieces, existing_record['inventory_id']))
+            customer_po, BT = existing_record['customer_po'], existing_record['BT']
         else:
             # 插入新记录
             cursor.execute('''
@@ -1574,6 +3868,9 @@ def input_inventory():
                 VALUES (?, ?, ?, ?, ?)
             ''', (bin_result['bin_id'], item_result['item_id'], 
                   data['box_count'], data['pieces_per_box'], total_pieces))
+            customer_po, BT = None, None
+        apply_inventory_delta(cursor, bin_result['bin_id'], item_result['item_id'], customer_po, BT,
+                              data['pieces_per_box'], data['box_count'], total_pieces)
         
         # 记录输入历史
         cursor.execute('''
@@ -1581,16 +3878,23 @@ def input_inventory():
             VALUES (?, ?, ?, ?, ?)
         ''', (data['bin_code'], data['item_code'], 
               data['box_count'], data['pieces_per_box'], total_pieces))
-        
-        db.commit()
-        return jsonify({'success': True})
-        
+        return customer_po, BT
+    
+    try:
+        customer_po, BT = run_write(write)
+    except WriteRejected as e:
+        return e.response()
     except Exception as e:
         print(f"Error in input_inventory: {str(e)}")
         print(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
+    
+    change_broadcaster.publish('inventory_added', bin_code=data['bin_code'], item_code=data['item_code'],
+                               customer_po=customer_po, BT=BT)
+    return jsonify({'success': True})
 
 @app.route('/api/export/item-details', methods=['GET'])
+@export_job_route
 def export_item_details():
     db = get_db()
     cursor = db.cursor()
@@ -1616,7 +3920,7 @@ def export_item_details():
                 SUM(inv.total_pieces) OVER (
                     PARTITION BY i.item_code
                 ) as total_pieces_all_bins
-            FROM inventory inv
+            FROM inventory_summary inv
             JOIN items i ON inv.item_id = i.item_id
             JOIN bins b ON inv.bin_id = b.bin_id
             WHERE inv.box_count > 0
@@ -1635,190 +3939,180 @@ def export_item_details():
         ORDER BY item_code, bin_code, customer_po, pieces_per_box DESC, box_count DESC
     ''')
     
-    # 使用生成器创建数据
-    def generate_rows():
-        current_item = None
-        current_bin = None
-        rows = []
-        
-        while True:
-            row = cursor.fetchone()
-            if not row:
-                if rows:
-                    yield rows
-                break
-            
-            if current_item != row['item_code']:
-                if rows:
-                    yield rows
-                current_item = row['item_code']
-                current_bin = None
-                rows = []
-            
-            rows.append(row)
+    def write_workbook(workbook):
+        formats = add_export_formats(workbook)
+        item_key = lambda values: values[0]
+        bin_key = lambda values: (values[0], values[1])
+        # 同一商品合并Item Code和Item Total，同一商品同一库位合并Bin Location和Bin Total
+        writer = XlsxStreamWriter(workbook.add_worksheet('Item Details'), [
+            ('Item Code', 20, formats['item']),
+            ('Bin Location', 15, formats['bin']),
+            ('Customer PO', 15, formats['customer_po']),
+            ('BT', 15, formats['bt']),
+            ('Box Count', 12, formats['number']),
+            ('Pieces/Box', 12, formats['number']),
+            ('Total in Box', 12, formats['number']),
+            ('Bin Total', 12, formats['number']),
+            ('Item Total', 12, formats['number'])
+        ], formats['header'], merge_keys={0: item_key, 1: bin_key, 7: bin_key, 8: item_key})
+        
+        for row in iter_cursor_rows(cursor):
+            writer.write_row([
+                row['item_code'],
+                row['bin_code'],
+                row['customer_po'] or '-',
+                row['BT'],
+                row['box_count'],
+                row['pieces_per_box'],
+                row['box_total'],
+                row['bin_total'],
+                row['item_total']
+            ], group_key=row['item_code'])
+        writer.close()
     
-    # 创建Excel文件
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        workbook = writer.book
-        worksheet = workbook.add_worksheet('Item Details')
-        
-        # 设置标题格式
-        header_format = workbook.add_format({
-            'bold': True,
-            'align': 'center',
-            'valign': 'vcenter',
-            'bg_color': '#f8f9fa'
-        })
-        
-        # 设置单元格格式
-        item_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#2962ff'  # 蓝色
-        })
-        bin_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#e67e22'  # 橙色
-        })
-        customer_po_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#ff5722'  # 橘红色
-        })
-        bt_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#9c27b0'  # 紫色
-        })
-        number_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#27ae60'  # 绿色
-        })
-        
-        # 写入标题
-        headers = ['Item Code', 'Bin Location', 'Customer PO', 'BT', 'Box Count', 'Pieces/Box', 
-                  'Total in Box', 'Bin Total', 'Item Total']
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-        
-        # 设置列宽
-        worksheet.set_column('A:A', 20)  # Item Code
-        worksheet.set_column('B:B', 15)  # Bin Location
-        worksheet.set_column('C:C', 15)  # Customer PO
-        worksheet.set_column('D:D', 15)  # BT
-        worksheet.set_column('E:I', 12)  # Numeric columns
-        
-        # 写入数据
-        row_num = 1
-        for group in generate_rows():
-            start_row = row_num
-            current_bin = None
-            bin_start = start_row
-            current_bin_total = None
-            
-            for data in group:
-                worksheet.write(row_num, 0, data['item_code'], item_format)
-                worksheet.write(row_num, 1, data['bin_code'], bin_format)
-                worksheet.write(row_num, 2, data['customer_po'] or '-', customer_po_format)
-                worksheet.write(row_num, 3, data['BT'], bt_format)
-                worksheet.write(row_num, 4, data['box_count'], number_format)
-                worksheet.write(row_num, 5, data['pieces_per_box'], number_format)
-                worksheet.write(row_num, 6, data['box_total'], number_format)
-                
-                # 处理bin_total和bin_code的写入和合并
-                if current_bin != data['bin_code']:
-                    if current_bin is not None and row_num - bin_start > 1:
-                        # 合并前一个bin的单元格
-                        worksheet.merge_range(f'H{bin_start+1}:H{row_num}', 
-                                              current_bin_total, number_format)
-                        worksheet.merge_range(f'B{bin_start+1}:B{row_num}',
-                                              current_bin, bin_format)
-                    current_bin = data['bin_code']
-                    current_bin_total = data['bin_total']
-                    bin_start = row_num
-                    worksheet.write(row_num, 7, current_bin_total, number_format)
-                    worksheet.write(row_num, 1, data['bin_code'], bin_format)
-                else:
-                    # 对于同一个bin的后续行，使用相同的bin_total
-                    worksheet.write(row_num, 7, current_bin_total, number_format)
-                
-                row_num += 1
-            
-            # 处理最后一个bin的合并
-            if row_num - bin_start > 1:
-                worksheet.merge_range(f'H{bin_start+1}:H{row_num}', 
-                                      current_bin_total, number_format)
-                worksheet.merge_range(f'B{bin_start+1}:B{row_num}',
-                                      data['bin_code'], bin_format)
-            elif row_num == bin_start + 1:
-                # 如果只有一行，直接写入而不合并
-                worksheet.write(bin_start, 1, data['bin_code'], bin_format)
-                worksheet.write(bin_start, 7, current_bin_total, number_format)
+    return send_xlsx_export(f'Details-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx', write_workbook)
+
+# 在线备份：每步复制BACKUP_PAGES_PER_STEP页后释放读锁并暂停片刻，备份期间扫码写入不会被阻塞
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '1024'))
+BACKUP_STEP_PAUSE_SECONDS = float(os.getenv('BACKUP_STEP_PAUSE_SECONDS', '0.005'))
+# 其他连接写入会让逐页备份从头开始，超过该次数后改为一次性复制
+BACKUP_MAX_RESTARTS = int(os.getenv('BACKUP_MAX_RESTARTS', '5'))
+BACKUP_CHUNK_SIZE = 1024 * 1024
+
+class BackupRestarted(Exception):
+    pass
+
+def backup_sqlite_database(dest_path, since_history_id=None, database='main'):
+    """
+    用SQLite在线备份API把数据库逐页复制到dest_path，返回备份中最大的history_id。
+    since_history_id不为空时生成增量备份：只保留history_id更大的历史记录（其他表为完整数据），
+    并在backup_info表中记录增量的起点。database='archive'时备份历史归档库（返回None）
+    """
+    source = connect_sqlite()
+    try:
+        for pages in (BACKUP_PAGES_PER_STEP, -1):
+            progress_state = {'remaining': None, 'restarts': 0}
             
-            # 合并item_total - 确保总是显示商品总数量
-            worksheet.merge_range(f'I{start_row+1}:I{row_num}', 
-                                  data['item_total'], number_format)
+            def progress(status, remaining, total):
+                if progress_state['remaining'] is not None and remaining > progress_state['remaining']:
+                    progress_state['restarts'] += 1
+                    if progress_state['restarts'] > BACKUP_MAX_RESTARTS:
+                        raise BackupRestarted()
+                progress_state['remaining'] = remaining
+                time.sleep(BACKUP_STEP_PAUSE_SECONDS)
             
-            # 合并item_code - 确保总是显示商品编码
-            if row_num - start_row > 1:
-                worksheet.merge_range(f'A{start_row+1}:A{row_num}', 
-                                      data['item_code'], item_format)
-            else:
-                # 如果只有一行，确保item_code、bin_total和item_total都正确显示
-                worksheet.write(start_row, 0, data['item_code'], item_format)
-                worksheet.write(start_row, 7, data['bin_total'], number_format)
-                worksheet.write(start_row, 8, data['item_total'], number_format)
+            dest = sqlite3.connect(dest_path)
+            try:
+                source.backup(dest, pages=pages, progress=progress if pages > 0 else None, name=database)
+                break
+            except BackupRestarted:
+                print(f"备份期间数据库被修改 {progress_state['restarts']} 次，改为一次性复制")
+            finally:
+                dest.close()
+    finally:
+        source.close()
     
-    output.seek(0)
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name= f'Details-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    )
+    if database != 'main':
+        return None
+    dest = sqlite3.connect(dest_path)
+    try:
+        if since_history_id is not None:
+            dest.execute('DELETE FROM input_history WHERE history_id <= ?', (since_history_id,))
+            dest.execute('DELETE FROM inventory_checkpoints WHERE history_id <= ?', (since_history_id,))
+            dest.execute('''
+                CREATE TABLE backup_info (
+                    since_history_id INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            dest.execute('INSERT INTO backup_info (since_history_id) VALUES (?)', (since_history_id,))
+            dest.commit()
+            dest.execute('VACUUM')
+        return dest.execute('SELECT MAX(history_id) FROM input_history').fetchone()[0] or since_history_id or 0
+    finally:
+        dest.close()
+
+def stream_backup_file(path, compress=False):
+    """分块读取备份文件（可选gzip压缩），读完后删除文件"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(BACKUP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunk = compressor.compress(chunk) if compressor else chunk
+                if chunk:
+                    yield chunk
+        if compressor:
+            yield compressor.flush()
+    finally:
+        os.remove(path)
 
 @app.route('/api/export/database', methods=['GET'])
 def export_database():
+    """
+    下载数据库备份（在线备份，不阻塞写入）。
+    compress=gzip 时压缩传输；since_history_id=N 时为增量备份，只包含之后的历史记录；
+    database=archive 时下载历史归档库
+    """
+    if is_postgresql():
+        return jsonify({
+            'error': 'PostgreSQL数据库请使用pg_dump备份',
+            'error_en': 'Use pg_dump to back up a PostgreSQL database'
+        }), 501
+    
+    since_history_id = request.args.get('since_history_id', '').strip()
+    if since_history_id and not since_history_id.isdigit():
+        return jsonify({'error': 'since_history_id必须是整数', 'error_en': 'since_history_id must be an integer'}), 400
+    since_history_id = int(since_history_id) if since_history_id else None
+    compress = request.args.get('compress', '').strip().lower()
+    if compress not in ('', 'gzip'):
+        return jsonify({'error': f'不支持的压缩格式: {compress}', 'error_en': f'Unsupported compression: {compress}'}), 400
+    database = request.args.get('database', 'main').strip().lower()
+    if database not in ('main', 'archive'):
+        return jsonify({'error': f'未知的数据库: {database}', 'error_en': f'Unknown database: {database}'}), 400
+    if database == 'archive' and since_history_id is not None:
+        return jsonify({
+            'error': '历史归档库不支持增量备份',
+            'error_en': 'Incremental backup is not supported for the history archive'
+        }), 400
+    
+    fd, backup_path = tempfile.mkstemp(prefix='inventory-backup-', suffix='.db')
+    os.close(fd)
     try:
-        db = get_db()
-        db.close()  # 关闭数据库连接以确保所有数据都已写入
-        
-        # 获取数据库文件路径
-        db_path = os.path.join(os.path.dirname(__file__), 'inventory.db')
-        
-        # 创建内存中的临时文件
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        temp_buffer = BytesIO()
-        with open(db_path, 'rb') as f:
-            temp_buffer.write(f.read())
-        
-        temp_buffer.seek(0)
-        
-        return send_file(
-            temp_buffer,
-            mimetype='application/x-sqlite3',
-            as_attachment=True,
-            download_name=f'inventory_{timestamp}.db'
-        )
-        
+        history_id = backup_sqlite_database(backup_path, since_history_id, database)
     except Exception as e:
         print(f"Error exporting database: {e}")
+        os.remove(backup_path)
         return jsonify({'error': str(e)}), 500
+    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    download_name = f'inventory_{timestamp}.db'
+    if since_history_id is not None:
+        download_name = f'inventory_{timestamp}_since_{since_history_id}.db'
+    elif database == 'archive':
+        download_name = f'archive_{timestamp}.db'
+    headers = {}
+    if history_id is not None:
+        headers['X-Backup-History-Id'] = str(history_id)
+    if compress:
+        download_name += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'application/x-sqlite3'
+        headers['Content-Length'] = str(os.path.getsize(backup_path))
+    headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    return Response(stream_backup_file(backup_path, bool(compress)), mimetype=mimetype, headers=headers)
 
 @app.route('/api/inventory/bin/<bin_code>/clear', methods=['DELETE'])
 def clear_bin_inventory(bin_code):
-    try:
-        db = get_db()
-        cursor = db.cursor()
-        
+    def write(cursor):
         # 先检查库位是否存在
         cursor.execute('SELECT bin_id FROM bins WHERE bin_code = ?', (bin_code,))
         bin_result = cursor.fetchone()
         if not bin_result:
-            return jsonify({'error': '库位不存在', 'error_en': 'Bin location does not exist'}), 404
+            raise WriteRejected('库位不存在', 'Bin location does not exist', 404)
         
         # 获取要删除的所有库存信息用于历史记录（包含详细信息）
         cursor.execute('''
@@ -1833,13 +4127,11 @@ def clear_bin_inventory(bin_code):
         
         # 如果库位为空，不允许清空操作
         if not inventory_records:
-            return jsonify({
-                'error': '该库位为空，无需清空',
-                'error_en': 'Bin is empty, no need to clear'
-            }), 400
+            raise WriteRejected('该库位为空，无需清空', 'Bin is empty, no need to clear')
         
         # 删除该库位的所有库存记录
         cursor.execute('DELETE FROM inventory WHERE bin_id = ?', (bin_result['bin_id'],))
+        cursor.execute('DELETE FROM inventory_summary WHERE bin_id = ?', (bin_result['bin_id'],))
         
         # 记录清除操作到历史记录（为每个商品的每个PO-BT组合创建详细的历史记录）
         # 按商品和PO-BT组合分组
@@ -1881,30 +4173,35 @@ def clear_bin_inventory(bin_code):
                  clear_box_count, clear_box_detail, 
                  clear_total_pieces))
         
-        db.commit()
-        return jsonify({'success': True, 'message': f'已清空库位 {bin_code} 的所有库存'})
-        
+        return sorted({group['item_code'] for group in item_po_bt_groups.values()})
+    
+    try:
+        item_codes = run_write(write)
+    except WriteRejected as e:
+        return e.response()
     except Exception as e:
         print(f"Error clearing bin inventory: {str(e)}")
         return jsonify({'error': str(e)}), 500
+    
+    bt_value_index.invalidate()
+    po_value_index.invalidate()
+    change_broadcaster.publish('bin_cleared', bin_code=bin_code, item_codes=item_codes)
+    return jsonify({'success': True, 'message': f'已清空库位 {bin_code} 的所有库存'})
 
 @app.route('/api/inventory/bin/<bin_code>/item/<item_code>/clear', methods=['DELETE'])
 def clear_item_at_bin(bin_code, item_code):
-    try:
-        db = get_db()
-        cursor = db.cursor()
-        
+    def write(cursor):
         # 先检查库位是否存在
         cursor.execute('SELECT bin_id FROM bins WHERE bin_code = ?', (bin_code,))
         bin_result = cursor.fetchone()
         if not bin_result:
-            return jsonify({'error': '库位不存在', 'error_en': 'Bin location does not exist'}), 404
+            raise WriteRejected('库位不存在', 'Bin location does not exist', 404)
         
         # 检查商品是否存在
         cursor.execute('SELECT item_id FROM items WHERE item_code = ?', (item_code,))
         item_result = cursor.fetchone()
         if not item_result:
-            return jsonify({'error': '商品不存在', 'error_en': 'Item does not exist'}), 404
+            raise WriteRejected('商品不存在', 'Item does not exist', 404)
         
         # 获取要删除的库存信息用于历史记录（包含详细信息）
         cursor.execute('''
@@ -1921,6 +4218,10 @@ def clear_item_at_bin(bin_code, item_code):
             DELETE FROM inventory 
             WHERE bin_id = ? AND item_id = ?
         ''', (bin_result['bin_id'], item_result['item_id']))
+        cursor.execute('''
+            DELETE FROM inventory_summary 
+            WHERE bin_id = ? AND item_id = ?
+        ''', (bin_result['bin_id'], item_result['item_id']))
         
         # 记录清除操作到历史记录（为每个不同的PO-BT组合创建单独的历史记录）
         if inventory_records:
@@ -1958,142 +4259,452 @@ def clear_item_at_bin(bin_code, item_code):
                      group_data['customer_po'], group_data['BT'],
                      clear_box_count, clear_box_detail, 
                      clear_total_pieces))
-        
-        db.commit()
-        return jsonify({
-            'success': True, 
-            'message': f'已清空库位 {bin_code} 中商品 {item_code} 的所有库存'
-        })
-        
+    
+    try:
+        run_write(write)
+    except WriteRejected as e:
+        return e.response()
     except Exception as e:
         print(f"Error clearing item at bin: {str(e)}")
         return jsonify({'error': str(e)}), 500
+    
+    bt_value_index.invalidate()
+    po_value_index.invalidate()
+    change_broadcaster.publish('item_cleared', bin_code=bin_code, item_code=item_code)
+    return jsonify({
+        'success': True, 
+        'message': f'已清空库位 {bin_code} 中商品 {item_code} 的所有库存'
+    })
+
+# 盘点：扫描写入暂存表（count_scans），与当前库存一次性集合比对后原子地调整库存并写入历史记录
+def get_count_session(cursor, session_id):
+    placeholder = get_placeholder()
+    cursor.execute(f'''
+        SELECT session_id, status, note, created_at, closed_at
+        FROM count_sessions WHERE session_id = {placeholder}
+    ''', (session_id,))
+    return cursor.fetchone()
+
+def format_count_session(cursor, session):
+    placeholder = get_placeholder()
+    cursor.execute(f'''
+        SELECT
+            (SELECT COUNT(*) FROM count_session_bins WHERE session_id = {placeholder}) AS bin_count,
+            (SELECT COUNT(*) FROM count_scans WHERE session_id = {placeholder}) AS scan_count
+    ''', (session['session_id'], session['session_id']))
+    counts = cursor.fetchone()
+    return {
+        'session_id': session['session_id'],
+        'status': session['status'],
+        'note': session['note'],
+        'created_at': session['created_at'],
+        'closed_at': session['closed_at'],
+        'bin_count': counts['bin_count'],
+        'scan_count': counts['scan_count']
+    }
+
+def require_open_count_session(cursor, session_id):
+    """返回进行中的盘点；盘点不存在或已结束时抛出WriteRejected"""
+    session = get_count_session(cursor, session_id)
+    if not session:
+        raise WriteRejected('盘点不存在', 'Count session does not exist', 404)
+    if session['status'] != 'open':
+        raise WriteRejected(f'盘点已结束（{session["status"]}）',
+                            f'Count session is already {session["status"]}', 409)
+    return session
+
+def open_count_session_or_error(cursor, session_id):
+    """返回 (盘点, 错误响应)；盘点不存在或已结束时返回错误响应"""
+    try:
+        return require_open_count_session(cursor, session_id), None
+    except WriteRejected as e:
+        return None, e.response()
+
+def compute_count_variances(cursor, session_id):
+    """
+    在一次查询中比对盘点结果与当前库存：只比较已盘点的库位，
+    按 (库位, 商品, PO, BT, 箱规) 分组，返回数量有差异的行。
+    """
+    placeholder = get_placeholder()
+    cursor.execute(f'''
+        SELECT bin_code, item_code, customer_po, BT AS "BT", pieces_per_box,
+               SUM(system_boxes) AS system_boxes, SUM(system_pieces) AS system_pieces,
+               SUM(counted_boxes) AS counted_boxes, SUM(counted_pieces) AS counted_pieces
+        FROM (
+            SELECT b.bin_code, i.item_code, s.customer_po, s.BT, s.pieces_per_box,
+                   s.box_count AS system_boxes, s.total_pieces AS system_pieces,
+                   0 AS counted_boxes, 0 AS counted_pieces
+            FROM inventory_summary s
+            JOIN count_session_bins cb ON cb.bin_id = s.bin_id AND cb.session_id = {placeholder}
+            JOIN bins b ON b.bin_id = s.bin_id
+            JOIN items i ON i.item_id = s.item_id
+            UNION ALL
+            SELECT b.bin_code, c.item_code, c.customer_po, c.BT, c.pieces_per_box,
+                   0, 0, c.box_count, c.total_pieces
+            FROM count_scans c
+            JOIN bins b ON b.bin_id = c.bin_id
+            WHERE c.session_id = {placeholder}
+        ) combined
+        GROUP BY bin_code, item_code, customer_po, BT, pieces_per_box
+        HAVING SUM(system_boxes) <> SUM(counted_boxes) OR SUM(system_pieces) <> SUM(counted_pieces)
+        ORDER BY bin_code, item_code, customer_po, BT, pieces_per_box
+    ''', (session_id, session_id))
+    return [{
+        'bin_code': row['bin_code'],
+        'item_code': row['item_code'],
+        'customer_po': row['customer_po'],
+        'BT': row['BT'],
+        'pieces_per_box': row['pieces_per_box'],
+        'system_boxes': row['system_boxes'],
+        'system_pieces': row['system_pieces'],
+        'counted_boxes': row['counted_boxes'],
+        'counted_pieces': row['counted_pieces'],
+        'box_variance': row['counted_boxes'] - row['system_boxes'],
+        'piece_variance': row['counted_pieces'] - row['system_pieces']
+    } for row in cursor.fetchall()]
+
+def summarize_count_variances(variances):
+    return {
+        'variance_lines': len(variances),
+        'bins_with_variance': len({variance['bin_code'] for variance in variances}),
+        'items_with_variance': len({variance['item_code'] for variance in variances}),
+        'pieces_over': sum(variance['piece_variance'] for variance in variances if variance['piece_variance'] > 0),
+        'pieces_short': -sum(variance['piece_variance'] for variance in variances if variance['piece_variance'] < 0)
+    }
+
+@app.route('/api/counts', methods=['POST'])
+def create_count_session():
+    """开始一次盘点"""
+    ensure_db_initialized()
+    data = request.get_json(silent=True) or {}
+    placeholder = get_placeholder()
+    
+    def write(cursor):
+        cursor.execute(f'INSERT INTO count_sessions (note) VALUES ({placeholder})', (data.get('note'),))
+        if is_postgresql():
+            cursor.execute('SELECT lastval() AS session_id')
+            session_id = cursor.fetchone()['session_id']
+        else:
+            session_id = cursor.lastrowid
+        return format_count_session(cursor, get_count_session(cursor, session_id))
+    
+    try:
+        return jsonify(run_write(write)), 201
+    except Exception as e:
+        print(f"创建盘点时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/counts', methods=['GET'])
+def list_count_sessions():
+    db = get_db()
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
+    status = request.args.get('status', '').strip()
+    if status:
+        cursor.execute(f'''
+            SELECT session_id, status, note, created_at, closed_at FROM count_sessions
+            WHERE status = {placeholder} ORDER BY session_id DESC
+        ''', (status,))
+    else:
+        cursor.execute('''
+            SELECT session_id, status, note, created_at, closed_at FROM count_sessions
+            ORDER BY session_id DESC
+        ''')
+    sessions = cursor.fetchall()
+    return jsonify([format_count_session(cursor, session) for session in sessions])
+
+@app.route('/api/counts/<int:session_id>', methods=['GET'])
+def get_count_session_info(session_id):
+    cursor = get_cursor(get_db())
+    session = get_count_session(cursor, session_id)
+    if not session:
+        return jsonify({'error': '盘点不存在', 'error_en': 'Count session does not exist'}), 404
+    return jsonify(format_count_session(cursor, session))
+
+@app.route('/api/counts/<int:session_id>/scans', methods=['POST'])
+def add_count_scans(session_id):
+    """
+    提交盘点扫描：entries格式与批量录入相同；bins列出盘点为空的库位。
+    replace=true时先删除这些库位在本次盘点中已有的扫描（重新盘点）。
+    """
+    data = request.get_json(silent=True) or {}
+    entries = data.get('entries') or []
+    empty_bins = data.get('bins') or []
+    if not isinstance(entries, list) or not isinstance(empty_bins, list) or not (entries or empty_bins):
+        return jsonify({'error': '没有要提交的记录', 'error_en': 'No entries to submit'}), 400
+    if len(entries) > INVENTORY_BATCH_MAX_LINES:
+        return jsonify({
+            'error': f'单次最多提交 {INVENTORY_BATCH_MAX_LINES} 行',
+            'error_en': f'At most {INVENTORY_BATCH_MAX_LINES} entries per batch'
+        }), 400
+    
+    placeholder = get_placeholder()
+    
+    results = []
+    lines = []
+    for index, entry in enumerate(entries):
+        try:
+            box_count = int(entry['box_count'])
+            pieces_per_box = int(entry['pieces_per_box'])
+            if box_count < 0 or pieces_per_box <= 0:
+                raise ValueError('box_count / pieces_per_box')
+            lines.append({
+                'index': index,
+                'bin_code': entry['bin_code'],
+                'item_code': entry['item_code'],
+                'customer_po': normalize_lookup_value(entry.get('customer_po')),
+                'BT': normalize_lookup_value(entry.get('BT')),
+                'box_count': box_count,
+                'pieces_per_box': pieces_per_box,
+                'total_pieces': box_count * pieces_per_box
+            })
+            results.append({'index': index, 'success': True})
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results.append({'index': index, 'success': False,
+                            'error': f'记录格式错误: {str(e)}', 'error_en': f'Invalid entry: {str(e)}'})
+    
+    def write(cursor):
+        # 在写事务中检查盘点状态，与取消/应用盘点互斥
+        require_open_count_session(cursor, session_id)
+        bin_ids = lookup_ids(cursor, 'bins', 'bin_id', 'bin_code',
+                             {line['bin_code'] for line in lines} | set(empty_bins))
+        unknown_bins = sorted(set(empty_bins) - set(bin_ids))
+        valid_lines = []
+        for line in lines:
+            if line['bin_code'] not in bin_ids:
+                results[line['index']] = {'index': line['index'], 'success': False,
+                                          'error': '库位不存在', 'error_en': 'Bin location does not exist'}
+            else:
+                valid_lines.append(line)
+        counted_bin_ids = sorted({bin_ids[line['bin_code']] for line in valid_lines} |
+                                 {bin_ids[code] for code in empty_bins if code in bin_ids})
+        
+        if data.get('replace') and counted_bin_ids:
+            for chunk in iter_chunks(counted_bin_ids, SQL_IN_CHUNK_SIZE):
+                cursor.execute(f'''
+                    DELETE FROM count_scans
+                    WHERE session_id = {placeholder} AND bin_id IN ({', '.join([placeholder] * len(chunk))})
+                ''', [session_id] + chunk)
+        
+        cursor.execute(f'SELECT bin_id FROM count_session_bins WHERE session_id = {placeholder}', (session_id,))
+        known_bin_ids = {row['bin_id'] for row in cursor.fetchall()}
+        cursor.executemany(f'''
+            INSERT INTO count_session_bins (session_id, bin_id) VALUES ({placeholder}, {placeholder})
+        ''', [(session_id, bin_id) for bin_id in counted_bin_ids if bin_id not in known_bin_ids])
+        cursor.executemany(f'''
+            INSERT INTO count_scans (session_id, bin_id, item_code, customer_po, BT, box_count, pieces_per_box, total_pieces)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+        ''', [(session_id, bin_ids[line['bin_code']], line['item_code'], line['customer_po'], line['BT'],
+               line['box_count'], line['pieces_per_box'], line['total_pieces']) for line in valid_lines])
+        return {
+            'success': all(result['success'] for result in results) and not unknown_bins,
+            'accepted': len(valid_lines),
+            'rejected': len(results) - len(valid_lines),
+            'bins_counted': len(counted_bin_ids),
+            'unknown_bins': unknown_bins,
+            'results': results
+        }
+    
+    try:
+        return jsonify(run_write(write))
+    except WriteRejected as e:
+        return e.response()
+    except Exception as e:
+        print(f"提交盘点扫描时出错: {str(e)}")
+        print(f"错误详情: {traceback.format_exc()}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/counts/<int:session_id>/variances', methods=['GET'])
+def get_count_variances(session_id):
+    """盘点差异预览（不修改库存）"""
+    cursor = get_cursor(get_db())
+    session = get_count_session(cursor, session_id)
+    if not session:
+        return jsonify({'error': '盘点不存在', 'error_en': 'Count session does not exist'}), 404
+    variances = compute_count_variances(cursor, session_id)
+    return jsonify({
+        'session': format_count_session(cursor, session),
+        'summary': summarize_count_variances(variances),
+        'variances': variances
+    })
+
+@app.route('/api/counts/<int:session_id>/apply', methods=['POST'])
+def apply_count_session(session_id):
+    """
+    按盘点结果调整库存：有差异的 (库位, 商品, PO, BT, 箱规) 改为盘点数量，
+    每条差异写一条历史记录（盘亏记为负数，与清空记录一致）。整个调整在一个事务中完成。
+    """
+    db = get_db()
+    cursor = get_cursor(db)
+    placeholder = get_placeholder()
+    equals = null_safe_equals()
+    session, error_response = open_count_session_or_error(cursor, session_id)
+    if error_response:
+        return error_response
+    
+    try:
+        # 先更新盘点状态：SQLite在此获得写锁，比对期间其他写入等待；同时防止重复提交
+        cursor.execute(f'''
+            UPDATE count_sessions SET status = 'applied', closed_at = CURRENT_TIMESTAMP
+            WHERE session_id = {placeholder} AND status = 'open'
+        ''', (session_id,))
+        if cursor.rowcount != 1:
+            db.rollback()
+            return jsonify({'error': '盘点已结束', 'error_en': 'Count session is already closed'}), 409
+        
+        cursor.execute(f'SELECT bin_id FROM count_session_bins WHERE session_id = {placeholder} ORDER BY bin_id',
+                       (session_id,))
+        counted_bin_ids = [row['bin_id'] for row in cursor.fetchall()]
+        if is_postgresql():
+            # 与apply_inventory_delta使用同一组库位锁，按顺序加锁避免死锁
+            for bin_id in counted_bin_ids:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', (bin_id,))
+        
+        variances = compute_count_variances(cursor, session_id)
+        bin_ids = lookup_ids(cursor, 'bins', 'bin_id', 'bin_code', {variance['bin_code'] for variance in variances})
+        item_codes = {variance['item_code'] for variance in variances}
+        item_ids = lookup_ids(cursor, 'items', 'item_id', 'item_code', item_codes)
+        new_item_codes = sorted(item_codes - set(item_ids))
+        if new_item_codes:
+            cursor.executemany(f'INSERT INTO items (item_code) VALUES ({placeholder})',
+                               [(code,) for code in new_item_codes])
+            item_ids.update(lookup_ids(cursor, 'items', 'item_id', 'item_code', new_item_codes))
+        
+        keys = [(bin_ids[variance['bin_code']], item_ids[variance['item_code']], variance['pieces_per_box'],
+                 variance['customer_po'], variance['BT']) for variance in variances]
+        for table in ('inventory', 'inventory_summary'):
+            cursor.executemany(f'''
+                DELETE FROM {table}
+                WHERE bin_id = {placeholder} AND item_id = {placeholder} AND pieces_per_box = {placeholder}
+                  AND customer_po {equals} {placeholder} AND BT {equals} {placeholder}
+            ''', keys)
+        counted_rows = [(key[0], key[1], variance['customer_po'], variance['BT'], variance['counted_boxes'],
+                         variance['pieces_per_box'], variance['counted_pieces'])
+                        for key, variance in zip(keys, variances) if variance['counted_pieces'] > 0]
+        for table in ('inventory', 'inventory_summary'):
+            cursor.executemany(f'''
+                INSERT INTO {table} (bin_id, item_id, customer_po, BT, box_count, pieces_per_box, total_pieces)
+                VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+            ''', counted_rows)
+        
+        cursor.executemany(f'''
+            INSERT INTO input_history (bin_code, item_code, customer_po, BT, box_count, pieces_per_box, total_pieces)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+        ''', [(variance['bin_code'], variance['item_code'], variance['customer_po'], variance['BT'],
+               variance['box_variance'],
+               variance['pieces_per_box'] if variance['piece_variance'] >= 0 else -variance['pieces_per_box'],
+               variance['piece_variance']) for variance in variances])
+        db.commit()
+    except Exception as e:
+        print(f"应用盘点结果时出错: {str(e)}")
+        print(f"错误详情: {traceback.format_exc()}")
+        db.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    for code in new_item_codes:
+        item_search_index.add(code, item_ids[code])
+    if variances:
+        bt_value_index.invalidate()
+        po_value_index.invalidate()
+        change_broadcaster.publish('count_applied', session_id=session_id,
+                                   bin_codes=sorted({variance['bin_code'] for variance in variances}),
+                                   item_codes=sorted(item_codes))
+    print(f"盘点 {session_id} 已应用: 差异 {len(variances)} 行")
+    return jsonify({
+        'success': True,
+        'session': format_count_session(cursor, get_count_session(cursor, session_id)),
+        'summary': summarize_count_variances(variances),
+        'variances': variances
+    })
+
+@app.route('/api/counts/<int:session_id>/cancel', methods=['POST'])
+def cancel_count_session(session_id):
+    placeholder = get_placeholder()
+    
+    def write(cursor):
+        require_open_count_session(cursor, session_id)
+        cursor.execute(f'''
+            UPDATE count_sessions SET status = 'cancelled', closed_at = CURRENT_TIMESTAMP
+            WHERE session_id = {placeholder} AND status = 'open'
+        ''', (session_id,))
+        # 其他请求已经应用或取消了这次盘点：不删除扫描记录
+        if cursor.rowcount != 1:
+            raise WriteRejected('盘点已结束', 'Count session is already closed', 409)
+        cursor.execute(f'DELETE FROM count_scans WHERE session_id = {placeholder}', (session_id,))
+    
+    try:
+        run_write(write)
+    except WriteRejected as e:
+        return e.response()
+    except Exception as e:
+        print(f"取消盘点时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'success': True})
 
 @app.route('/api/export/history', methods=['GET'])
+@export_job_route
 def export_history():
     db = get_db()
     cursor = db.cursor()
     
-    # 检查是否有日期过滤参数
-    date_filter = request.args.get('date', '').strip()
+    start_date, end_date, error_response = parse_history_date_range()
+    if error_response:
+        return error_response
     
-    if date_filter:
-        # 导出指定日期的历史记录
-        cursor.execute('''
-            SELECT 
-                datetime(input_time, 'localtime') as input_time,
-                bin_code,
-                item_code,
-                customer_po,
-                BT,
-                box_count,
-                pieces_per_box,
-                total_pieces
-            FROM input_history
-            WHERE DATE(datetime(input_time, 'localtime')) = ?
-            ORDER BY input_time DESC
-        ''', (date_filter,))
-        filename = f'History-{date_filter}.xlsx'
+    # 导出指定日期范围（未指定时为所有）的历史记录，包括已归档的月份
+    conditions, params = history_date_filter(start_date, end_date)
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cursor.execute(f'''
+        SELECT 
+            datetime(input_time, 'localtime') as input_time,
+            bin_code,
+            item_code,
+            customer_po,
+            BT,
+            box_count,
+            pieces_per_box,
+            total_pieces
+        FROM {history_source(get_cursor(db), start_date, end_date)}
+        {where_clause}
+        ORDER BY input_time DESC
+    ''', params)
+    if start_date and start_date == end_date:
+        filename = f'History-{start_date}.xlsx'
+    elif start_date or end_date:
+        filename = f"History-{start_date or ''}_{end_date or ''}.xlsx"
     else:
-        # 导出所有历史记录
-        cursor.execute('''
-            SELECT 
-                datetime(input_time, 'localtime') as input_time,
-                bin_code,
-                item_code,
-                customer_po,
-                BT,
-                box_count,
-                pieces_per_box,
-                total_pieces
-            FROM input_history
-            ORDER BY input_time DESC
-        ''')
         filename = f'History-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
     
-    history_data = cursor.fetchall()
-    
-    # 创建DataFrame
-    df = pd.DataFrame(history_data, columns=[
-        'Time (UTC)', 'Bin Location', 'Item (SKU)', 'Customer PO', 'BT Number', 
-        'Box Count', 'PCs/Box', 'Total Pieces'
-    ])
-    
-    # 创建Excel文件
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='History', index=False)
-        
-        workbook = writer.book
-        worksheet = writer.sheets['History']
-        
-        # 定义格式
-        header_format = workbook.add_format({
-            'bold': True,
-            'align': 'center',
-            'valign': 'vcenter',
-            'bg_color': '#f8f9fa'
-        })
-        
-        time_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'num_format': 'yyyy-mm-dd hh:mm:ss',
-            'font_color': '#666666'  # 灰色
-        })
-        
-        bin_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#e67e22'  # 橙色
-        })
-        
-        item_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#2962ff'  # 蓝色
-        })
-        
-        customer_po_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#ff5722'  # 橘红色
-        })
-        
-        bt_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#9c27b0'  # 紫色
-        })
-        
-        number_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'num_format': '#,##0',
-            'font_color': '#27ae60'  # 绿色
-        })
-        
-        # 应用格式到表头
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(0, col_num, value, header_format)
-        
-        # 设置列宽并应用格式
-        worksheet.set_column('A:A', 20, time_format)    # Time column
-        worksheet.set_column('B:B', 15 , bin_format)     # Bin Code column
-        worksheet.set_column('C:C', 20, item_format)    # Item Code column
-        worksheet.set_column('D:D', 15, customer_po_format) # Customer PO column
-        worksheet.set_column('E:E', 10, bt_format)      # BT Number column
-        worksheet.set_column('F:H', None, number_format) # Number columns
+    def write_workbook(workbook):
+        formats = add_export_formats(workbook)
+        writer = XlsxStreamWriter(workbook.add_worksheet('History'), [
+            ('Time (UTC)', 20, formats['time']),
+            ('Bin Location', 15, formats['bin']),
+            ('Item (SKU)', 20, formats['item']),
+            ('Customer PO', 15, formats['customer_po']),
+            ('BT Number', 10, formats['bt']),
+            ('Box Count', None, formats['count']),
+            ('PCs/Box', None, formats['count']),
+            ('Total Pieces', None, formats['count'])
+        ], formats['header'])
+        
+        for row in iter_cursor_rows(cursor):
+            writer.write_row([
+                row['input_time'],
+                row['bin_code'],
+                row['item_code'],
+                row['customer_po'],
+                row['BT'],
+                row['box_count'],
+                row['pieces_per_box'],
+                row['total_pieces']
+            ])
+        writer.close()
     
-    output.seek(0)
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return send_xlsx_export(filename, write_workbook)
 
 @app.route('/api/export/po/<PO>', methods=['GET'])
+@export_job_route
 def export_po(PO):
     db = get_db()
     cursor = db.cursor()
@@ -2107,7 +4718,7 @@ def export_po(PO):
                 inv.customer_po,
                 i.item_code,
                 SUM(inv.total_pieces) as item_total_in_po
-            FROM inventory inv
+            FROM inventory_summary inv
             JOIN items i ON inv.item_id = i.item_id
             WHERE inv.customer_po = ?
             GROUP BY inv.customer_po, i.item_code
@@ -2121,7 +4732,7 @@ def export_po(PO):
             inv.pieces_per_box,
             inv.total_pieces as pieces_in_bin,
             pit.item_total_in_po
-        FROM inventory inv
+        FROM inventory_summary inv
         JOIN items i ON inv.item_id = i.item_id
         JOIN bins b ON inv.bin_id = b.bin_id
         JOIN po_item_totals pit ON inv.customer_po = pit.customer_po AND i.item_code = pit.item_code
@@ -2129,44 +4740,18 @@ def export_po(PO):
         ORDER BY i.item_code, b.bin_code, inv.BT
     ''', (PO, PO))
     
-    results = cursor.fetchall()
-    
-    if not results:
+    first_row = cursor.fetchone()
+    if not first_row:
         return jsonify({
             'error': f'客户订单号 {PO} 不存在',
             'error_en': f'Customer PO {PO} does not exist'
         }), 404
     
-    # 准备导出数据
-    export_data = []
-    for row in results:
-        export_data.append({
-            'Customer PO': row['customer_po'],
-            'Item Code': row['item_code'], 
-            'Bin Code': row['bin_code'],
-            'BT Number': row['BT'] or '',
-            'Boxes in Bin': row['boxes_in_bin'],
-            'Pieces per Box': row['pieces_per_box'],
-            'Pieces in Bin': row['pieces_in_bin'],
-            'Item Total in PO': row['item_total_in_po']
-        })
-    
-    # 创建DataFrame
-    df = pd.DataFrame(export_data)
-    
     # 生成文件名
     filename = f'PO-{PO}-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
     
-    # 创建Excel文件
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='PO Details', index=False)
-        
-        # 获取工作表和工作簿对象
-        workbook = writer.book
-        worksheet = writer.sheets['PO Details']
-        
-        # 定义格式
+    def write_workbook(workbook):
+        formats = add_export_formats(workbook)
         header_format = workbook.add_format({
             'bold': True,
             'align': 'center',
@@ -2174,97 +4759,22 @@ def export_po(PO):
             'bg_color': '#f0f0f0',
             'border': 1
         })
-        
-        customer_po_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#ff5722'  # 橘红色
-        })
-        
-        item_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#2962ff'  # 蓝色
-        })
-        
-        bin_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#e67e22'  # 橙色
-        })
-        
-        bt_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#9c27b0'  # 紫色
-        })
-        
-        number_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#27ae60'  # 绿色
-        })
-        
-        # 设置列宽和格式
-        worksheet.set_column('A:A', 15, customer_po_format)  # Customer PO
-        worksheet.set_column('B:B', 20, item_format)         # Item Code
-        worksheet.set_column('C:C', 15, bin_format)          # Bin Code
-        worksheet.set_column('D:D', 12, bt_format)           # BT Number
-        worksheet.set_column('E:E', 12, number_format)       # Boxes in Bin
-        worksheet.set_column('F:F', 12, number_format)       # Pieces per Box
-        worksheet.set_column('G:G', 12, number_format)       # Pieces in Bin
-        worksheet.set_column('H:H', 15, number_format)       # Item Total in PO
-        
-        # 应用表头格式
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(0, col_num, value, header_format)
-        
-        # 合并相同PO和相同商品的单元格
-        if len(export_data) > 0:
-            # 合并整个Customer PO列（所有行都是同一个PO）
-            if len(export_data) > 1:
-                po_value = export_data[0]['Customer PO']
-                worksheet.merge_range(1, 0, len(export_data), 0, po_value, customer_po_format)
-            
-            # 合并相同Item Code的行
-            current_item = None
-            item_start_row = 1
-            
-            for row_idx, row_data in enumerate(export_data, start=1):
-                item = row_data['Item Code']
-                
-                # 检查商品是否变化
-                if current_item != item:
-                    # 合并之前商品的Item Code列和Item Total in PO列（如果有多行）
-                    if current_item is not None and row_idx - 1 > item_start_row:
-                        # 合并Item Code列 (B列)
-                        worksheet.merge_range(item_start_row, 1, row_idx - 1, 1, current_item, item_format)
-                        # 合并Item Total in PO列 (H列)
-                        item_total = export_data[row_idx - 2]['Item Total in PO']
-                        worksheet.merge_range(item_start_row, 7, row_idx - 1, 7, item_total, number_format)
-                    
-                    current_item = item
-                    item_start_row = row_idx
-            
-            # 处理最后一个商品的合并
-            if len(export_data) > item_start_row:
-                last_item = export_data[-1]['Item Code']
-                last_item_total = export_data[-1]['Item Total in PO']
-                # 合并Item Code列 (B列)
-                worksheet.merge_range(item_start_row, 1, len(export_data), 1, last_item, item_format)
-                # 合并Item Total in PO列 (H列)
-                worksheet.merge_range(item_start_row, 7, len(export_data), 7, last_item_total, number_format)
+        item_key = lambda values: values[1]
+        # 合并整个Customer PO列（所有行都是同一个PO），以及相同商品的Item Code列和Item Total in PO列
+        writer = XlsxStreamWriter(workbook.add_worksheet('PO Details'),
+                                  xlsx_columns(PO_EXPORT_COLUMNS, formats), header_format,
+                                  merge_keys={0: lambda values: values[0], 1: item_key, 7: item_key})
+        
+        # 所有行的PO相同，整列作为一组；内存中只保留该PO的行
+        writer.write_row(format_po_export_row(first_row), group_key=PO)
+        for row in iter_cursor_rows(cursor):
+            writer.write_row(format_po_export_row(row), group_key=PO)
+        writer.close()
     
-    output.seek(0)
-    
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return send_xlsx_export(filename, write_workbook)
 
 @app.route('/api/export/bt/<BT>', methods=['GET'])
+@export_job_route
 def export_bt(BT):
     db = get_db()
     cursor = db.cursor()
@@ -2280,7 +4790,7 @@ def export_bt(BT):
             inv.BT,
             SUM(inv.total_pieces) as total_pieces,
             SUM(inv.box_count) as total_boxes
-        FROM inventory inv
+        FROM inventory_summary inv
         JOIN items i ON inv.item_id = i.item_id
         JOIN bins b ON inv.bin_id = b.bin_id
         WHERE inv.BT = ?
@@ -2288,42 +4798,28 @@ def export_bt(BT):
         ORDER BY i.item_code, b.bin_code, inv.customer_po
     ''', (BT,))
     
-    results = cursor.fetchall()
-    
-    if not results:
+    first_row = cursor.fetchone()
+    if not first_row:
         return jsonify({
             'error': f'BT {BT} 不存在',
             'error_en': f'BT {BT} does not exist'
         }), 404
     
-    # 准备导出数据
-    export_data = []
-    for row in results:
-        export_data.append({
-            'BT Number': row['BT'],
-            'Item Code': row['item_code'], 
-            'Bin Code': row['bin_code'],
-            'Customer PO': row['customer_po'] or '',
-            'Total Pieces': row['total_pieces'],
-            'Box Count': row['total_boxes']
-        })
-    
-    # 创建DataFrame
-    df = pd.DataFrame(export_data)
-    
     # 生成文件名
     filename = f'BT-{BT}-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
     
-    # 创建Excel文件
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='BT Details', index=False)
-        
-        # 获取工作表和工作簿对象
-        workbook = writer.book
-        worksheet = writer.sheets['BT Details']
-        
-        # 定义格式
+    def format_bt_export_row(row):
+        return [
+            row['BT'],
+            row['item_code'],
+            row['bin_code'],
+            row['customer_po'] or '',
+            row['total_pieces'],
+            row['total_boxes']
+        ]
+    
+    def write_workbook(workbook):
+        formats = add_export_formats(workbook)
         header_format = workbook.add_format({
             'bold': True,
             'align': 'center',
@@ -2331,88 +4827,30 @@ def export_bt(BT):
             'bg_color': '#f0f0f0',
             'border': 1
         })
-        
-        bt_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#9c27b0'  # 紫色
-        })
-        
-        item_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#2962ff'  # 蓝色
-        })
-        
-        bin_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#e67e22'  # 橙色
-        })
-        
-        customer_po_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#ff5722'  # 橘红色
-        })
-        
-        number_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#27ae60'  # 绿色
-        })
-        
-        # 设置列宽和格式
-        worksheet.set_column('A:A', 12, bt_format)           # BT Number
-        worksheet.set_column('B:B', 20, item_format)         # Item Code
-        worksheet.set_column('C:C', 15, bin_format)          # Bin Code
-        worksheet.set_column('D:D', 15, customer_po_format)  # Customer PO
-        worksheet.set_column('E:E', 12, number_format)       # Total Pieces
-        worksheet.set_column('F:F', 12, number_format)       # Box Count
-        
-        # 应用表头格式
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(0, col_num, value, header_format)
-        
-        # 合并相同BT和相同商品的单元格
-        if len(export_data) > 0:
-            # 合并整个BT Number列（所有行都是同一个BT）
-            if len(export_data) > 1:
-                bt_value = export_data[0]['BT Number']
-                worksheet.merge_range(1, 0, len(export_data), 0, bt_value, bt_format)
-            
-            # 合并相同Item Code的行
-            current_item = None
-            item_start_row = 1
-            
-            for row_idx, row_data in enumerate(export_data, start=1):
-                item = row_data['Item Code']
-                
-                # 检查商品是否变化
-                if current_item != item:
-                    # 合并之前商品的Item Code列（如果有多行）
-                    if current_item is not None and row_idx - 1 > item_start_row:
-                        worksheet.merge_range(item_start_row, 1, row_idx - 1, 1, current_item, item_format)
-                    
-                    current_item = item
-                    item_start_row = row_idx
-            
-            # 处理最后一个商品的合并
-            if len(export_data) > item_start_row:
-                last_item = export_data[-1]['Item Code']
-                worksheet.merge_range(item_start_row, 1, len(export_data), 1, last_item, item_format)
-    
-    output.seek(0)
+        # 合并整个BT Number列（所有行都是同一个BT），以及相同商品的Item Code列
+        writer = XlsxStreamWriter(workbook.add_worksheet('BT Details'), [
+            ('BT Number', 12, formats['bt']),
+            ('Item Code', 20, formats['item']),
+            ('Bin Code', 15, formats['bin']),
+            ('Customer PO', 15, formats['customer_po']),
+            ('Total Pieces', 12, formats['number']),
+            ('Box Count', 12, formats['number'])
+        ], header_format, merge_keys={0: lambda values: values[0], 1: lambda values: values[1]})
+        
+        writer.write_row(format_bt_export_row(first_row), group_key=BT)
+        for row in iter_cursor_rows(cursor):
+            writer.write_row(format_bt_export_row(row), group_key=BT)
+        writer.close()
     
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return send_xlsx_export(filename, write_workbook)
 
 @app.route('/api/export/all-pos', methods=['GET'])
+@export_job_route
 def export_all_pos():
+    export_format, error_response = get_export_format()
+    if error_response:
+        return error_response
+    
     db = get_db()
     cursor = db.cursor()
     
@@ -2423,7 +4861,7 @@ def export_all_pos():
                 inv.customer_po,
                 i.item_code,
                 SUM(inv.total_pieces) as item_total_in_po
-            FROM inventory inv
+            FROM inventory_summary inv
             JOIN items i ON inv.item_id = i.item_id
             WHERE inv.customer_po IS NOT NULL AND inv.customer_po != ''
             GROUP BY inv.customer_po, i.item_code
@@ -2437,7 +4875,7 @@ def export_all_pos():
             inv.pieces_per_box,
             inv.total_pieces as pieces_in_bin,
             pit.item_total_in_po
-        FROM inventory inv
+        FROM inventory_summary inv
         JOIN items i ON inv.item_id = i.item_id
         JOIN bins b ON inv.bin_id = b.bin_id
         JOIN po_item_totals pit ON inv.customer_po = pit.customer_po AND i.item_code = pit.item_code
@@ -2445,44 +4883,17 @@ def export_all_pos():
         ORDER BY inv.customer_po, i.item_code, b.bin_code, inv.BT
     ''')
     
-    results = cursor.fetchall()
-    
-    if not results:
+    first_row = cursor.fetchone()
+    if not first_row:
         return jsonify({
             'error': '没有找到任何客户订单号数据',
             'error_en': 'No customer PO data found'
         }), 404
     
-    # 准备导出数据
-    export_data = []
-    for row in results:
-        export_data.append({
-            'Customer PO': row['customer_po'],
-            'Item Code': row['item_code'], 
-            'Bin Code': row['bin_code'],
-            'BT Number': row['BT'] or '',
-            'Boxes in Bin': row['boxes_in_bin'],
-            'Pieces per Box': row['pieces_per_box'],
-            'Pieces in Bin': row['pieces_in_bin'],
-            'Item Total in PO': row['item_total_in_po']
-        })
-    
-    # 创建DataFrame
-    df = pd.DataFrame(export_data)
-    
-    # 生成文件名
-    filename = f'POs-{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+    rows = (format_po_export_row(row) for row in chain([first_row], iter_cursor_rows(cursor)))
     
-    # 创建Excel文件
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='All POs Details', index=False)
-        
-        # 获取工作表和工作簿对象
-        workbook = writer.book
-        worksheet = writer.sheets['All POs Details']
-        
-        # 定义格式
+    def write_workbook(workbook, rows):
+        formats = add_export_formats(workbook)
         header_format = workbook.add_format({
             'bold': True,
             'align': 'center',
@@ -2490,115 +4901,30 @@ def export_all_pos():
             'bg_color': '#f0f0f0',
             'border': 1
         })
-        
-        customer_po_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#ff5722'  # 橘红色
-        })
-        
-        item_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#2962ff'  # 蓝色
-        })
-        
-        bin_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#e67e22'  # 橙色
-        })
-        
-        bt_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#9c27b0'  # 紫色
-        })
-        
-        number_format = workbook.add_format({
-            'align': 'center',
-            'valign': 'vcenter',
-            'font_color': '#27ae60'  # 绿色
-        })
-        
-        # 设置列宽和格式
-        worksheet.set_column('A:A', 15, customer_po_format)  # Customer PO
-        worksheet.set_column('B:B', 20, item_format)         # Item Code
-        worksheet.set_column('C:C', 15, bin_format)          # Bin Code
-        worksheet.set_column('D:D', 12, bt_format)           # BT Number
-        worksheet.set_column('E:E', 12, number_format)       # Boxes in Bin
-        worksheet.set_column('F:F', 12, number_format)       # Pieces per Box
-        worksheet.set_column('G:G', 12, number_format)       # Pieces in Bin
-        worksheet.set_column('H:H', 15, number_format)       # Item Total in PO
-        
-        # 应用表头格式
-        for col_num, value in enumerate(df.columns.values):
-            worksheet.write(0, col_num, value, header_format)
-        
-        # 合并相同PO和相同商品的单元格
-        if len(export_data) > 0:
-            current_po = None
-            current_item = None
-            po_start_row = 1
-            item_start_row = 1
-            
-            for row_idx, row_data in enumerate(export_data, start=1):
-                po = row_data['Customer PO']
-                item = row_data['Item Code']
-                
-                # 检查PO是否变化
-                if current_po != po:
-                    # 合并之前PO的单元格（如果有多行）
-                    if current_po is not None and row_idx - 1 > po_start_row:
-                        worksheet.merge_range(po_start_row, 0, row_idx - 1, 0, current_po, customer_po_format)
-                        # 同时合并该PO下最后一个商品的Item Code列和总数量列
-                        if row_idx - 1 > item_start_row:
-                            # 合并Item Code列 (B列)
-                            worksheet.merge_range(item_start_row, 1, row_idx - 1, 1, current_item, item_format)
-                            # 合并Item Total in PO列 (H列)
-                            last_item_total = export_data[row_idx - 2]['Item Total in PO']
-                            worksheet.merge_range(item_start_row, 7, row_idx - 1, 7, last_item_total, number_format)
-                    
-                    current_po = po
-                    po_start_row = row_idx
-                    current_item = item
-                    item_start_row = row_idx
-                
-                # 检查商品是否变化（在同一PO内）
-                elif current_item != item:
-                    # 合并之前商品的Item Code列和Item Total in PO列（如果有多行）
-                    if row_idx - 1 > item_start_row:
-                        # 合并Item Code列 (B列)
-                        worksheet.merge_range(item_start_row, 1, row_idx - 1, 1, current_item, item_format)
-                        # 合并Item Total in PO列 (H列)
-                        item_total = export_data[row_idx - 2]['Item Total in PO']
-                        worksheet.merge_range(item_start_row, 7, row_idx - 1, 7, item_total, number_format)
-                    
-                    current_item = item
-                    item_start_row = row_idx
-            
-            # 处理最后一个PO和商品的合并
-            if len(export_data) > po_start_row:
-                last_po = export_data[-1]['Customer PO']
-                worksheet.merge_range(po_start_row, 0, len(export_data), 0, last_po, customer_po_format)
-                
-                # 合并最后一个商品的Item Code列和Item Total in PO列
-                if len(export_data) > item_start_row:
-                    last_item = export_data[-1]['Item Code']
-                    last_item_total = export_data[-1]['Item Total in PO']
-                    # 合并Item Code列 (B列)
-                    worksheet.merge_range(item_start_row, 1, len(export_data), 1, last_item, item_format)
-                    # 合并Item Total in PO列 (H列)
-                    worksheet.merge_range(item_start_row, 7, len(export_data), 7, last_item_total, number_format)
+        po_key = lambda values: values[0]
+        item_key = lambda values: (values[0], values[1])
+        # 合并相同PO的Customer PO列，以及同一PO下相同商品的Item Code列和Item Total in PO列
+        writer = XlsxStreamWriter(workbook.add_worksheet('All POs Details'),
+                                  xlsx_columns(PO_EXPORT_COLUMNS, formats), header_format,
+                                  merge_keys={0: po_key, 1: item_key, 7: item_key})
+        for values in rows:
+            writer.write_row(values, group_key=values[0])
+        writer.close()
     
-    output.seek(0)
-    
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    filename = f'POs-{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+    return send_export(export_format, filename, PO_EXPORT_COLUMNS, rows, write_workbook)
+
+def format_po_export_row(row):
+    return [
+        row['customer_po'],
+        row['item_code'],
+        row['bin_code'],
+        row['BT'] or '',
+        row['boxes_in_bin'],
+        row['pieces_per_box'],
+        row['pieces_in_bin'],
+        row['item_total_in_po']
+    ]
 
 
 if __name__ == '__main__':
@@ -2613,7 +4939,8 @@ if __name__ == '__main__':
             print(f"  {file}: Missing!")
     
     try:
-        init_db()
+        with app.app_context():
+            init_db()
         print("Database initialized successfully")
         
         # 关闭Flask的访问日志
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 导入server时会初始化数据库：测试统一使用临时SQLite数据库，并关闭定时检查点
+os.environ.pop('DATABASE_URL', None)
+os.environ['INVENTORY_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='inventory-test-'), 'inventory.db')
+os.environ['CHECKPOINT_INTERVAL_SECONDS'] = '0'
@@ -0,0 +1,109 @@
+import sqlite3
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def execute(sql, params=()):
+    db = sqlite3.connect(server.get_db_path())
+    try:
+        rows = db.execute(sql, params).fetchall()
+        db.commit()
+        return rows
+    finally:
+        db.close()
+
+
+def add_bins(*bin_codes):
+    for code in bin_codes:
+        execute('INSERT OR IGNORE INTO bins (bin_code) VALUES (?)', (code,))
+
+
+def last_history_id():
+    return execute('SELECT MAX(history_id) FROM input_history')[0][0] or 0
+
+
+def add(client, *entries):
+    response = client.post('/api/inventory/batch', json={'entries': [
+        dict(zip(('bin_code', 'item_code', 'customer_po', 'BT', 'box_count', 'pieces_per_box'), entry))
+        for entry in entries]})
+    assert response.status_code == 200 and response.get_json()['success']
+
+
+def stamp_history(after_id, input_time):
+    """把after_id之后写入的历史记录改到指定时间（UTC），模拟不同时刻的录入"""
+    execute('UPDATE input_history SET input_time = ?, input_date = ? WHERE history_id > ?',
+            (input_time, input_time[:10], after_id))
+
+
+def stock(client, bin_code, item_code, as_of=None):
+    query = f'?as_of={as_of}' if as_of else ''
+    by_bin = client.get(f'/api/inventory/bin/{bin_code}{query}')
+    by_item = client.get(f'/api/inventory/item/{item_code}{query}')
+    assert by_bin.status_code == 200 and by_item.status_code == 200
+    item = by_item.get_json()
+    return by_bin.get_json(), (item['total'], item['total_boxes'], sorted(item['box_details']))
+
+
+def test_as_of_matches_live_stock_at_checkpoint_and_after_clear(client):
+    add_bins('ASOF-A1')
+    start_id = last_history_id()
+    add(client,
+        ('ASOF-A1', 'ASOF-X', 'PO1', 'BT1', 2, 10),
+        ('ASOF-A1', 'ASOF-X', 'PO1', 'BT1', 1, 12),
+        ('ASOF-A1', 'ASOF-X', None, None, 3, 5),
+        ('ASOF-A1', 'ASOF-Y', 'PO2', None, 4, 6))
+    stamp_history(start_id, '2020-01-01 10:00:00')
+    at_checkpoint = stock(client, 'ASOF-A1', 'ASOF-X')
+    response = client.post('/api/checkpoints')
+    assert response.status_code == 201
+
+    checkpoint_id = last_history_id()
+    # 清空后重新录入：同一组先归零再出现，另加一个新的箱规
+    response = client.delete('/api/inventory/bin/ASOF-A1/item/ASOF-X/clear')
+    assert response.status_code == 200
+    add(client,
+        ('ASOF-A1', 'ASOF-X', 'PO1', 'BT1', 5, 10),
+        ('ASOF-A1', 'ASOF-X', 'PO1', 'BT1', 1, 8),
+        ('ASOF-A1', 'ASOF-Y', 'PO2', None, 1, 6))
+    stamp_history(checkpoint_id, '2020-01-02 10:00:00')
+    after_clear = stock(client, 'ASOF-A1', 'ASOF-X')
+
+    assert stock(client, 'ASOF-A1', 'ASOF-X', '2020-01-01 12:00:00') == at_checkpoint
+    assert stock(client, 'ASOF-A1', 'ASOF-X', '2020-01-02 12:00:00') == after_clear
+    assert stock(client, 'ASOF-A1', 'ASOF-X', '2020-01-01 09:00:00') == ([], (0, 0, []))
+
+
+def test_as_of_replay_drops_cleared_groups_and_merges_blank_values(client):
+    add_bins('ASOF-B1')
+    start_id = last_history_id()
+    add(client,
+        ('ASOF-B1', 'ASOF-Z', None, 'BT9', 2, 10),
+        ('ASOF-B1', 'ASOF-Z', None, 'BT9', 3, 4),
+        ('ASOF-B1', 'ASOF-Z', 'PO9', None, 1, 7))
+    # 早期版本把空的PO/BT存成空字符串：与NULL属于同一组
+    execute("UPDATE input_history SET customer_po = '' WHERE history_id > ? AND customer_po IS NULL", (start_id,))
+    execute("UPDATE input_history SET BT = '' WHERE history_id > ? AND BT IS NULL", (start_id,))
+    stamp_history(start_id, '2020-02-01 10:00:00')
+    before_clear = stock(client, 'ASOF-B1', 'ASOF-Z')
+
+    cleared_id = last_history_id()
+    # 清空记录只带最大的箱规：(NULL, BT9) 组的件数合计为0后整组删除，两个箱规都不应残留
+    response = client.delete('/api/inventory/bin/ASOF-B1/item/ASOF-Z/clear')
+    assert response.status_code == 200
+    stamp_history(cleared_id, '2020-02-02 10:00:00')
+    readded_id = last_history_id()
+    add(client, ('ASOF-B1', 'ASOF-Z', None, 'BT9', 1, 4))
+    stamp_history(readded_id, '2020-02-03 10:00:00')
+    after_readd = stock(client, 'ASOF-B1', 'ASOF-Z')
+
+    assert stock(client, 'ASOF-B1', 'ASOF-Z', '2020-02-01 12:00:00') == before_clear
+    assert stock(client, 'ASOF-B1', 'ASOF-Z', '2020-02-02 12:00:00') == ([], (0, 0, []))
+    assert stock(client, 'ASOF-B1', 'ASOF-Z', '2020-02-03 12:00:00') == after_readd
+    assert [group['customer_po'] for group in after_readd[0][0]['po_bt_groups']] == [None]
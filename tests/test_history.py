@@ -0,0 +1,91 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+HISTORY_DATE = '2019-05-01'
+HISTORY_BINS = ['HIST-01', 'HIST-02', 'HIST-03']
+
+
+def history_rows():
+    """生成一天的历史记录（按写入顺序）：清空库位并添加、单独的清空、清空商品和普通添加交错出现"""
+    rng = random.Random(24)
+    time = datetime.strptime(HISTORY_DATE + ' 08:00:00', '%Y-%m-%d %H:%M:%S')
+    rows = []
+    for _ in range(120):
+        time += timedelta(seconds=rng.choice([0, 1, 2, 4, 6, 30]))
+        bin_code = rng.choice(HISTORY_BINS)
+        kind = rng.random()
+        if kind < 0.35:
+            # 清空库位并添加：先写清空记录，再写添加记录
+            for item_code in rng.sample(['清空库位', '清空库位HIST-X', 'Clear Bin'], rng.randint(1, 2)):
+                rows.append((bin_code, item_code, None, None, -1, -10, -10, time))
+            time += timedelta(seconds=rng.choice([0, 1, 3, 6]))
+            rows.append((bin_code, 'HIST-ITEM', 'PO1', None, 2, 10, 20, time))
+        elif kind < 0.5:
+            rows.append((bin_code, '清空库位', None, None, -1, -12, -12, time))
+        elif kind < 0.6:
+            rows.append((bin_code, '清空商品HIST-ITEM', None, None, -1, -10, -10, time))
+        else:
+            rows.append((bin_code, 'HIST-ITEM', None, 'BT1', 1, 6, 6, time))
+    return rows
+
+
+@pytest.fixture(scope='module')
+def flat_merge():
+    db = sqlite3.connect(server.get_db_path())
+    db.row_factory = sqlite3.Row
+    db.executemany('''
+        INSERT INTO input_history (bin_code, item_code, customer_po, BT, box_count, pieces_per_box, total_pieces,
+                                   input_time, input_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [row[:7] + (row[7].strftime('%Y-%m-%d %H:%M:%S'), HISTORY_DATE) for row in history_rows()])
+    db.commit()
+    rows = db.execute('''
+        SELECT history_id, bin_code, item_code, customer_po, BT, box_count, pieces_per_box, total_pieces, input_time
+        FROM input_history WHERE input_date = ? ORDER BY history_id DESC
+    ''', (HISTORY_DATE,)).fetchall()
+    db.close()
+
+    # 一次合并整天的记录，作为分页结果的参照
+    records = []
+    for _, row, clears in server.merge_history_rows(rows):
+        record = server.format_log_row(row)
+        if clears:
+            record['cleared'] = [server.format_log_row(clear) for clear in clears]
+        records.append(record)
+    return rows, records
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 7, 10, 11, 50, 500])
+def test_paged_history_matches_flat_merge(limit, flat_merge):
+    rows, expected = flat_merge
+    client = server.app.test_client()
+    records = []
+    before_id = None
+    for _ in range(len(rows) + 1):
+        query = {'date': HISTORY_DATE, 'limit': limit}
+        if before_id is not None:
+            query['before_id'] = before_id
+        response = client.get('/api/history', query_string=query)
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page['records']) <= limit
+        records.extend(page['records'])
+        before_id = page['next_before_id']
+        if not page['has_more']:
+            break
+    assert records == expected
+
+
+def test_flat_merge_keeps_every_row_once(flat_merge):
+    rows, records = flat_merge
+    # 每条记录要么单独返回，要么作为被吸收的清空记录出现一次
+    returned = [record['history_id'] for record in records] + \
+        [clear['history_id'] for record in records for clear in record.get('cleared', [])]
+    assert sorted(returned) == sorted(row['history_id'] for row in rows)
+    assert any(record.get('cleared') for record in records)
+    assert any(server.history_record_kind(record['item_code']) == 'clear_bin' for record in records)
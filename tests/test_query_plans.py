@@ -0,0 +1,77 @@
+import sqlite3
+
+import pytest
+
+import server
+
+# 查询接口及示例参数：这些接口执行的每条查询都必须使用索引
+LOOKUP_ENDPOINTS = [
+    '/api/inventory/item/{item}',
+    '/api/inventory/bin/{bin}',
+    '/api/inventory/locations/{item}',
+    '/api/inventory/BT/{bt}',
+    '/api/inventory/PO/{po}',
+    '/api/logs?date={date}',
+    '/api/logs?since_id=100&limit=50',
+]
+
+PLAN_BINS = [f'PLAN-{n:03d}' for n in range(20)]
+PLAN_ITEMS = [f'PLAN-SKU{n:03d}' for n in range(50)]
+
+
+@pytest.fixture(scope='module')
+def plan_params():
+    """写入一批库存和历史记录，返回各接口的示例参数"""
+    client = server.app.test_client()
+    db = sqlite3.connect(server.get_db_path())
+    db.executemany('INSERT OR IGNORE INTO bins (bin_code) VALUES (?)', [(code,) for code in PLAN_BINS])
+    db.commit()
+    db.close()
+    entries = [{
+        'bin_code': PLAN_BINS[n % len(PLAN_BINS)],
+        'item_code': PLAN_ITEMS[n % len(PLAN_ITEMS)],
+        'customer_po': f'PLAN-PO{n % 7}',
+        'BT': f'PLAN-BT{n % 5}',
+        'box_count': n % 9 + 1,
+        'pieces_per_box': 12
+    } for n in range(300)]
+    response = client.post('/api/inventory/batch', json={'entries': entries})
+    assert response.status_code == 200 and response.get_json()['accepted'] == len(entries)
+    db = sqlite3.connect(server.get_db_path())
+    date = db.execute('SELECT MAX(input_date) FROM input_history').fetchone()[0]
+    db.close()
+    return {'item': PLAN_ITEMS[0], 'bin': PLAN_BINS[0], 'bt': 'PLAN-BT0', 'po': 'PLAN-PO0', 'date': date}
+
+
+# 每个归档月份一行的元数据表，整表读取是预期行为
+SMALL_TABLES = ('history_archive_months',)
+
+
+def full_table_scans(plan_rows):
+    # 标量子查询外层的"SCAN CONSTANT ROW"只读一行常量，不算扫描
+    return [detail for detail in plan_rows
+            if detail.startswith('SCAN') and detail != 'SCAN CONSTANT ROW'
+            and detail.split()[1] not in SMALL_TABLES]
+
+
+@pytest.mark.parametrize('endpoint', LOOKUP_ENDPOINTS)
+def test_lookup_queries_use_indexes(endpoint, plan_params):
+    client = server.app.test_client()
+    with server.app.app_context():
+        # 测试客户端与应用上下文在同一线程，复用同一个SQLite连接，可以捕获接口实际执行的SQL
+        connection = server.get_db()
+        statements = []
+        connection.set_trace_callback(statements.append)
+        try:
+            response = client.get(endpoint.format(**plan_params))
+        finally:
+            connection.set_trace_callback(None)
+        assert response.status_code == 200
+
+        queries = [sql for sql in statements if sql.lstrip().upper().startswith(('SELECT', 'WITH'))]
+        assert queries
+        cursor = connection.cursor()
+        for sql in queries:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            plan = [row[3] for row in cursor.fetchall()]
+            assert not full_table_scans(plan), f"{' '.join(sql.split())}\n" + '\n'.join(plan)
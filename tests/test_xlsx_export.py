@@ -0,0 +1,57 @@
+import pytest
+import xlsxwriter
+
+from server import XlsxStreamWriter
+
+openpyxl = pytest.importorskip('openpyxl')
+
+
+def write_grouped_sheet(path, rows):
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Export')
+    header = workbook.add_format({'bold': True})
+    text = workbook.add_format({'valign': 'vcenter'})
+    writer = XlsxStreamWriter(worksheet, [('Item', 12, text), ('Bin', 12, text), ('Pieces', 10, text)], header,
+                              merge_keys={0: lambda values: values[0],
+                                          1: lambda values: (values[0], values[1])})
+    for values in rows:
+        writer.write_row(values, group_key=values[0])
+    row_count = writer.close()
+    workbook.close()
+    return row_count
+
+
+def test_grouped_rows_are_merged_and_complete(tmp_path):
+    path = str(tmp_path / 'export.xlsx')
+    rows = [
+        ('X1', 'A1', 10),
+        ('X1', 'A1', 20),
+        ('X1', 'A2', 30),
+        ('X2', 'A1', 40),
+        ('X3', 'B1', 50),
+        ('X3', 'B2', 60),
+    ]
+    assert write_grouped_sheet(path, rows) == len(rows)
+
+    worksheet = openpyxl.load_workbook(path)['Export']
+    assert sorted(str(cell_range) for cell_range in worksheet.merged_cells.ranges) == ['A2:A4', 'A6:A7', 'B2:B3']
+    # 每一行的非合并列都完整写出，合并区域只在首行有值
+    assert [worksheet.cell(row=row, column=3).value for row in range(2, 8)] == [10, 20, 30, 40, 50, 60]
+    assert [worksheet.cell(row=row, column=1).value for row in range(2, 8)] == ['X1', None, None, 'X2', 'X3', None]
+    assert [worksheet.cell(row=row, column=2).value for row in range(2, 8)] == ['A1', None, 'A2', 'A1', 'B1', 'B2']
+
+
+def test_rows_without_merge_keys_are_written_directly(tmp_path):
+    path = str(tmp_path / 'plain.xlsx')
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Export')
+    header = workbook.add_format({'bold': True})
+    writer = XlsxStreamWriter(worksheet, [('Item', 12, None), ('Pieces', 10, None)], header)
+    writer.write_row(('X1', 1))
+    writer.write_row(('X1', 2))
+    assert writer.close() == 2
+    workbook.close()
+
+    worksheet = openpyxl.load_workbook(path)['Export']
+    assert not worksheet.merged_cells.ranges
+    assert [[cell.value for cell in row] for row in worksheet.iter_rows()] == [['Item', 'Pieces'], ['X1', 1], ['X1', 2]]